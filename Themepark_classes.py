@@ -1,29 +1,64 @@
-import random
+import copyreg
+import csv
+import heapq
+import math
+import pickle
+import time
+import weakref
+import zlib
+from array import array
+from bisect import bisect_right
 from collections import deque
+from itertools import count
 import numpy as np
+from themepark_trace import TRACE_ARRIVAL, TRACE_REJECTED, TRACE_RIDE, TraceRecorder, format_trace
 
 class PriorityQueue:
     """
     Represents a priority queue in the theme park simulation that arranges events 
     in ascending order of their priority value (event time). 
+    The events are kept in a binary heap, so pushing and popping an event costs O(log n).
+    Events with the same event_time are returned in the order they were pushed.
     
     Attribute:
-    queue (list): a list of tuples representing events. Each tuple contains:
+    queue (list): a list of tuples representing events in the order they will be popped. Each tuple contains:
             - event_time (float): The time at which the event occurs.
             - ride_id (int): The unique identifier of the ride or 0 for a new customer arrival.
     """
     def __init__(self):
         """Initialises an empty priority queue."""
-        self._queue = []
+        self._heap = []  # Heap of (event_time, sequence_number, ride_id) tuples
+        self._counter = count()  # Sequence numbers break ties between events with equal times
 
     @property
     def queue(self):
-        """Returns the current state of the priority queue."""
-        return self._queue
+        """Returns the current state of the priority queue, sorted by event_time."""
+        return [(event_time, ride_id) for event_time, _, ride_id in sorted(self._heap)]
+
+    def __getstate__(self):
+        # Sequence numbers only order events with equal times, so the counter is not saved
+        return {"_heap": self._heap}
+
+    def __setstate__(self, state):
+        self._heap = state["_heap"]
+        # Later events still get higher sequence numbers than the scheduled ones
+        self._counter = count(max((sequence for _, sequence, _ in self._heap), default=-1) + 1)
+
+    def __len__(self):
+        """Returns the number of scheduled events."""
+        return len(self._heap)
+
+    @staticmethod
+    def _check_event(event_time, ride_id):
+        """Raises ValueError if event_time is not a non-negative number or ride_id is not a non-negative integer."""
+        if not isinstance(event_time, (int, float)) or event_time < 0:
+            raise ValueError("event_time must be a non-negative number.")
+        if not isinstance(ride_id, int) or ride_id < 0:  
+            raise ValueError("ride_id must be a non-negative integer.")
 
     def push(self, event_time, ride_id):
         """
-        Inserts a new event into the priority queue and sorts it by event_time.
+        Inserts a new event into the priority queue.
 
         Parameters:
         - event_time (int or float): The time at which the event occurs.
@@ -31,15 +66,44 @@ class PriorityQueue:
         
         Raises ValueError if event_time is not a non-negative number or ride_id is not a non-negative integer.
         """
-        if not isinstance(event_time, (int, float)) or event_time < 0:
-            raise ValueError("event_time must be a non-negative number.")
-        if not isinstance(ride_id, int) or ride_id < 0:  
-            raise ValueError("ride_id must be a non-negative integer.")
-        
-        self._queue.append((float(event_time), ride_id))
-        # Sort the queue by event_time
-        get_first_element = lambda event: event[0]
-        self._queue.sort(key = get_first_element)
+        self._check_event(event_time, ride_id)
+        heapq.heappush(self._heap, (float(event_time), next(self._counter), ride_id))
+
+    def _push_trusted(self, event_time, ride_id):
+        """Inserts an event without validating it, for the float times and ride_ids generated by ThemePark.simulate."""
+        heapq.heappush(self._heap, (event_time, next(self._counter), ride_id))
+
+    def push_many(self, events):
+        """
+        Schedules several events at once, e.g. to pre-schedule a batch of arrivals.
+        Equal event times keep the order in which they appear in events.
+
+        Parameters:
+        - events (iterable of tuples): (event_time, ride_id) pairs.
+
+        Raises ValueError if any event_time is not a non-negative number or any ride_id is not a non-negative integer.
+        """
+        new_entries = []
+        for event_time, ride_id in events:
+            self._check_event(event_time, ride_id)
+            new_entries.append((float(event_time), next(self._counter), ride_id))
+        # Rebuilding the heap is O(n), cheaper than pushing a large batch one by one
+        self._heap.extend(new_entries)
+        heapq.heapify(self._heap)
+
+    def peek(self):
+        """
+        Returns the first item in queue without removing it.
+
+        Returns:
+        - tuple (event_time, ride_id): the event with the smallest event_time.
+
+        Raises IndexError if the queue is empty.
+        """
+        if not self._heap:
+            raise IndexError("Cannot peek because the priority queue is empty.")
+        event_time, _, ride_id = self._heap[0]
+        return (event_time, ride_id)
 
     def popleft(self):
         """
@@ -50,15 +114,172 @@ class PriorityQueue:
 
         Raises IndexError if the queue is empty.
         """
-        if not self._queue:
+        if not self._heap:
             raise IndexError("Cannot popleft because the priority queue is empty.")
-        return self._queue.pop(0)
+        event_time, _, ride_id = heapq.heappop(self._heap)
+        return (event_time, ride_id)
     
 
 
+class TripLog:
+    """
+    Append-only columnar record of the rides taken by customers, shared by all customers of a park.
+    Each column is a typed array that grows geometrically, so a trip costs 44 bytes instead of
+    several Python objects. Every trip also stores the index of the same customer's previous trip,
+    so a customer only needs to remember their latest trip to walk back through their history.
+    The trips of customers who have left can be dropped with compact.
+
+    Attributes (one element per trip, in the order the trips were recorded, or grouped by customer after compact):
+    - customer_ids (array of int): The customer who took the ride.
+    - ride_ids (array of int): The ride taken.
+    - queue_entry_times (array of float): The time the customer joined the ride queue.
+    - start_times (array of float): The time the ride started.
+    - end_times (array of float): The time the ride finished.
+    """
+    def __init__(self):
+        """Initialises an empty trip log."""
+        self._customer_ids = array("q")
+        self._ride_ids = array("i")
+        self._queue_entry_times = array("d")
+        self._start_times = array("d")
+        self._end_times = array("d")
+        self._previous = array("q")  # Index of the customer's previous trip, -1 for their first
+
+    @property
+    def customer_ids(self):
+        return self._customer_ids
+
+    @property
+    def ride_ids(self):
+        return self._ride_ids
+
+    @property
+    def queue_entry_times(self):
+        return self._queue_entry_times
+
+    @property
+    def start_times(self):
+        return self._start_times
+
+    @property
+    def end_times(self):
+        return self._end_times
+
+    def __len__(self):
+        """Returns the number of trips recorded."""
+        return len(self._ride_ids)
+
+    def append(self, customer_id, ride_id, queue_entry_time, start_time, end_time, previous):
+        """
+        Records one trip.
+
+        Parameters:
+        - customer_id (int): The ID of the customer.
+        - ride_id (int): The ID of the ride.
+        - queue_entry_time (float): The time the customer joined the queue.
+        - start_time (float): The time the ride started.
+        - end_time (float): The time the ride finished.
+        - previous (int): The index of the customer's previous trip, or -1 if this is their first.
+
+        Returns:
+        int: the index of the new trip.
+        """
+        self._customer_ids.append(customer_id)
+        self._ride_ids.append(ride_id)
+        self._queue_entry_times.append(queue_entry_time)
+        self._start_times.append(start_time)
+        self._end_times.append(end_time)
+        self._previous.append(previous)
+        return len(self._previous) - 1
+
+    def history(self, last_trip):
+        """
+        Returns the indices of a customer's trips in the order they were taken.
+
+        Parameter:
+        last_trip (int): The index of the customer's latest trip, or -1 if they have not taken any.
+
+        Returns:
+        list of int: indices into the columns of the log.
+        """
+        indices = []
+        previous = self._previous
+        while last_trip >= 0:
+            indices.append(last_trip)
+            last_trip = previous[last_trip]
+        indices.reverse()
+        return indices
+
+    def extract(self, history):
+        """
+        Copies the trips of one customer to a new log.
+
+        Parameter:
+        history (list of int): The indices of the customer's trips in the order they were taken, as from history.
+
+        Returns:
+        TripLog: a log holding these trips only, in the same order.
+        """
+        trip_log = TripLog.__new__(TripLog)
+        trip_log._customer_ids = array("q", [self._customer_ids[i] for i in history])
+        trip_log._ride_ids = array("i", [self._ride_ids[i] for i in history])
+        trip_log._queue_entry_times = array("d", [self._queue_entry_times[i] for i in history])
+        trip_log._start_times = array("d", [self._start_times[i] for i in history])
+        trip_log._end_times = array("d", [self._end_times[i] for i in history])
+        trip_log._previous = array("q", range(-1, len(history) - 1))
+        return trip_log
+
+    def compact(self, last_trips):
+        """
+        Keeps only the trips of the given customers, grouped by customer in the order given,
+        and drops every other trip.
+
+        Parameter:
+        last_trips (list of int): The index of the latest trip of each customer to keep, -1 if they have not taken any.
+
+        Returns:
+        list of int: the new index of the latest trip of each customer, in the same order.
+        """
+        keep, new_last_trips = [], []
+        previous = array("q")
+        for last_trip in last_trips:
+            history = self.history(last_trip)
+            previous.extend(range(len(keep) - 1, len(keep) + len(history) - 1))
+            if history:
+                previous[len(keep)] = -1  # The customer's first trip
+            keep += history
+            new_last_trips.append(len(keep) - 1 if history else -1)
+        keep = np.array(keep, dtype=np.int64)
+        for name, dtype in (("_customer_ids", np.int64), ("_ride_ids", np.int32), ("_queue_entry_times", np.float64),
+                            ("_start_times", np.float64), ("_end_times", np.float64)):
+            column = getattr(self, name)
+            kept = array(column.typecode)
+            kept.frombytes(np.frombuffer(column, dtype=dtype)[keep].tobytes())
+            setattr(self, name, kept)
+        self._previous = previous
+        return new_last_trips
+
+    def to_numpy(self):
+        """
+        Returns the columns of the log as numpy arrays sharing memory with the log.
+        The arrays are only valid until the next trip is appended.
+
+        Returns:
+        dict of numpy.ndarray: keyed by 'customer_id', 'ride_id', 'queue_entry_time', 'start_time' and 'end_time'.
+        """
+        return {"customer_id": np.frombuffer(self._customer_ids, dtype=np.int64),
+                "ride_id": np.frombuffer(self._ride_ids, dtype=np.int32),
+                "queue_entry_time": np.frombuffer(self._queue_entry_times, dtype=np.float64),
+                "start_time": np.frombuffer(self._start_times, dtype=np.float64),
+                "end_time": np.frombuffer(self._end_times, dtype=np.float64)}
+
+
+
 class Customer:
     """
     Represents a customer visiting the theme park.
+    The rides of the customer are stored in a TripLog, usually shared with the rest of the park, 
+    and path, ride_times and wait_times are built from it when they are accessed.
     
     Attributes: 
     - customer_id (int): The unique identifier of the customer.
@@ -66,15 +287,19 @@ class Customer:
     - path (list[int]): The sequence of ride_id (int) the customer visits.    
     - ride_times (list[float]): Time spent on each ride.
     - wait_times (list[float]): Time spent in each ride's queue.
+    - trip_log (TripLog): The log holding the customer's rides.
     """
+    # No per-instance __dict__, as a park can hold millions of customers
+    __slots__ = ("_customer_id", "_arrival_time", "_trip_log", "_last_trip", "__weakref__")
 
-    def __init__(self, customer_id, arrival_time):
+    def __init__(self, customer_id, arrival_time, trip_log=None):
         """
         Initialises a Customer object with their ID and arrival time.
 
         Parameters:
         - customer_id (int): The unique ID of the customer.
         - arrival_time (int or float): The time at which the customer arrives at the park.
+        - trip_log (TripLog or None): The log to record rides in. A private log is created if None.
         
         Raises ValueError if
         - customer_id is not an integer or 
@@ -89,9 +314,18 @@ class Customer:
         # Private attributes to prevent accidental modification of the customer record by external code
         self._customer_id = customer_id
         self._arrival_time = float(arrival_time)
-        self._path = []
-        self._ride_times = []
-        self._wait_times = []
+        self._trip_log = trip_log if trip_log is not None else TripLog()
+        self._last_trip = -1  # Index of the customer's latest trip in the log
+
+    @classmethod
+    def _trusted(cls, customer_id, arrival_time, trip_log):
+        """Creates a customer without validating the arguments, for the values generated by ThemePark.simulate."""
+        customer = cls.__new__(cls)
+        customer._customer_id = customer_id
+        customer._arrival_time = arrival_time
+        customer._trip_log = trip_log
+        customer._last_trip = -1
+        return customer
 
     # Use getters to access the read-only private attributes
     @property
@@ -101,18 +335,41 @@ class Customer:
     @property
     def arrival_time(self):
         return self._arrival_time
+
+    @property
+    def trip_log(self):
+        return self._trip_log
     
     @property
     def path(self):
-        return self._path
+        ride_ids = self._trip_log.ride_ids
+        return [ride_ids[i] for i in self._trip_log.history(self._last_trip)]
 
     @property
     def ride_times(self):
-        return self._ride_times
+        starts, ends = self._trip_log.start_times, self._trip_log.end_times
+        return [ends[i] - starts[i] for i in self._trip_log.history(self._last_trip)]
 
     @property
     def wait_times(self):
-        return self._wait_times
+        entries, starts = self._trip_log.queue_entry_times, self._trip_log.start_times
+        # A customer whose queue entry time is after the ride start boarded immediately
+        return [starts[i] - entries[i] if starts[i] >= entries[i] else 0.0
+                for i in self._trip_log.history(self._last_trip)]
+
+    def _detach(self):
+        """
+        Moves the customer's trips to a private TripLog, so that the shared log can drop them.
+
+        Returns:
+        int: the number of trips moved.
+        """
+        if self._last_trip < 0:
+            return 0  # No trips to keep, so the shared log is never read
+        history = self._trip_log.history(self._last_trip)
+        self._trip_log = self._trip_log.extract(history)
+        self._last_trip = len(history) - 1
+        return len(history)
 
     def record_ride(self, ride_id, ride_time, wait_time):
         """
@@ -134,9 +391,107 @@ class Customer:
             raise ValueError("ride_time must be a non-negative number.")
         if not isinstance(wait_time, (int, float)) or wait_time < 0:
             raise ValueError("wait_time must be a non-negative number.")
-        self._path.append(ride_id)
-        self._ride_times.append(float(ride_time))
-        self._wait_times.append(float(wait_time))
+        # Start the ride at time 0 so that the durations are stored exactly
+        self._last_trip = self._trip_log.append(self._customer_id, ride_id, -float(wait_time), 0.0, 
+                                                float(ride_time), self._last_trip)
+
+    def record_trip(self, ride_id, queue_entry_time, start_time, end_time):
+        """
+        Records a ride by its times, as the simulation knows them.
+
+        Parameters:
+        - ride_id (int): The ID of the ride.
+        - queue_entry_time (int or float): The time the customer joined the ride queue. It may be after
+            start_time if the customer boarded as soon as they were routed to the ride, i.e. without waiting.
+        - start_time (int or float): The time the ride started.
+        - end_time (int or float): The time the ride finished.
+
+        Raises ValueError if
+        - ride_id is not a non-negative integer or
+        - a time is not a non-negative number or end_time is before start_time
+        """
+        if not isinstance(ride_id, int) or ride_id < 0:
+            raise ValueError("ride_id must be a non-negative integer.")
+        for time_value in (queue_entry_time, start_time, end_time):
+            if not isinstance(time_value, (int, float)) or time_value < 0:
+                raise ValueError("queue_entry_time, start_time and end_time must be non-negative numbers.")
+        if end_time < start_time:
+            raise ValueError("end_time must not be before start_time.")
+        self._record_trip(ride_id, float(queue_entry_time), float(start_time), float(end_time))
+
+    def _record_trip(self, ride_id, queue_entry_time, start_time, end_time):
+        """Does the work of record_trip without validation, for the values generated by ThemePark.simulate."""
+        self._last_trip = self._trip_log.append(self._customer_id, ride_id, queue_entry_time, start_time,
+                                                end_time, self._last_trip)
+
+
+
+class VariateStream:
+    """
+    A stream of random variates drawn from its own numpy Generator in pre-drawn blocks, 
+    so that each variate costs a list lookup rather than a call into numpy. Blocks start small and 
+    double up to block_size, so that rarely used streams do not draw thousands of unused variates.
+    Giving each source of randomness (arrivals, each ride's service, routing) its own stream 
+    keeps runs reproducible from one seed and lets scenarios share common random numbers.
+
+    Attributes:
+    - rng (numpy.random.Generator): The generator the blocks are drawn from.
+    - block_size (int): The largest number of variates drawn at a time.
+    """
+    def __init__(self, rng=None, block_size=4096):
+        """
+        Parameters:
+        - rng (numpy.random.Generator, int, numpy.random.SeedSequence or None): The generator, or a seed for one.
+        - block_size (int): The largest number of variates to pre-draw at a time. Must be positive.
+
+        Raises ValueError if block_size is not a positive integer.
+        """
+        if not isinstance(block_size, int) or block_size <= 0:
+            raise ValueError("block_size must be a positive integer.")
+        self._rng = np.random.default_rng(rng)
+        self._block_size = block_size
+        self._exponential_block = min(64, block_size)  # Size of the next block of each kind
+        self._uniform_block = min(64, block_size)
+        self._exponentials = []  # Pre-drawn standard exponential variates
+        self._exponential_position = 0
+        self._uniforms = []  # Pre-drawn uniform variates on [0, 1)
+        self._uniform_position = 0
+
+    @property
+    def rng(self):
+        return self._rng
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def exponential(self, rate):
+        """
+        Returns an exponential variate.
+
+        Parameter:
+        rate (float): The rate of the distribution (1 / mean).
+
+        Returns:
+        float: the variate.
+        """
+        if self._exponential_position == len(self._exponentials):
+            self._exponentials = self._rng.standard_exponential(self._exponential_block).tolist()
+            self._exponential_position = 0
+            self._exponential_block = min(2 * self._exponential_block, self._block_size)
+        value = self._exponentials[self._exponential_position]
+        self._exponential_position += 1
+        return value / rate
+
+    def uniform(self):
+        """Returns a uniform variate on [0, 1)."""
+        if self._uniform_position == len(self._uniforms):
+            self._uniforms = self._rng.random(self._uniform_block).tolist()
+            self._uniform_position = 0
+            self._uniform_block = min(2 * self._uniform_block, self._block_size)
+        value = self._uniforms[self._uniform_position]
+        self._uniform_position += 1
+        return value
 
 
 
@@ -152,8 +507,17 @@ class Ride(deque):
     - customers_processed (int): A count of the number of customers the ride has processed.
     - total_ride_time (float): The cumulative time spent on the ride by customers.
     - queue_entry_times (dict): A ditionary mapping customer IDs to their queue entry times. 
+        Entries are removed when the customer boards.
+    - service_stream (VariateStream): The source of the ride times.
+    - queue_area (float): The integral over time of the queue length since the statistics were reset.
+        The queue holds every customer routed to the ride who has not boarded yet, including those still
+        finishing their previous ride.
+    - busy_area (float): The total ride time of the customers boarded since the statistics were reset, i.e. the
+        integral over time of the number of customers riding, counting each ride to its end.
+    - max_queue_length (int): The longest queue seen.
+    - stats_start (float): The time the statistics were last reset.
     """
-    def __init__(self, ride_id, ride_name, ride_rate):
+    def __init__(self, ride_id, ride_name, ride_rate, rng=None):
         """
         Initialises a Ride object with its ID, name, and customer-processing rate.
         
@@ -161,6 +525,8 @@ class Ride(deque):
         - ride_id (int): a unique positive identifier of the ride, or 0 for a new customer arrival.
         - ride_name (str): The name of the ride.
         - ride_rate (float): Rate at which the ride processes customers (positive number).
+        - rng (numpy.random.Generator, int or None): The generator, or a seed for one, of the ride times.
+            A ThemePark created with its own rng replaces it.
         
         Raises ValueError if
         ride_id is not a positive integer, or ride_name is not of type string, or ride_rate is not a positive number.
@@ -180,6 +546,23 @@ class Ride(deque):
         self._customers_processed = 0
         self._total_ride_time = 0
         self._queue_entry_times = {}  # Dictionary to store queue entry times of customers
+        self._service_stream = VariateStream(rng)
+        self.reset_stats()
+
+    def reset_stats(self, start_time=0.0):
+        """
+        Starts the time-weighted statistics afresh at start_time, e.g. at the start of a simulation run.
+        customers_processed and total_ride_time are not reset.
+        """
+        self._clock = start_time  # The time up to which queue_area is integrated
+        self._stats_start = start_time
+        self._queue_area = 0.0
+        self._busy_area = 0.0
+        self._max_queue_length = len(self)
+        # Completion times of the customers boarded since the reset, of which those that may still be riding are kept
+        self._completions = []
+        self._compact_completions_at = 1024
+        self._n_served = 0  # Customers boarded since the reset
 
     @property
     def ride_id(self):
@@ -200,6 +583,85 @@ class Ride(deque):
     @property
     def total_ride_time(self):
         return self._total_ride_time
+
+    @property
+    def queue_entry_times(self):
+        return self._queue_entry_times
+
+    @property
+    def service_stream(self):
+        return self._service_stream
+
+    @property
+    def queue_area(self):
+        return self._queue_area
+
+    @property
+    def busy_area(self):
+        return self._busy_area
+
+    @property
+    def max_queue_length(self):
+        return self._max_queue_length
+
+    @property
+    def stats_start(self):
+        return self._stats_start
+
+    def _advance(self, now):
+        """Integrates the queue length up to now, in O(1)."""
+        self._queue_area += len(self) * (now - self._clock)
+        self._clock = now
+
+    def _join(self, customer, queue_entry_time, now):
+        """Adds a customer to the back of the queue at time now, for the ThemePark event handlers."""
+        if now > self._clock:
+            self._advance(now)
+        deque.append(self, (customer, queue_entry_time))
+        self._queue_entry_times[customer.customer_id] = queue_entry_time
+        if len(self) > self._max_queue_length:
+            self._max_queue_length = len(self)
+
+    def summary(self, end_time):
+        """
+        Returns the time-weighted statistics of the ride from stats_start to end_time, without changing them.
+
+        Parameter:
+        end_time (float): The end of the period, at least the time of the last update.
+
+        Returns:
+        dict with the keys 'n_served' (customers boarded), 'throughput' (boardings per unit time), 
+        'mean_queue_length' and 'max_queue_length' (of the queue as held by the ride, i.e. including customers
+        routed to the ride who are still finishing their previous ride, unlike the mean_queue_length of
+        ThemePark.analyze), 'mean_busy' (mean number of customers riding) and 'utilization' (throughput divided
+        by ride_rate, i.e. the mean number riding if every customer rode for 1 / ride_rate, which estimates
+        the utilization of ThemePark.analyze).
+        """
+        # The rides still going on at end_time only count up to it
+        busy_area = self._busy_area - sum(completion_time - end_time for completion_time in self._completions
+                                          if completion_time > end_time)
+        queue_area = self._queue_area + len(self) * max(0.0, end_time - self._clock)
+        elapsed = end_time - self._stats_start
+        mean = (lambda area: area / elapsed) if elapsed > 0 else (lambda area: math.nan)
+        return {"n_served": self._n_served,
+                "throughput": mean(self._n_served),
+                "mean_queue_length": mean(queue_area),
+                "max_queue_length": self._max_queue_length,
+                "mean_busy": mean(busy_area),
+                "utilization": mean(self._n_served) / self._ride_rate}
+
+    def set_rng(self, rng):
+        """
+        Replaces the source of the ride times.
+
+        Parameter:
+        rng (numpy.random.Generator, int, numpy.random.SeedSequence or None): The generator, or a seed for one.
+        """
+        self._service_stream = VariateStream(rng)
+
+    def sample_ride_time(self):
+        """Returns a ride time drawn from the exponential distribution with rate ride_rate."""
+        return self._service_stream.exponential(self._ride_rate)
     
     def append(self, customer_tuple):
         """
@@ -208,9 +670,9 @@ class Ride(deque):
         Parameters:
         customer_tuple (tuple): contains a Customer object and their queue entry time.
         """
-        super().append(customer_tuple)  # Add the customer to the queue
         customer, queue_entry_time = customer_tuple
-        self._queue_entry_times[customer.customer_id] = queue_entry_time  # Store queue entry time
+        # The customer joins at their queue entry time, or now if the statistics have already passed it
+        self._join(customer, queue_entry_time, max(queue_entry_time, self._clock))
     
     def carry_customer(self, current_time):
         """
@@ -228,21 +690,43 @@ class Ride(deque):
         - IndexError if the ride queue is empty i.e. no customers.
         - ValueError if current_time is not a number. 
         """
+        customer, _, completion_time = self._carry_validated(current_time)
+        return (customer, completion_time)
+
+    def _carry_validated(self, current_time):
+        """Validates current_time as carry_customer does, then returns _carry_trusted(current_time)."""
         if not isinstance(current_time, (int, float)):
             raise ValueError("current_time must be a number.")
         if not self:
             raise ValueError("The ride queue is empty so there is no customer to carry.")
+        return self._carry_trusted(current_time)
 
+    def _carry_trusted(self, current_time):
+        """
+        Does the work of carry_customer without validation, as ThemePark.simulate only boards non-empty queues.
+        Returns (customer, queue_entry_time, completion_time).
+        """
+        if current_time > self._clock:
+            self._advance(current_time)
         # Process the first customer in the queue
         customer, queue_entry_time = self.popleft()  
+        self._queue_entry_times.pop(customer.customer_id, None)  # Only customers in the queue are kept
         self._customers_processed += 1
+        self._n_served += 1
 
         # Generate ride time with the exponential rate parameter
-        ride_time = random.expovariate(self._ride_rate)
+        ride_time = self._service_stream.exponential(self._ride_rate)
         completion_time = current_time + ride_time
         self._total_ride_time += ride_time
+        self._busy_area += ride_time
+        completions = self._completions
+        completions.append(completion_time)
+        if len(completions) >= self._compact_completions_at:
+            # Drop the rides that have finished, in amortised O(1) per boarding
+            completions[:] = [completion for completion in completions if completion > current_time]
+            self._compact_completions_at = max(1024, 2 * len(completions))
 
-        return (customer, completion_time)
+        return (customer, queue_entry_time, completion_time)
     
     def get_queue_entry_time(self, customer_id):
         """
@@ -265,43 +749,725 @@ class Ride(deque):
         """
         customer_ids = [customer.customer_id for customer, arrival_time in self]
         return f"Queue for the ride {self.ride_id}, {self.ride_name}: {customer_ids}"
+
+    def __reduce__(self):
+        # deque pickles by calling the class without arguments, which Ride does not accept, 
+        # so create the deque without __init__ and restore the queue and attributes afterwards
+        return (copyreg.__newobj__, (type(self),), self.__dict__, iter(self))
     
 
 
+class Router:
+    """
+    Draws the next ride of a customer from a transition matrix using Walker alias tables.
+    The tables are built once per row, after which each draw costs O(1) and uses a single
+    uniform variate taken from a pre-drawn block.
+
+    Attributes:
+    - n_states (int): The number of rows (and columns) of the transition matrix.
+    - block_size (int): The number of uniform variates drawn from the generator at a time.
+    """
+    def __init__(self, transition_matrix, rng=None, block_size=4096):
+        """
+        Builds the alias tables of every row of the transition matrix.
+
+        Parameters:
+        - transition_matrix (numpy.ndarray): Square matrix whose rows are probability distributions.
+        - rng (numpy.random.Generator, int or None): The generator, or a seed for one, used for all draws.
+        - block_size (int): The number of uniform variates to pre-draw at a time. Must be positive.
+
+        Raises ValueError if a row has negative entries or does not sum to 1, or block_size is not a positive integer.
+        """
+        probabilities = np.asarray(transition_matrix, dtype=float)
+        if probabilities.ndim != 2 or np.any(probabilities < 0) or not np.allclose(probabilities.sum(axis=1), 1.0):
+            raise ValueError("Every row of the transition matrix must be non-negative and sum to 1.")
+        if not isinstance(block_size, int) or block_size <= 0:
+            raise ValueError("block_size must be a positive integer.")
+        self._n_states = probabilities.shape[1]
+        self._block_size = block_size
+        self._rng = np.random.default_rng(rng)
+
+        # Python lists index faster than numpy arrays when drawing one value at a time
+        tables = [self._build_alias_table(row) for row in probabilities]
+        self._accept = [accept.tolist() for accept, _ in tables]
+        self._alias = [alias.tolist() for _, alias in tables]
+        self._accept_array = np.array([accept for accept, _ in tables])
+        self._alias_array = np.array([alias for _, alias in tables])
+
+        self._columns = []  # Pre-drawn column indices and their fractional parts
+        self._fractions = []
+        self._position = 0
+
+    @property
+    def n_states(self):
+        return self._n_states
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    def set_rng(self, rng):
+        """
+        Replaces the generator of the draws, discarding the pre-drawn variates.
+
+        Parameter:
+        rng (numpy.random.Generator, int, numpy.random.SeedSequence or None): The generator, or a seed for one.
+        """
+        self._rng = np.random.default_rng(rng)
+        self._columns = []
+        self._fractions = []
+        self._position = 0
+
+    @staticmethod
+    def _build_alias_table(row):
+        """
+        Builds the alias table of one probability distribution with Vose's method.
+
+        Parameter:
+        row (numpy.ndarray): probabilities of each outcome, summing to 1.
+
+        Returns:
+        tuple (accept, alias) of numpy arrays: outcome i is kept with probability accept[i], 
+        otherwise it is replaced by alias[i].
+        """
+        n = len(row)
+        scaled = row / row.sum() * n
+        accept = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            i = small.pop()
+            j = large.pop()
+            accept[i] = scaled[i]
+            alias[i] = j
+            scaled[j] -= 1.0 - scaled[i]
+            if scaled[j] < 1.0:
+                small.append(j)
+            else:
+                large.append(j)
+        # Whatever is left has probability 1 up to rounding error
+        return accept, alias
+
+    def _refill(self):
+        """Pre-draws a block of uniform variates, split into a column index and its fractional part."""
+        scaled = self._rng.random(self._block_size) * self._n_states
+        columns = np.minimum(scaled.astype(np.int64), self._n_states - 1)
+        self._columns = columns.tolist()
+        self._fractions = (scaled - columns).tolist()
+        self._position = 0
+
+    def draw(self, row):
+        """
+        Draws the next state given the current one.
+
+        Parameter:
+        row (int): The current state (row of the transition matrix).
+
+        Returns:
+        int: The next state.
+        """
+        if self._position == len(self._columns):
+            self._refill()
+        column = self._columns[self._position]
+        fraction = self._fractions[self._position]
+        self._position += 1
+        if fraction < self._accept[row][column]:
+            return column
+        return self._alias[row][column]
+
+    def draw_many(self, rows):
+        """
+        Draws the next state for many current states at once.
+
+        Parameter:
+        rows (int or array-like of int): The current states.
+
+        Returns:
+        numpy.ndarray: The next state for each element of rows.
+        """
+        rows = np.asarray(rows)
+        scaled = self._rng.random(rows.shape) * self._n_states
+        columns = np.minimum(scaled.astype(np.int64), self._n_states - 1)
+        keep = (scaled - columns) < self._accept_array[rows, columns]
+        return np.where(keep, columns, self._alias_array[rows, columns])
+
+
+
+class SparseTransitions:
+    """
+    Transition probabilities stored in compressed sparse row (CSR) form, for parks where each ride, show
+    or food stop only leads to a handful of others. The out-edges of state i are at positions 
+    indptr[i] to indptr[i + 1] of indices (the next states) and probabilities.
+    It can be passed to ThemePark instead of a dense transition matrix, with the same numbering of states
+    (0 for the entrance, the ride_ids, then the exit).
+
+    Attributes:
+    - n_states (int): The number of states (rows and columns).
+    - shape (tuple): (n_states, n_states), as for a dense matrix.
+    - indptr (numpy.ndarray): The start of the out-edges of each state, followed by the number of edges.
+    - indices (numpy.ndarray): The next state of each edge.
+    - probabilities (numpy.ndarray): The probability of each edge.
+    """
+    def __init__(self, indptr, indices, probabilities):
+        """
+        Parameters:
+        - indptr (array-like of int): The start of the out-edges of each state, then the number of edges.
+        - indices (array-like of int): The next state of each edge.
+        - probabilities (array-like of float): The probability of each edge.
+
+        Raises ValueError if the arrays are inconsistent, a next state is out of range, a probability is 
+        negative or the out-edges of a state do not sum to 1.
+        """
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        probabilities = np.asarray(probabilities, dtype=float)
+        if indptr.ndim != 1 or len(indptr) < 2 or indptr[0] != 0 or np.any(np.diff(indptr) < 0) or \
+                indptr[-1] != len(indices) or len(indices) != len(probabilities):
+            raise ValueError("indptr must start at 0 and increase to the number of edges, "
+                             "with one index and probability per edge.")
+        n_states = len(indptr) - 1
+        if np.any(indices < 0) or np.any(indices >= n_states):
+            raise ValueError(f"The next states must run from 0 to {n_states - 1}.")
+        if np.any(indptr[1:] == indptr[:-1]):
+            raise ValueError("Every state must have at least one out-edge.")
+        if np.any(probabilities < 0) or not np.allclose(np.add.reduceat(probabilities, indptr[:-1]), 1.0):
+            raise ValueError("The out-edges of every state must have non-negative probabilities summing to 1.")
+        self._indptr = indptr
+        self._indices = indices
+        self._probabilities = probabilities
+
+    @classmethod
+    def from_edges(cls, n_states, sources, targets, probabilities):
+        """
+        Builds the transitions from an edge list.
+
+        Parameters:
+        - n_states (int): The number of states.
+        - sources, targets (array-like of int): The current and next state of each edge.
+        - probabilities (array-like of float): The probability of each edge.
+
+        Returns:
+        SparseTransitions: the transitions, with the edges of each state in the order given.
+
+        Raises ValueError if a source is out of range, or as SparseTransitions.
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        if np.any(sources < 0) or np.any(sources >= n_states):
+            raise ValueError(f"The current states must run from 0 to {n_states - 1}.")
+        order = np.argsort(sources, kind="stable")
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n_states))])
+        return cls(indptr, np.asarray(targets, dtype=np.int64)[order], np.asarray(probabilities, dtype=float)[order])
+
+    @classmethod
+    def from_adjacency(cls, adjacency):
+        """
+        Builds the transitions from adjacency lists.
+
+        Parameter:
+        adjacency (list of lists): for each state, its out-edges as (next_state, probability) pairs.
+
+        Returns:
+        SparseTransitions: the transitions.
+        """
+        edges = [(source, target, probability) for source, out_edges in enumerate(adjacency)
+                 for target, probability in out_edges]
+        sources, targets, probabilities = zip(*edges) if edges else ((), (), ())
+        return cls.from_edges(len(adjacency), sources, targets, probabilities)
+
+    @classmethod
+    def from_dense(cls, matrix):
+        """Builds the transitions from the non-zero entries of a square matrix."""
+        matrix = np.asarray(matrix, dtype=float)
+        sources, targets = np.nonzero(matrix)
+        return cls.from_edges(matrix.shape[0], sources, targets, matrix[sources, targets])
+
+    @classmethod
+    def read_csv(cls, path, n_states=None):
+        """
+        Reads an edge list from a CSV file with the header from_id,to_id,probability and one row per edge,
+        e.g. ride_transitions_edges.csv. Pairs that are not listed have probability 0.
+
+        Parameters:
+        - path (str): The CSV file.
+        - n_states (int or None): The number of states. None uses the largest id plus 1.
+
+        Returns:
+        SparseTransitions: the transitions.
+
+        Raises ValueError if the header is not from_id,to_id,probability, or as SparseTransitions.
+        """
+        with open(path, newline="") as file:
+            reader = csv.reader(file)
+            if [column.strip() for column in next(reader, [])] != ["from_id", "to_id", "probability"]:
+                raise ValueError(f"{path} must have the columns from_id, to_id and probability.")
+            rows = [row for row in reader if row]
+        sources = [int(row[0]) for row in rows]
+        targets = [int(row[1]) for row in rows]
+        if n_states is None:
+            n_states = max(sources + targets, default=-1) + 1
+        return cls.from_edges(n_states, sources, targets, [float(row[2]) for row in rows])
+
+    @property
+    def n_states(self):
+        return len(self._indptr) - 1
+
+    @property
+    def shape(self):
+        return (self.n_states, self.n_states)
+
+    @property
+    def indptr(self):
+        return self._indptr
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def probabilities(self):
+        return self._probabilities
+
+    def row(self, state):
+        """Returns the out-edges of a state as a tuple (next states, probabilities) of numpy arrays."""
+        start, end = self._indptr[state], self._indptr[state + 1]
+        return self._indices[start:end], self._probabilities[start:end]
+
+    def sources(self):
+        """Returns the current state of each edge."""
+        return np.repeat(np.arange(self.n_states), np.diff(self._indptr))
+
+    def to_dense(self):
+        """Returns the transitions as a square numpy array."""
+        matrix = np.zeros(self.shape)
+        np.add.at(matrix, (self.sources(), self._indices), self._probabilities)
+        return matrix
+
+
+
+class ArrivalSchedule:
+    """
+    A time-varying arrival rate, made of consecutive segments (e.g. the days of a season or the hours of a day).
+    The rate is constant within each segment, or given by a function bounded within each segment.
+    Arrivals are drawn by Lewis-Shedler thinning: candidates come from a Poisson process at the bound of the
+    current segment and are kept with probability rate / bound, so a piecewise-constant schedule keeps every
+    candidate and needs no extra variates. A schedule with a single segment draws the same arrivals as a
+    constant arrival rate.
+
+    Attributes:
+    - start_times (list of float): The start time of each segment, from 0 in increasing order. 
+        The last segment has no end.
+    - rates (list of float): The arrival rate of each segment, or its upper bound if there is a rate_function.
+    - labels (list or None): A label for each segment, e.g. a dictionary of the day and week it represents.
+    - rate_function (callable or None): The arrival rate at a given time, at most the rate of its segment.
+    """
+    def __init__(self, start_times, rates, labels=None, rate_function=None):
+        """
+        Parameters:
+        - start_times (list of int or float): The start time of each segment, starting at 0 and increasing.
+        - rates (list of int or float): The non-negative arrival rate (or bound) of each segment. 
+            A rate of 0 means that nobody arrives during the segment.
+        - labels (list or None): A label for each segment.
+        - rate_function (callable or None): If given, maps a time to the arrival rate at that time.
+            A park using the schedule can only be saved by ThemePark.snapshot or clone if it is a function
+            defined at module level, as lambdas and local functions cannot be pickled.
+
+        Raises ValueError if
+        - start_times is empty, does not start at 0 or is not increasing, or
+        - a rate is not a non-negative number or all rates are 0, or
+        - rates or labels do not have one element per segment, or rate_function is not callable.
+        """
+        if not len(start_times) or start_times[0] != 0:
+            raise ValueError("start_times must start at 0.")
+        if any(not isinstance(t, (int, float)) for t in start_times) or \
+                any(t >= u for t, u in zip(start_times, start_times[1:])):
+            raise ValueError("start_times must be increasing numbers.")
+        if len(rates) != len(start_times) or (labels is not None and len(labels) != len(start_times)):
+            raise ValueError("rates and labels must have one element per segment.")
+        if any(not isinstance(rate, (int, float)) or rate < 0 for rate in rates) or not any(rates):
+            raise ValueError("rates must be non-negative numbers, not all 0.")
+        if rate_function is not None and not callable(rate_function):
+            raise ValueError("rate_function must be callable.")
+        self._start_times = [float(t) for t in start_times]
+        self._rates = [float(rate) for rate in rates]
+        self._labels = list(labels) if labels is not None else None
+        self._rate_function = rate_function
+
+    @classmethod
+    def daily(cls, rates, day_length, labels=None):
+        """
+        Builds a schedule of consecutive days of equal length, each with a constant arrival rate.
+
+        Parameters:
+        - rates (list of int or float): The arrival rate of each day, e.g. the column arrival_rate of arrival_rates.csv.
+        - day_length (int or float): The length of each day. Must be positive.
+        - labels (list or None): A label for each day.
+
+        Returns:
+        ArrivalSchedule: the schedule, with day i starting at i * day_length.
+
+        Raises ValueError if day_length is not positive, or as ArrivalSchedule.
+        """
+        if not isinstance(day_length, (int, float)) or day_length <= 0:
+            raise ValueError("day_length must be a positive number.")
+        return cls([i * day_length for i in range(len(rates))], [float(rate) for rate in rates], labels)
+
+    @property
+    def start_times(self):
+        return self._start_times
+
+    @property
+    def rates(self):
+        return self._rates
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @property
+    def rate_function(self):
+        return self._rate_function
+
+    def __len__(self):
+        """Returns the number of segments."""
+        return len(self._start_times)
+
+    def segment(self, t):
+        """Returns the index of the segment containing time t."""
+        return bisect_right(self._start_times, t) - 1
+
+    def label_at(self, t):
+        """Returns the label of the segment containing time t, or None if there are no labels."""
+        return self._labels[self.segment(t)] if self._labels is not None else None
+
+    def rate_at(self, t):
+        """Returns the arrival rate at time t."""
+        if self._rate_function is not None:
+            return self._rate_function(t)
+        return self._rates[self.segment(t)]
+
+    def next_arrival(self, t, stream):
+        """
+        Draws the time of the first arrival after time t.
+
+        Parameters:
+        - t (float): The current time.
+        - stream (VariateStream): The source of the candidate gaps and of the thinning uniforms.
+
+        Returns:
+        float: the arrival time, or math.inf if nobody arrives after t.
+
+        Raises ValueError if rate_function exceeds the rate of its segment.
+        """
+        start_times, rates = self._start_times, self._rates
+        k = bisect_right(start_times, t) - 1
+        last = len(start_times) - 1
+        while True:
+            bound = rates[k]
+            t = t + stream.exponential(bound) if bound > 0 else math.inf
+            if k < last and t >= start_times[k + 1]:
+                # No candidate left in this segment: restart from the next one, as the gaps are memoryless
+                k += 1
+                t = start_times[k]
+                continue
+            if t == math.inf or self._rate_function is None:
+                return t
+            rate = self._rate_function(t)
+            if rate > bound:
+                raise ValueError(f"rate_function is {rate} at time {t}, above the bound {bound} of its segment.")
+            if stream.uniform() * bound < rate:
+                return t
+
+
+
+class SparseRouter(Router):
+    """
+    A Router for SparseTransitions: the alias table of each state only covers its out-edges,
+    so memory grows with the number of edges rather than the square of the number of states,
+    and each draw still costs O(1) and one uniform variate.
+    """
+    def __init__(self, transitions, rng=None, block_size=4096):
+        """
+        Builds the alias tables of the out-edges of every state.
+
+        Parameters:
+        - transitions (SparseTransitions): The transition probabilities, already validated.
+        - rng (numpy.random.Generator, int or None): The generator, or a seed for one, used for all draws.
+        - block_size (int): The number of uniform variates to pre-draw at a time. Must be positive.
+
+        Raises ValueError if block_size is not a positive integer.
+        """
+        if not isinstance(block_size, int) or block_size <= 0:
+            raise ValueError("block_size must be a positive integer.")
+        self._n_states = transitions.n_states
+        self._block_size = block_size
+        self._rng = np.random.default_rng(rng)
+
+        indptr = transitions.indptr
+        accept = np.ones(len(transitions.indices))
+        alias = np.arange(len(transitions.indices))  # Position of the alias edge, over all edges
+        for state in range(self._n_states):
+            start, end = indptr[state], indptr[state + 1]
+            row_accept, row_alias = self._build_alias_table(transitions.probabilities[start:end])
+            accept[start:end] = row_accept
+            alias[start:end] = start + row_alias
+        self._starts_array = indptr[:-1]
+        self._degrees_array = np.diff(indptr)
+        self._accept_array = accept
+        self._alias_array = alias
+        self._targets_array = transitions.indices
+        # Python lists index faster than numpy arrays when drawing one value at a time
+        self._starts = self._starts_array.tolist()
+        self._degrees = self._degrees_array.tolist()
+        self._accept = accept.tolist()
+        self._alias = alias.tolist()
+        self._targets = transitions.indices.tolist()
+
+        self._uniforms = []  # Pre-drawn uniform variates
+        self._position = 0
+
+    def set_rng(self, rng):
+        super().set_rng(rng)
+        self._uniforms = []
+
+    def _refill(self):
+        """Pre-draws a block of uniform variates."""
+        self._uniforms = self._rng.random(self._block_size).tolist()
+        self._position = 0
+
+    def draw(self, row):
+        """
+        Draws the next state given the current one.
+
+        Parameter:
+        row (int): The current state.
+
+        Returns:
+        int: The next state.
+        """
+        if self._position == len(self._uniforms):
+            self._refill()
+        degree = self._degrees[row]
+        scaled = self._uniforms[self._position] * degree
+        self._position += 1
+        column = int(scaled)
+        if column == degree:  # Rounding of a variate just below 1
+            column -= 1
+        edge = self._starts[row] + column
+        if scaled - column < self._accept[edge]:
+            return self._targets[edge]
+        return self._targets[self._alias[edge]]
+
+    def draw_many(self, rows):
+        """
+        Draws the next state for many current states at once.
+
+        Parameter:
+        rows (int or array-like of int): The current states.
+
+        Returns:
+        numpy.ndarray: The next state for each element of rows.
+        """
+        rows = np.asarray(rows)
+        degrees = self._degrees_array[rows]
+        scaled = self._rng.random(rows.shape) * degrees
+        columns = np.minimum(scaled.astype(np.int64), degrees - 1)
+        edges = self._starts_array[rows] + columns
+        keep = (scaled - columns) < self._accept_array[edges]
+        return self._targets_array[np.where(keep, edges, self._alias_array[edges])]
+
+
+
+class SimulationStats:
+    """
+    Counters and timers collected by ThemePark.simulate(profile=True).
+    Timers use time.perf_counter. The time of an event type includes the calendar pushes and 
+    routing done while handling it, which are also reported separately.
+
+    Attributes:
+    - event_counts (dict): The number of events of each type ('arrival' and 'ride').
+    - event_times (dict): The cumulative seconds spent handling each event type.
+    - calendar_time (float): The cumulative seconds spent pushing and popping events.
+    - routing_time (float): The cumulative seconds spent routing customers.
+    - routing_draws (int): The number of routing decisions.
+    - calendar_high_water (int): The largest number of events scheduled at once.
+    - wall_time (float): The seconds from the start to the end of the simulation.
+    - events_per_second (float): The number of events processed per second of wall_time.
+    """
+    def __init__(self):
+        self.event_counts = {"arrival": 0, "ride": 0}
+        self.event_times = {"arrival": 0.0, "ride": 0.0}
+        self.calendar_time = 0.0
+        self.routing_time = 0.0
+        self.routing_draws = 0
+        self.calendar_high_water = 0
+        self.wall_time = 0.0
+        self._start = time.perf_counter()
+
+    @property
+    def events_per_second(self):
+        n_events = sum(self.event_counts.values())
+        return n_events / self.wall_time if self.wall_time else 0.0
+
+    def instrument(self, park, pop):
+        """
+        Replaces the park's per-run push and route functions by timed versions.
+
+        Parameters:
+        - park (ThemePark): The park being simulated.
+        - pop (callable): The function popping the next event.
+
+        Returns:
+        tuple (pop, handle_arrival, handle_ride) of timed versions of pop and of the park's event handlers.
+        """
+        clock = time.perf_counter
+        push, route = park._push, park._route
+        event_queue = park.event_queue
+        handle_arrival, handle_ride = park._handle_arrival, park._handle_ride
+
+        def timed_push(event_time, ride_id):
+            start = clock()
+            push(event_time, ride_id)
+            self.calendar_time += clock() - start
+            if len(event_queue) > self.calendar_high_water:
+                self.calendar_high_water = len(event_queue)
+
+        def timed_pop():
+            start = clock()
+            event = pop()
+            self.calendar_time += clock() - start
+            return event
+
+        def timed_route(ride_id):
+            start = clock()
+            next_ride_id = route(ride_id)
+            self.routing_time += clock() - start
+            self.routing_draws += 1
+            return next_ride_id
+
+        def timed_arrival(current_time):
+            start = clock()
+            handle_arrival(current_time)
+            self.event_times["arrival"] += clock() - start
+            self.event_counts["arrival"] += 1
+
+        def timed_ride(current_time, ride_id):
+            start = clock()
+            handle_ride(current_time, ride_id)
+            self.event_times["ride"] += clock() - start
+            self.event_counts["ride"] += 1
+
+        park._push, park._route = timed_push, timed_route
+        return timed_pop, timed_arrival, timed_ride
+
+    def stop(self):
+        """Records the wall time since the stats were created."""
+        self.wall_time = time.perf_counter() - self._start
+
+    def to_dict(self):
+        """Returns the stats as a dictionary of plain numbers, e.g. to dump to JSON."""
+        return {"event_counts": dict(self.event_counts),
+                "event_times": dict(self.event_times),
+                "calendar_time": self.calendar_time,
+                "routing_time": self.routing_time,
+                "routing_draws": self.routing_draws,
+                "calendar_high_water": self.calendar_high_water,
+                "wall_time": self.wall_time,
+                "events_per_second": self.events_per_second}
+
+
+
 class ThemePark:
     """
     Represents the theme park simulation.
 
     Attributes:
     - rides (list): an ordered collection of Ride instances in increasing order of ride_id.
-    - arrival_rate (float): The rate at which customers arrive at the park. Must be positive.
+    - arrival_rate (float or ArrivalSchedule): The rate at which customers arrive at the park. Must be positive.
         Assumes customers arrive according to a Poisson process with rate arrival_rate.
         The time until the next customer arrival is exponentially distributed with mean 1/arrival_rate.
-    - transition_matrix (numpy.ndarray): Square matrix representing ride transition probabilities.
+        With an ArrivalSchedule, the Poisson process is non-homogeneous, e.g. to run a whole season at once.
+    - transition_matrix (numpy.ndarray or SparseTransitions): Square matrix representing ride transition probabilities.
+    - router (Router): Draws the next ride of each customer from transition_matrix.
     - event_queue (PriorityQueue): Queue managing simulation events.
     - customers (list): List of all customers in the simulation.
+    - trip_log (TripLog): The rides taken by all customers, in the order they started.
+    - stats (SimulationStats or None): Counters and timers of the last simulation run with profile=True.
+    - current_time (float or None): The time reached by the last run, None before the first run.
     """
 
-    def __init__(self, rides, arrival_rate, transition_matrix):
+    def __init__(self, rides, arrival_rate, transition_matrix, rng=None):
         """
         Initialises the theme park with rides, arrival rate, and a transition matrix.
 
         Parameters:
         - rides (list of Ride): an ordered collection of Ride instances in increasing order of ride_id.
-        - arrival_rate (int or float): The rate at which customers arrive at the park. Must be positive.
-        - transition_matrix (numpy.ndarray): Square matrix representing ride transition probabilities.
+        - arrival_rate (int, float or ArrivalSchedule): The rate at which customers arrive at the park. 
+            Must be positive.
+        - transition_matrix (numpy.ndarray or SparseTransitions): Square matrix representing ride transition 
+            probabilities. SparseTransitions suits large parks where each state only leads to a few others.
+        - rng (numpy.random.Generator, int, numpy.random.SeedSequence or None): The source of all randomness.
+            It is split into independent streams for the arrivals, the routing and the ride times of each ride
+            (which replace the rides' own streams), so that one seed reproduces the whole run and parks with
+            the same seed share common random numbers. If None, the rides keep their own streams and
+            the other streams are seeded from fresh entropy.
 
-        Raises ValueError if arrival_rate is not positive or transition_matrix is not a square numpy array.
+        Raises ValueError if 
+        - the ride_ids are not unique and contiguous from 1 to the number of rides, or
+        - arrival_rate is not positive or transition_matrix is not a square numpy array or SparseTransitions, or
+        - a row of transition_matrix is not a probability distribution.
         """
         self._rides = rides
-        if not isinstance(arrival_rate, (int, float)) or arrival_rate <= 0:
-            raise ValueError("arrival_rate must be a positive number.")
-        self._arrival_rate = float(arrival_rate)
-        if not isinstance(transition_matrix, np.ndarray) or transition_matrix.shape[0] != transition_matrix.shape[1]:
-            raise ValueError("transition_matrix must be a square numpy array.")
+        self._ride_lookup = self._build_ride_lookup(rides)
+        if isinstance(arrival_rate, ArrivalSchedule):
+            self._arrival_rate = self._arrival_schedule = arrival_rate
+        elif not isinstance(arrival_rate, (int, float)) or arrival_rate <= 0:
+            raise ValueError("arrival_rate must be a positive number or an ArrivalSchedule.")
+        else:
+            self._arrival_rate = float(arrival_rate)
+            self._arrival_schedule = None
+        if isinstance(transition_matrix, SparseTransitions):
+            self._router = SparseRouter(transition_matrix)
+        elif not isinstance(transition_matrix, np.ndarray) or transition_matrix.ndim != 2 or \
+                transition_matrix.shape[0] != transition_matrix.shape[1]:
+            raise ValueError("transition_matrix must be a square numpy array or SparseTransitions.")
+        else:
+            self._router = Router(transition_matrix)
         self._transition_matrix = transition_matrix
+        self._arrival_stream = VariateStream()
+        if rng is not None:
+            self.set_rng(rng)
         self._event_queue = PriorityQueue()
         self._customers = []
+        self._trip_log = TripLog()
+        self._compact_at = 4096  # The size of the trip log at which the trips of customers who have left are dropped
+        self._stats = None
+        self._current_time = None  # The time reached by the last run, None before the first run
+        self._next_customer_id = 1
+
+    @staticmethod
+    def _build_ride_lookup(rides):
+        """
+        Builds a dense list indexed by ride_id so that each event finds its ride in O(1).
+        Index 0 (new customer arrival) holds None.
+
+        Parameter:
+        rides (list of Ride): the rides of the park.
+
+        Returns:
+        list: the lookup list, where lookup[ride_id] is the Ride with that ride_id.
+
+        Raises ValueError if the ride_ids are not unique and contiguous from 1 to len(rides).
+        """
+        lookup = [None] * (len(rides) + 1)
+        for ride in rides:
+            ride_id = ride.ride_id
+            if not 1 <= ride_id <= len(rides):
+                raise ValueError(f"ride_id {ride_id} is out of range: ride_ids must run from 1 to {len(rides)}.")
+            if lookup[ride_id] is not None:
+                raise ValueError(f"ride_id {ride_id} is used by more than one ride.")
+            lookup[ride_id] = ride
+        return lookup
 
     @property
     def rides(self):
@@ -311,10 +1477,18 @@ class ThemePark:
     def arrival_rate(self):
         return self._arrival_rate
 
+    @property
+    def arrival_schedule(self):
+        return self._arrival_schedule
+
     @property
     def transition_matrix(self):
         return self._transition_matrix
 
+    @property
+    def router(self):
+        return self._router
+
     @property
     def event_queue(self):
         return self._event_queue
@@ -323,10 +1497,100 @@ class ThemePark:
     def customers(self):
         return self._customers
 
+    @property
+    def trip_log(self):
+        return self._trip_log
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def current_time(self):
+        return self._current_time
+
+    def set_rng(self, rng):
+        """
+        Replaces every source of randomness of the park by independent streams split from rng,
+        spawned in a fixed order: arrivals, routing, then the ride times of each ride by ride_id.
+
+        Parameter:
+        rng (numpy.random.Generator, int or numpy.random.SeedSequence): The generator, or a seed for one.
+        """
+        arrival_rng, routing_rng, *service_rngs = np.random.default_rng(rng).spawn(2 + len(self._rides))
+        self._arrival_stream = VariateStream(arrival_rng)
+        self._router.set_rng(routing_rng)
+        for ride, service_rng in zip(self._ride_lookup[1:], service_rngs):
+            ride.set_rng(service_rng)
+
+    def __getstate__(self):
+        # Leave out the state of a run in progress, e.g. the sink, which may not be picklable
+        transient = ("_max_time", "_trace", "_sink", "_finished", "_released", "_to_sink", "_num_rides", "_push", "_route",
+                     "_new_customer", "_carry", "_record")
+        return {name: value for name, value in self.__dict__.items() if name not in transient}
+
+    def snapshot(self):
+        """
+        Saves the full state of the park: the event calendar, the ride queues with their entry times,
+        the customers and their rides, the clock, the counters and the state of every random stream.
+        A park warmed up once can then be restored many times, e.g. to start replications in steady state.
+
+        Returns:
+        bytes: the compressed snapshot, to pass to ThemePark.restore. Only restore snapshots you trust,
+        as they are unpickled.
+
+        Raises ValueError if the park holds an object that cannot be pickled, e.g. an ArrivalSchedule whose
+        rate_function is a lambda or a local function: the rate function must be defined at module level.
+        """
+        try:
+            state = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, AttributeError, TypeError) as error:
+            rate_function = getattr(self._arrival_rate, "rate_function", None)
+            if rate_function is not None:
+                raise ValueError(f"The park cannot be saved, as the rate_function {rate_function!r} of its "
+                                 f"ArrivalSchedule cannot be pickled: define it at module level, not as a lambda "
+                                 f"or a local function.") from error
+            raise ValueError(f"The park cannot be saved, as it holds an object that cannot be pickled: "
+                             f"{error}") from error
+        return zlib.compress(state)
+
+    @staticmethod
+    def restore(snapshot):
+        """
+        Rebuilds a park from a snapshot. It continues exactly as the saved park would have.
+
+        Parameter:
+        snapshot (bytes): The output of ThemePark.snapshot.
+
+        Returns:
+        ThemePark: an independent copy of the saved park, with its own rides and customers.
+        """
+        return pickle.loads(zlib.decompress(snapshot))
+
+    def clone(self, rng=None):
+        """
+        Returns an independent copy of the park in its current state.
+
+        Parameter:
+        rng (numpy.random.Generator, int, numpy.random.SeedSequence or None): If given, the copy's random
+            streams are replaced as by set_rng, so that clones of one warmed-up park continue as different
+            replications. If None, the copy draws the same variates as the park.
+
+        Returns:
+        ThemePark: the copy.
+
+        Raises ValueError if the park cannot be saved by snapshot.
+        """
+        park = ThemePark.restore(self.snapshot())
+        if rng is not None:
+            park.set_rng(rng)
+        return park
+
     def route_customer(self, ride_id):
         """
         Generates the next ride's ID probabilistically based on the transition matrix. 
-        With replacement, randomly selects the next ride based on the probabilities given the current ride_id.
+        With replacement, randomly selects the next ride based on the probabilities given the current ride_id,
+        using the alias tables precomputed by the park's Router.
         
         Parameters:
         ride_id (int): The ID of the current ride (1-based index), or 0 for a customer entrance.
@@ -334,81 +1598,327 @@ class ThemePark:
         Returns:
         int: The ID of the next ride, or the exit indicator.
         """
-        row = self._transition_matrix[ride_id] # List of transition probabilities given the current ride
-        dim = len(row)   # Length of the ride indices
-        next_ride_id = np.random.choice(a=range(dim), replace=True, p=row)
-        return int(next_ride_id)
+        return self._router.draw(ride_id)
+
+    def analyze(self):
+        """
+        Computes steady-state estimates without simulating, by treating the park as an open Jackson network:
+        Poisson arrivals, exponential ride times, Markov routing and, as in simulate, no limit on the number
+        of customers on a ride. simulate boards a customer at every queue entry time, so as many customers have
+        boarded as have joined at any time and each ride is an infinite-server (M/M/inf) queue, which is never
+        unstable. The boarding times are the queue entry times in another order, so the delays between joining
+        and boarding average 0; a customer who boards before their own entry time is recorded with a wait of 0,
+        which is why the mean of Customer.wait_times is positive.
+        The effective arrival rate of each ride solves the traffic equations 
+            rate = arrival_rate * (row 0 of transition_matrix) + (ride submatrix of transition_matrix)^T @ rate.
 
-    def simulate(self, max_time, verbose=False):
+        Returns:
+        dict with the keys:
+        - 'ride_id' (numpy.ndarray): The ride_ids, in increasing order.
+        - 'arrival_rate' (numpy.ndarray): The effective arrival rate of each ride.
+        - 'utilization' (numpy.ndarray): rho, the arrival rate divided by the ride rate, i.e. the offered load,
+            which may exceed 1.
+        - 'mean_number_in_system' (numpy.ndarray): L = rho, the mean number of customers riding.
+        - 'mean_queue_length' (numpy.ndarray): Lq = 0, the mean number of customers who have joined but not boarded, 
+            less those who have boarded before joining.
+        - 'mean_time_in_system' (numpy.ndarray): W = 1 / ride_rate, the mean time from joining the queue to finishing
+            the ride.
+        - 'mean_wait' (numpy.ndarray): Wq = 0, the mean delay between joining the queue and boarding.
+        - 'rides_per_guest' (float): The expected number of rides taken by a customer.
+
+        Raises ValueError if 
+        - the arrival rate is an ArrivalSchedule, which has no steady state, or
+        - customers can never leave the park, so the traffic equations have no solution.
+        """
+        if self._arrival_schedule is not None:
+            raise ValueError("analyze needs a constant arrival rate, not an ArrivalSchedule.")
+        num_rides = len(self._rides)
+        if isinstance(self._transition_matrix, SparseTransitions):
+            arrival_rates = self._sparse_traffic_rates(num_rides)
+        else:
+            routing = self._transition_matrix[1:num_rides + 1, 1:num_rides + 1]
+            external_rates = self._arrival_rate * self._transition_matrix[0, 1:num_rides + 1]
+            try:
+                arrival_rates = np.linalg.solve(np.eye(num_rides) - routing.T, external_rates)
+            except np.linalg.LinAlgError:
+                raise ValueError("The traffic equations have no solution: customers can never leave the park.")
+
+        ride_rates = np.array([ride.ride_rate for ride in self._ride_lookup[1:]], dtype=float)
+        utilization = arrival_rates / ride_rates
+        return {"ride_id": np.arange(1, num_rides + 1),
+                "arrival_rate": arrival_rates,
+                "utilization": utilization,
+                "mean_number_in_system": utilization,
+                "mean_queue_length": np.zeros(num_rides),
+                "mean_time_in_system": 1 / ride_rates,
+                "mean_wait": np.zeros(num_rides),
+                "rides_per_guest": float(arrival_rates.sum() / self._arrival_rate)}
+
+    def ride_stats(self):
+        """
+        Returns the time-weighted statistics of every ride, updated by the rides at each boarding and queue change 
+        during the simulation, from the start of the last run that did not resume to the time it reached.
+
+        Returns:
+        dict of numpy.ndarray, one element per ride in increasing order of ride_id, with the keys 'ride_id' and
+        those of Ride.summary: 'n_served', 'throughput', 'mean_queue_length', 'max_queue_length', 'mean_busy'
+        and 'utilization'. Unlike those of analyze, the queue lengths count the customers routed to a ride who
+        are still finishing their previous ride.
+
+        Raises ValueError if the park has not been simulated yet.
+        """
+        if self._current_time is None:
+            raise ValueError("The park has not been simulated yet.")
+        summaries = [ride.summary(self._current_time) for ride in self._ride_lookup[1:]]
+        stats = {"ride_id": np.arange(1, len(summaries) + 1)}
+        for key in summaries[0]:
+            stats[key] = np.array([summary[key] for summary in summaries])
+        return stats
+
+    def _sparse_traffic_rates(self, num_rides, tolerance=1e-12, max_iterations=100000):
+        """
+        Solves the traffic equations of SparseTransitions by fixed-point iteration, 
+        each step costing O(number of edges) instead of a dense solve in O(num_rides ** 3).
+        Raises ValueError if the iteration does not converge, e.g. because customers can never leave the park.
+        """
+        transitions = self._transition_matrix
+        sources, targets, probabilities = transitions.sources(), transitions.indices, transitions.probabilities
+        to_ride = (targets >= 1) & (targets <= num_rides)
+        entering = (sources == 0) & to_ride
+        external_rates = np.bincount(targets[entering] - 1, weights=self._arrival_rate * probabilities[entering],
+                                     minlength=num_rides)
+        between = (sources >= 1) & (sources <= num_rides) & to_ride
+        from_rides, to_rides, weights = sources[between] - 1, targets[between] - 1, probabilities[between]
+        rates = external_rates
+        for _ in range(max_iterations):
+            new_rates = external_rates + np.bincount(to_rides, weights=rates[from_rides] * weights, minlength=num_rides)
+            if np.all(np.abs(new_rates - rates) <= tolerance * np.maximum(1.0, new_rates)):
+                return new_rates
+            rates = new_rates
+        raise ValueError("The traffic equations have no solution: customers can never leave the park.")
+
+    def _finish_customer(self, customer):
+        """
+        Passes a customer who has left the park to the sink, once every customer who arrived 
+        before them has been passed on too, so that the sink receives customers in order of customer_id.
+        """
+        self._finished[customer.customer_id] = customer
+        to_sink = self._to_sink
+        while to_sink and to_sink[0] in self._finished:
+            self._sink(self._release(self._finished.pop(to_sink.popleft())))
+
+    def _release(self, customer):
+        """
+        Returns a customer who has left the park, to be passed to the sink. Their trips stay in the shared
+        trip log until it is next compacted, once it has doubled in size since the last time.
+        """
+        self._released.append(weakref.ref(customer))
+        if len(self._trip_log) > self._compact_at:
+            self._compact_trip_log()
+        return customer
+
+    def _detach_released(self):
+        """Moves the trips of the customers passed to the sink that are still in use to logs of their own."""
+        for reference in self._released:
+            customer = reference()
+            if customer is not None:
+                customer._detach()
+        self._released.clear()
+
+    def _compact_trip_log(self):
+        """
+        Drops the trips of the customers who have left the park from the shared trip log, so that its size
+        does not grow with the number of customers passed to the sink.
+        """
+        self._detach_released()
+        # Everyone else is in the customers list, in a ride queue or waits for earlier customers to reach the sink
+        customers = self._customers + [c for ride in self._rides for c, _ in ride] + list(self._finished.values())
+        last_trips = self._trip_log.compact([c._last_trip for c in customers])
+        for c, last_trip in zip(customers, last_trips):
+            c._last_trip = last_trip
+        self._compact_at = max(4096, 2 * len(self._trip_log))
+
+    def _handle_arrival(self, current_time):
+        """Processes the arrival of a new customer at current_time and schedules the next arrival."""
+        arrival_time = current_time
+        c = self._new_customer(self._next_customer_id, arrival_time, self._trip_log)
+        if self._sink is None:
+            self._customers.append(c) 
+        else:
+            self._to_sink.append(c.customer_id)
+
+        # Route them to the next event (ride or exit)
+        next_ride_id = self._route(0)
+        if 0 < next_ride_id <= self._num_rides:  # If they are not exiting
+            self._ride_lookup[next_ride_id]._join(c, arrival_time, arrival_time)
+            # Schedule an event for this ride
+            self._push(arrival_time, next_ride_id)
+        elif self._sink is not None:
+            self._finish_customer(c)
+        
+        if self._trace is not None:
+            if 0 < next_ride_id <= self._num_rides:
+                self._trace.record(arrival_time, TRACE_ARRIVAL, c.customer_id, next_ride_id, 
+                                   len(self._ride_lookup[next_ride_id]), 0.0)
+            else:
+                self._trace.record(arrival_time, TRACE_ARRIVAL, c.customer_id, 0, 0, 0.0)
+
+        # Schedule the next customer arrival event (then sorted by the priority queue)
+        self._next_customer_id += 1 
+        if self._arrival_schedule is None:
+            next_arrival_time = current_time + self._arrival_stream.exponential(self._arrival_rate)
+        else:
+            next_arrival_time = self._arrival_schedule.next_arrival(current_time, self._arrival_stream)
+            if next_arrival_time == math.inf:  # Nobody arrives any more
+                return
+        self._push(next_arrival_time, 0)
+
+    def _handle_ride(self, current_time, ride_id):
+        """Processes the customer at the front of the queue of ride ride_id boarding at current_time."""
+        ride = self._ride_lookup[ride_id]
+        c, queue_entry_time, completion_time = self._carry(ride, current_time)
+        # The wait and ride times are derived from these times when they are read
+        self._record(c, ride_id, queue_entry_time, current_time, completion_time)
+
+        # Route the customer to a next ride or exit
+        next_ride_id = self._route(ride_id)
+        if 0 < next_ride_id <= self._num_rides: 
+            next_ride = self._ride_lookup[next_ride_id]
+            # Check if the ride can be completed within the remaining time
+            expected_ride_time = next_ride.sample_ride_time()
+            if completion_time + expected_ride_time <= self._max_time:
+                next_ride._join(c, completion_time, current_time)
+                self._push(completion_time, next_ride_id)
+            else:
+                if self._trace is not None:
+                    self._trace.record(completion_time, TRACE_REJECTED, c.customer_id, next_ride_id, len(next_ride), 0.0)
+                if self._sink is not None:
+                    self._finish_customer(c)
+        elif self._sink is not None:
+            self._finish_customer(c)
+            
+        if self._trace is not None:
+            wait_time = current_time - queue_entry_time if current_time >= queue_entry_time else 0.0
+            self._trace.record(completion_time, TRACE_RIDE, c.customer_id, ride_id, len(ride), wait_time)
+
+    def simulate(self, max_time, verbose=False, sink=None, profile=False, resume=False, trace=None, validate=False):
         """
         Performs a simulation of the theme park events for a given duration (max_time).
 
         Parameters:
         - max_time (float): The maximum simulation time. The simulation stops when current_time exceeds max_time.
-        - verbose (bool): If True, prints a log whenever a customer entered or is processed by a ride. False by default (no logs).
+        - verbose (bool): If True, prints a log of every customer arrival, completed ride and ride refused for lack of time, 
+            formatted from the trace once the run is over. False by default (no logs).
+        - sink (callable or None): If given, it is called with each Customer once they have left the park, 
+            and with the customers still in the park when the simulation ends, in order of customer_id. 
+            The customers are then not kept in the customers list, and the rides of those who have left are 
+            dropped from trip_log whenever it doubles in size (a customer still referenced elsewhere, e.g. by the
+            sink, keeps them in a log of their own), so the memory used does not grow with the number of 
+            customers who have left. None by default (customers are kept).
+        - profile (bool): If True, counts and times the work done per event type, the event calendar and 
+            the routing into the stats attribute. False by default, which adds no cost to the simulation.
+        - resume (bool): If True, continues the last run (or the run of a restored snapshot) from where it
+            stopped, with its calendar, queues and customers, until the new max_time. Customers turned away 
+            because their next ride would have ended after the earlier max_time stay gone, and customers still 
+            in the park at the end of a run are passed to the sink of that run and again to the sink of the run
+            that resumes it. False by default (a new day starting at time 0).
+        - trace (TraceRecorder or None): If given, records each arrival, completed ride (at its completion time)
+            and refused ride as a binary record. None by default (no trace, unless verbose is True).
+        - validate (bool): If True, every event goes through the validating public methods (PriorityQueue.push,
+            Customer(), Ride.carry_customer and Customer.record_trip), e.g. to debug changes to the simulation. False by default: 
+            the arguments are checked once here and the values generated internally are trusted, which is faster.
+            Both give the same run.
+
+        Raises ValueError if 
+        - max_time is not a non-negative number, sink is not callable or trace is not a TraceRecorder, or
+        - resume is True but the park has not been simulated yet.
         """
-        num_rides = len(self._rides)
-        current_time = 0  # Initialise the simulation time
-        
-        # Generate the first customer arrival and schedule this event in the priority queue
-        customer_id = 1
-        t = random.expovariate(self._arrival_rate)  
-        self._event_queue.push(event_time=t, ride_id=0)
-
-        # Continue processing the events until time exceeds the maximum or the event queue is empty
-        while self._event_queue.queue and current_time < max_time: 
-            current_time, ride_id = self._event_queue.popleft()  # Get the next event
-
-            if int(ride_id) == 0:  # Event being a new customer arrival
-                # Process their arrival
-                arrival_time = current_time
-                c = Customer(customer_id, arrival_time)
-                self._customers.append(c) 
-
-                # Route them to the next event (ride or exit)
-                next_ride_id = self.route_customer(ride_id)
-                if next_ride_id <= num_rides:  # If they are not exiting
-                    for ride in self._rides:
-                        if ride.ride_id == next_ride_id:
-                            ride.append((c, arrival_time))
-                    # Schedule an event for this ride
-                    self._event_queue.push(arrival_time, next_ride_id)
-                
-                if verbose:
-                    print(f"Customer {c.customer_id} arrived at time {arrival_time}.")
-
-                # Schedule the next customer arrival event (then sorted by the priority queue)
-                customer_id += 1 
-                next_arrival_time = current_time + random.expovariate(self._arrival_rate)
-                self._event_queue.push(next_arrival_time, ride_id=0)
-
-            else:  # Event being a customer completing a ride
-                for ride in self._rides:
-                    if ride.ride_id == int(ride_id):
-                        c, completion_time = ride.carry_customer(current_time)
-                        queue_entry_time = ride.get_queue_entry_time(c.customer_id)
-                        if current_time < queue_entry_time:  # Customer arrived and immediately boarded the ride
-                            wait_time = 0
-                        else: # Customer waited in the queue
-                            wait_time = current_time - queue_entry_time
-                        c.record_ride(ride_id, completion_time - current_time, wait_time)
-
-                        # Route the customer to a next ride or exit
-                        next_ride_id = self.route_customer(ride_id)
-                        if next_ride_id <= num_rides: 
-                            for next_ride in self._rides:
-                                if next_ride.ride_id == next_ride_id:
-                                    # Check if the ride can be completed within the remaining time
-                                    expected_ride_time = random.expovariate(next_ride.ride_rate)
-                                    if completion_time + expected_ride_time <= max_time:
-                                        next_ride.append((c, completion_time))
-                                        self._event_queue.push(completion_time, next_ride_id)
-                                    else:
-                                        if verbose:
-                                            print(f"Customer {c.customer_id} cannot start {next_ride.ride_name} due to insufficient remaining time.")
-                            
-                        if verbose:
-                            print(f"Customer {c.customer_id} completed {ride.ride_name} at time {completion_time}.")
+        if not isinstance(max_time, (int, float)) or max_time < 0:
+            raise ValueError("max_time must be a non-negative number.")
+        if sink is not None and not callable(sink):
+            raise ValueError("sink must be callable.")
+        if trace is not None and not isinstance(trace, TraceRecorder):
+            raise ValueError("trace must be a TraceRecorder.")
+        if resume and self._current_time is None:
+            raise ValueError("There is no run to resume: the park has not been simulated yet.")
+        self._max_time = max_time
+        if verbose and trace is None:
+            trace = TraceRecorder(ring=False)
+        first_record = trace.n_recorded if trace is not None else 0
+        self._trace = trace
+        self._sink = sink
+        if sink is not None:
+            self._finished = {}  # Customers who have left but wait for earlier customers to reach the sink
+            self._released = []  # Weak references to the customers passed to the sink
+            # The customer_ids owed to the sink, in order: when resuming, those still in the park
+            self._to_sink = deque(sorted(c.customer_id for ride in self._rides for c, _ in ride) if resume else ())
+        self._num_rides = len(self._rides)
+        if resume:
+            current_time = self._current_time
+        else:
+            self._next_customer_id = 1
+            current_time = 0  # Initialise the simulation time
+            for ride in self._rides:
+                ride.reset_stats()
+
+        event_queue = self._event_queue
+        if validate:
+            self._push, self._new_customer, self._carry = event_queue.push, Customer, Ride._carry_validated
+            self._record = Customer.record_trip
+        else:
+            self._push, self._new_customer, self._carry = event_queue._push_trusted, Customer._trusted, Ride._carry_trusted
+            self._record = Customer._record_trip
+        self._route = self._router.draw
+        handle_arrival = self._handle_arrival
+        handle_ride = self._handle_ride
+        if profile:
+            self._stats = SimulationStats()
+            pop, handle_arrival, handle_ride = self._stats.instrument(self, event_queue.popleft)
+        else:
+            pop = event_queue.popleft
+
+        try:
+            if not resume:
+                # Generate the first customer arrival and schedule this event in the priority queue
+                if self._arrival_schedule is None:
+                    t = self._arrival_stream.exponential(self._arrival_rate)
+                else:
+                    t = self._arrival_schedule.next_arrival(0.0, self._arrival_stream)
+                if t != math.inf:
+                    self._push(t, 0)
+
+            # Continue processing the events until time exceeds the maximum or the event queue is empty
+            while event_queue and current_time < max_time: 
+                current_time, ride_id = pop()  # Get the next event
+                if ride_id == 0:  # Event being a new customer arrival
+                    handle_arrival(current_time)
+                else:  # Event being a customer boarding a ride
+                    handle_ride(current_time, ride_id)
+        finally:
+            self._current_time = current_time
+            if profile:
+                self._stats.stop()
+            # Drop the per-run functions, which may be timing wrappers
+            del self._push, self._route, self._new_customer, self._carry, self._record
+            self._trace = None
+
+        if verbose:
+            ride_names = {ride.ride_id: ride.ride_name for ride in self._rides}
+            records = trace.to_numpy()
+            for line in format_trace(records[max(0, len(records) - (trace.n_recorded - first_record)):], ride_names):
+                print(line)
+
+        if sink is not None:
+            # The day is over: pass on the customers still queueing, in order of customer_id, 
+            # keeping their rides in the trip log as a resumed run continues them
+            in_park = {c.customer_id: c for ride in self._rides for c, _ in ride}
+            for next_id in sorted(self._finished.keys() | in_park.keys()):
+                if next_id in self._finished:
+                    sink(self._release(self._finished.pop(next_id)))
+                else:
+                    sink(in_park[next_id])
+            self._to_sink.clear()
+            self._detach_released()  # The trip log may be compacted by a later run
 
     def __str__(self):
         """
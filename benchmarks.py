@@ -0,0 +1,452 @@
+import argparse
+import json
+import math
+import multiprocessing
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from Themepark_classes import Customer, PriorityQueue, Ride, Router, ThemePark, TripLog
+from themepark_batch import BatchThemePark
+from themepark_loader import parse_park_model
+import numpy as np
+
+BASELINE_PATH = "benchmark_baselines.json"
+
+
+class SortedListPriorityQueue:
+    """
+    The original event calendar, kept for comparison: appends the event and re-sorts
+    the whole list on every push, and pops from the front of the list.
+    """
+    def __init__(self):
+        self._queue = []
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def push(self, event_time, ride_id):
+        self._queue.append((float(event_time), ride_id))
+        self._queue.sort(key=lambda event: event[0])
+
+    def popleft(self):
+        return self._queue.pop(0)
+
+
+class ListCustomer:
+    """
+    The original customer record, kept for comparison: a regular object holding three growing lists.
+    """
+    def __init__(self, customer_id, arrival_time):
+        self._customer_id = customer_id
+        self._arrival_time = float(arrival_time)
+        self._path = []
+        self._ride_times = []
+        self._wait_times = []
+
+    def record_ride(self, ride_id, ride_time, wait_time):
+        self._path.append(ride_id)
+        self._ride_times.append(float(ride_time))
+        self._wait_times.append(float(wait_time))
+
+
+def bench_event_calendar(queue_class, calendar_size, n_events=20000, seed=0):
+    """
+    Measures events per second of a calendar using the hold model: the calendar is filled with
+    calendar_size events, then each event popped schedules a new one a random time later.
+
+    Parameters:
+    - queue_class (type): PriorityQueue or SortedListPriorityQueue.
+    - calendar_size (int): Number of events kept in the calendar.
+    - n_events (int): Number of pop/push pairs to time.
+    - seed (int): Seed for the event time increments.
+
+    Returns:
+    float: events processed per second.
+    """
+    rng = np.random.default_rng(seed)
+    increments = rng.exponential(1.0, size=calendar_size + n_events).tolist()
+    queue = queue_class()
+    for i in range(calendar_size):
+        queue.push(increments[i], i % 4)
+
+    start = time.perf_counter()
+    for i in range(calendar_size, calendar_size + n_events):
+        event_time, ride_id = queue.popleft()
+        queue.push(event_time + increments[i], ride_id)
+    elapsed = time.perf_counter() - start
+    return n_events / elapsed
+
+
+def run_event_calendar_benchmark(sizes=(10, 100, 1000, 10000)):
+    """Prints events per second against calendar size for the old and new event calendars."""
+    print(f"{'calendar size':>14} {'sorted list (ev/s)':>20} {'heap (ev/s)':>14} {'speed-up':>9}")
+    for size in sizes:
+        # Fewer events for the sorted list at large sizes, as each event costs O(n log n)
+        n_events = max(200, min(20000, 2000000 // size))
+        old = bench_event_calendar(SortedListPriorityQueue, size, n_events)
+        new = bench_event_calendar(PriorityQueue, size, n_events)
+        print(f"{size:>14} {old:>20,.0f} {new:>14,.0f} {new / old:>8.1f}x")
+
+
+def make_synthetic_park(n_rides, arrival_rate, seed=0, exit_probability=0.2):
+    """
+    Builds a random park with n_rides rides for benchmarking.
+
+    Parameters:
+    - n_rides (int): Number of rides.
+    - arrival_rate (float): Customer arrival rate of the park.
+    - seed (int): Seed for the service rates, transition probabilities and routing.
+    - exit_probability (float): Probability of leaving the park after each ride.
+
+    Returns:
+    ThemePark: a park with ride_ids 1..n_rides and an (n_rides + 2) square transition matrix.
+    """
+    rng = np.random.default_rng(seed)
+    rides = [Ride(ride_id, f"Ride {ride_id}", float(rate))
+             for ride_id, rate in enumerate(rng.uniform(0.5, 1.5, size=n_rides), start=1)]
+
+    transition_matrix = np.zeros((n_rides + 2, n_rides + 2))
+    transition_matrix[0, 1:n_rides + 1] = rng.dirichlet(np.ones(n_rides))  # From Arrival
+    for ride_id in range(1, n_rides + 1):
+        transition_matrix[ride_id, 1:n_rides + 1] = (1 - exit_probability) * rng.dirichlet(np.ones(n_rides))
+        transition_matrix[ride_id, n_rides + 1] = exit_probability
+    transition_matrix[n_rides + 1, n_rides + 1] = 1.0  # From Exit: just to make it square
+    return ThemePark(rides, arrival_rate, transition_matrix, rng=seed)
+
+
+def count_events(park):
+    """Returns the number of events a finished simulation processed: one per arrival and one per ride taken."""
+    return len(park.customers) + sum(ride.customers_processed for ride in park.rides)
+
+
+def run_ride_scaling_benchmark(ride_counts=(3, 10, 50, 200), max_time=200, arrival_rate=5.0, seed=0):
+    """Prints events per second of ThemePark.simulate against the number of rides in the park."""
+    print(f"{'rides':>6} {'events':>8} {'events/s':>10} {'us/event':>9}")
+    for n_rides in ride_counts:
+        park = make_synthetic_park(n_rides, arrival_rate, seed)
+        start = time.perf_counter()
+        park.simulate(max_time)
+        elapsed = time.perf_counter() - start
+        n_events = count_events(park)
+        print(f"{n_rides:>6} {n_events:>8} {n_events / elapsed:>10,.0f} {1e6 * elapsed / n_events:>9.1f}")
+
+
+def run_routing_benchmark(ride_counts=(3, 50, 200), n_draws=20000, seed=0):
+    """Prints the cost per routing draw of np.random.choice, Router.draw and Router.draw_many."""
+    print(f"{'rides':>6} {'np.random.choice (us)':>22} {'Router.draw (us)':>17} {'draw_many (us)':>15}")
+    for n_rides in ride_counts:
+        transition_matrix = make_synthetic_park(n_rides, 1.0, seed).transition_matrix
+        dim = transition_matrix.shape[0]
+        rows = np.random.default_rng(seed).integers(0, n_rides + 1, size=n_draws).tolist()
+
+        start = time.perf_counter()
+        for row in rows[:n_draws // 10]:  # np.random.choice is slow, so time fewer draws
+            np.random.choice(a=range(dim), replace=True, p=transition_matrix[row])
+        choice_cost = (time.perf_counter() - start) / (n_draws // 10)
+
+        router = Router(transition_matrix, rng=seed)
+        start = time.perf_counter()
+        for row in rows:
+            router.draw(row)
+        draw_cost = (time.perf_counter() - start) / n_draws
+
+        start = time.perf_counter()
+        router.draw_many(rows)
+        draw_many_cost = (time.perf_counter() - start) / n_draws
+        print(f"{n_rides:>6} {1e6 * choice_cost:>22.2f} {1e6 * draw_cost:>17.2f} {1e6 * draw_many_cost:>15.3f}")
+
+
+def run_batch_benchmark(n_rides=3, arrival_rates=(0.5, 2.0, 8.0), max_time=10, n_replications=2000, seed=0):
+    """Prints replications per second of ThemePark.simulate run in a loop and of BatchThemePark."""
+    print(f"{'arrival rate':>12} {'ThemePark (reps/s)':>19} {'BatchThemePark (reps/s)':>24}")
+    template = make_synthetic_park(n_rides, 1.0, seed)
+    for arrival_rate in arrival_rates:
+        n_reference = max(20, n_replications // 20)  # The reference engine is timed on fewer replications
+        start = time.perf_counter()
+        for replication in range(n_reference):
+            rides = [Ride(ride.ride_id, ride.ride_name, ride.ride_rate) for ride in template.rides]
+            ThemePark(rides, arrival_rate, template.transition_matrix, rng=replication).simulate(max_time)
+        reference_rate = n_reference / (time.perf_counter() - start)
+
+        batch = BatchThemePark(template.rides, arrival_rate, template.transition_matrix, n_replications, rng=seed)
+        start = time.perf_counter()
+        batch.simulate(max_time)
+        batch_rate = n_replications / (time.perf_counter() - start)
+        print(f"{arrival_rate:>12} {reference_rate:>19,.0f} {batch_rate:>24,.0f}")
+
+
+def measure_customer_memory(use_trip_log, n_guests=100000, rides_per_guest=4, seed=0):
+    """
+    Measures the memory held by the records of n_guests customers who each took rides_per_guest rides.
+
+    Parameters:
+    - use_trip_log (bool): If True, uses Customer with a shared TripLog, otherwise the list-based ListCustomer.
+    - n_guests (int): Number of customers.
+    - rides_per_guest (int): Number of rides recorded per customer.
+    - seed (int): Seed for the recorded times.
+
+    Returns:
+    float: bytes allocated per guest.
+    """
+    times = np.random.default_rng(seed).exponential(1.0, size=rides_per_guest).tolist()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    customers = []
+    if use_trip_log:
+        trip_log = TripLog()
+        for customer_id in range(1, n_guests + 1):
+            c = Customer(customer_id, 0.5, trip_log)
+            for ride_id, t in enumerate(times, start=1):
+                c.record_trip(ride_id, customer_id + t, customer_id + 2 * t, customer_id + 3 * t)
+            customers.append(c)
+    else:
+        for customer_id in range(1, n_guests + 1):
+            c = ListCustomer(customer_id, 0.5)
+            for ride_id, t in enumerate(times, start=1):
+                c.record_ride(ride_id, customer_id + t, customer_id + 2 * t)
+            customers.append(c)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / n_guests
+
+
+def run_memory_benchmark(rides_per_guest=(1, 4, 16)):
+    """Prints bytes per guest of the list-based customer records and of Customer with a shared TripLog."""
+    print(f"{'rides/guest':>11} {'lists (B/guest)':>16} {'trip log (B/guest)':>19}")
+    for n_rides in rides_per_guest:
+        before = measure_customer_memory(False, rides_per_guest=n_rides)
+        after = measure_customer_memory(True, rides_per_guest=n_rides)
+        print(f"{n_rides:>11} {before:>16,.0f} {after:>19,.0f}")
+
+
+def load_shipped_park(arrival_rate, seed=0):
+    """
+    Builds the park of ride_info.csv and ride_transitions.csv.
+
+    Parameters:
+    - arrival_rate (float): Customer arrival rate of the park.
+    - seed (int): Seed of the park's random streams.
+
+    Returns:
+    ThemePark: the 3-ride park used by themepark_simulation.py.
+    """
+    model = parse_park_model()
+    return ThemePark(model.build_rides(), arrival_rate, model.transition_matrix, rng=seed)
+
+
+def build_park(park_name, arrival_rate, seed=0):
+    """Builds a fresh park of a benchmark scenario: 'shipped' or 'synthetic<n_rides>'."""
+    if park_name == "shipped":
+        return load_shipped_park(arrival_rate, seed)
+    return make_synthetic_park(int(park_name[len("synthetic"):]), arrival_rate, seed)
+
+
+def saturation_rate(park):
+    """
+    Returns the arrival rate at which the busiest ride of a park has an offered load of 1, i.e. one customer
+    riding on average (see ThemePark.analyze). Rides have no capacity limit in this simulator, so this is the
+    rate at which a ride carrying one customer at a time would saturate.
+    """
+    return park.arrival_rate / park.analyze()["utilization"].max()
+
+
+def scenario_days(park, horizon):
+    """
+    Returns the number of park-days of length horizon a scenario simulates, so that together they would process
+    MIN_EVENTS events if every customer took all their rides: a single 10-hour day is too short to time. Short days
+    process fewer, as customers who cannot finish a ride before the horizon are turned away.
+    """
+    analysis = park.analyze()
+    events_per_day = park.arrival_rate * (1 + analysis["rides_per_guest"]) * horizon
+    return max(1, math.ceil(MIN_EVENTS / events_per_day))
+
+
+# Canonical workloads: (park, arrival rate as a multiple of saturation_rate, horizon in hours, in the quick suite).
+# themepark_simulation.py simulates 10-hour days, and the busiest day of arrival_rates.csv is about 5 times
+# the saturation rate of the shipped park
+SCENARIOS = [
+    ("shipped", 0.5, 10, True),
+    ("shipped", 1.0, 10, True),
+    ("shipped", 5.0, 10, True),
+    ("shipped", 1.0, 10000, True),
+    ("synthetic50", 0.5, 10, True),
+    ("synthetic50", 1.0, 100, True),
+    ("synthetic50", 1.0, 10000, False),
+    ("synthetic500", 0.5, 10, True),
+    ("synthetic500", 1.0, 1000, False),
+]
+
+# Scenarios with fewer expected events per day simulate several days
+MIN_EVENTS = 50000
+
+# Runs shorter than this are dominated by timer resolution and noise
+MIN_WALL_TIME = 0.1
+
+
+def scenario_name(park_name, load, horizon):
+    return f"{park_name}-load{load:g}-h{horizon:g}"
+
+
+def run_scenario(scenario, repeat=3, seed=0):
+    """
+    Measures one scenario. Meant to run in a fresh process, so that the peak RSS is the scenario's own.
+
+    Parameters:
+    - scenario (tuple): (park name, load, horizon, quick) as in SCENARIOS.
+    - repeat (int): The number of timed runs; the median is reported.
+    - seed (int): Seed of the park and of the random streams of its days, the same for every run.
+
+    Returns:
+    dict: 'days', 'events', 'wall_time' (seconds spent in simulate), 'events_per_second', 'peak_rss_mb' and
+    'peak_alloc_mb' (the peak memory traced by tracemalloc during an extra, untimed run of the first day).
+    """
+    import resource  # Unix only, so imported here rather than by every module that imports benchmarks
+
+    park_name, load, horizon, _ = scenario
+    template = build_park(park_name, 1.0, seed)
+    arrival_rate = load * saturation_rate(template)
+    template = build_park(park_name, arrival_rate, seed)
+    n_days = scenario_days(template, horizon)
+
+    def new_day(day):
+        rides = [Ride(ride.ride_id, ride.ride_name, ride.ride_rate) for ride in template.rides]
+        return ThemePark(rides, arrival_rate, template.transition_matrix, rng=np.random.SeedSequence((seed, day)))
+
+    wall_times = []
+    for _ in range(repeat):
+        wall_time = 0.0
+        n_events = 0
+        for day in range(n_days):
+            park = new_day(day)
+            start = time.perf_counter()
+            park.simulate(horizon)
+            wall_time += time.perf_counter() - start
+            n_events += count_events(park)
+        wall_times.append(wall_time)
+    wall_time = statistics.median(wall_times)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kilobytes on Linux
+
+    park = new_day(0)
+    tracemalloc.start()
+    park.simulate(horizon)
+    peak_alloc = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"days": n_days, "events": n_events, "wall_time": wall_time, "events_per_second": n_events / wall_time,
+            "peak_rss_mb": peak_rss, "peak_alloc_mb": peak_alloc / 2 ** 20}
+
+
+def run_suite(quick=False, repeat=3, seed=0):
+    """
+    Runs every scenario of SCENARIOS (or only the quick ones), each in a fresh process.
+
+    Returns:
+    dict: the measurements of run_scenario keyed by scenario name.
+    """
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for scenario in SCENARIOS:
+        if quick and not scenario[3]:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_scenario, scenario, repeat, seed).result()
+        name = scenario_name(*scenario[:3])
+        results[name] = result
+        print(f"{name:<24} {result['days']:>5} days {result['events']:>9} events {result['wall_time']:>8.3f} s "
+              f"{result['events_per_second']:>10,.0f} ev/s {result['peak_rss_mb']:>7.1f} MB RSS "
+              f"{result['peak_alloc_mb']:>7.1f} MB alloc")
+        if result["wall_time"] < MIN_WALL_TIME:
+            print(f"Warning: {name} ran for less than {MIN_WALL_TIME} s, too short to be timed reliably.")
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Compares suite results with saved baselines.
+
+    Parameters:
+    - results (dict): The output of run_suite.
+    - baseline (dict): Saved results of an earlier run_suite.
+    - tolerance (float): The largest accepted relative drop in events per second.
+
+    Returns:
+    list of str: a message for each scenario whose throughput dropped by more than tolerance. Scenarios
+    missing from baseline are left out, for the caller to report.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result["events"] != baseline[name]["events"]:
+            print(f"Note: {name} processed {result['events']} events instead of {baseline[name]['events']}, "
+                  f"so the workload itself has changed.")
+        ratio = result["events_per_second"] / baseline[name]["events_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append(f"{name}: {result['events_per_second']:,.0f} ev/s is {1 - ratio:.0%} below "
+                               f"the baseline of {baseline[name]['events_per_second']:,.0f} ev/s")
+    return regressions
+
+
+def run_microbenchmarks():
+    """Runs the benchmarks of the individual components."""
+    run_event_calendar_benchmark()
+    print("")
+    run_ride_scaling_benchmark()
+    print("")
+    run_routing_benchmark()
+    print("")
+    run_batch_benchmark()
+    print("")
+    run_memory_benchmark()
+
+
+def main(argv=None):
+    """
+    Command line entry point. 'suite' runs the canonical scenarios and exits with status 1 if the throughput 
+    of any scenario dropped by more than the tolerance compared with the baseline file, or with status 2 if
+    the baseline file has no results for some scenario; 'micro' runs the component benchmarks.
+    """
+    parser = argparse.ArgumentParser(description="Theme park simulation benchmarks.")
+    parser.add_argument("mode", nargs="?", choices=["suite", "micro"], default="suite")
+    parser.add_argument("--quick", action="store_true", help="only run the short scenarios")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per scenario (the median is kept)")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="JSON file of baseline results")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="accepted relative drop in events per second")
+    args = parser.parse_args(argv)
+    if args.save and args.repeat < 3:
+        parser.error("--save needs --repeat 3 or more, so that the baseline is a median of several runs.")
+
+    if args.mode == "micro":
+        run_microbenchmarks()
+        return 0
+
+    results = run_suite(quick=args.quick, repeat=args.repeat)
+    try:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    except FileNotFoundError:
+        baseline = {}
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+        print(f"Saved the results to {args.baseline}.")
+        return 0
+
+    # Baselines depend on the machine, so none is shipped: without one there is nothing to compare with
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(f"No baseline in {args.baseline} for {', '.join(missing)}: "
+              f"run 'python benchmarks.py suite --save' on this machine first.")
+        return 2
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
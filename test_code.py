@@ -1,5 +1,43 @@
-from Themepark_classes import Ride, ThemePark
+import os
+import shutil
+import sys
+import warnings
 import numpy as np
+import pandas as pd
+import pytest
+from Themepark_classes import (ArrivalSchedule, Customer, PriorityQueue, Ride, Router, SparseTransitions, ThemePark,
+                               TripLog, VariateStream)
+from benchmarks import compare_to_baseline
+from themepark_aggregation import SummaryAccumulator, t_quantile
+from themepark_batch import BatchThemePark
+import themepark_cache
+from themepark_cache import ResultCache
+from themepark_loader import load_park_model, parse_park_model
+from themepark_runner import run_adaptive, run_scenarios, run_season
+from themepark_sinks import CSVSink, NpySink, ParquetSink, RESULT_COLUMNS, customer_summary
+from themepark_trace import TRACE_ARRIVAL, TRACE_RIDE, TraceRecorder, format_trace, read_trace
+
+# The park of test_theme_park, shared by the other tests
+RIDE_SPECS = [(1, "Ride One", 1.1), (2, "Ride Two", 0.7), (3, "Ride Three", 0.8)]
+TRANSITION_MATRIX = np.array([
+    [0, 0.3, 0.4, 0.3, 0.0],  # From Arrival
+    [0, 0.5, 0.3, 0.1, 0.1],  # From Ride One
+    [0, 0.4, 0.1, 0.3, 0.2],  # From Ride Two
+    [0, 0.3, 0.3, 0.2, 0.2],  # From Ride Three
+    [0, 0.0, 0.0, 0.0, 1.0]   # From Exit: just to make it square
+])
+TRANSITION_MATRIX.flags.writeable = False  # Shared by every test
+
+
+def make_rides():
+    """Returns fresh Ride objects of RIDE_SPECS, so that no queue is shared between parks."""
+    return [Ride(ride_id, ride_name, ride_rate) for ride_id, ride_name, ride_rate in RIDE_SPECS]
+
+
+def wavy_rate(t):
+    """An arrival rate function at module level, so that parks using it can be saved."""
+    return 1 + np.sin(t)
+
 
 def test_theme_park():
     rides = [
@@ -38,3 +76,510 @@ def test_theme_park():
 test_theme_park()  # Should produce a different output each time
 
 
+
+def test_priority_queue_order():
+    queue = PriorityQueue()
+    queue.push(2.0, 1)
+    queue.push(1.0, 3)
+    queue.push(2.0, 0)  # Same time as the first event, so it must come out after it
+    queue.push_many([(0.5, 2), (2.0, 4)])
+
+    assert len(queue) == 5
+    assert queue.peek() == (0.5, 2)
+    assert queue.queue == [(0.5, 2), (1.0, 3), (2.0, 1), (2.0, 0), (2.0, 4)]
+    assert [queue.popleft() for _ in range(5)] == [(0.5, 2), (1.0, 3), (2.0, 1), (2.0, 0), (2.0, 4)]
+
+def test_ride_ids_must_be_unique_and_contiguous():
+    transition_matrix = np.array([
+        [0, 0.5, 0.5, 0.0],
+        [0, 0.0, 0.5, 0.5],
+        [0, 0.5, 0.0, 0.5],
+        [0, 0.0, 0.0, 1.0]
+    ])
+    with pytest.raises(ValueError):
+        ThemePark([Ride(1, "A", 1.0), Ride(1, "B", 1.0)], 0.5, transition_matrix)
+    with pytest.raises(ValueError):
+        ThemePark([Ride(1, "A", 1.0), Ride(3, "B", 1.0)], 0.5, transition_matrix)
+
+    # Rides given out of order are still found by their ride_id
+    park = ThemePark([Ride(2, "B", 1.0), Ride(1, "A", 1.0)], 0.5, transition_matrix)
+    park.simulate(max_time=5)
+    assert all(ride_id in (1, 2) for customer in park.customers for ride_id in customer.path)
+
+def test_router_matches_transition_probabilities():
+    n_draws = 200000
+    for row in range(len(TRANSITION_MATRIX)):
+        router = Router(TRANSITION_MATRIX, rng=row)
+        single = np.bincount([router.draw(row) for _ in range(n_draws)], minlength=5) / n_draws
+        batched = np.bincount(router.draw_many(np.full(n_draws, row)), minlength=5) / n_draws
+        # Five standard errors of a proportion estimated from n_draws draws is below 0.006
+        assert np.allclose(single, TRANSITION_MATRIX[row], atol=0.006)
+        assert np.allclose(batched, TRANSITION_MATRIX[row], atol=0.006)
+
+def test_replications_do_not_depend_on_worker_count():
+    scenarios = [(0.6, "Monday", 1), (2.0, "Sunday", 1)]
+    serial = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=7, max_workers=1)
+    parallel = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=7, max_workers=2)
+    assert serial == parallel
+    assert {row[-1] for row in serial} == {0, 1, 2}  # Replication numbers
+    assert serial != run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=8, max_workers=1)
+
+def test_batch_engine_matches_reference_engine():
+    reference = {"n_customers": [], "n_rides": [], "wait_time": [], "ride_time": []}
+    for replication in range(300):
+        park = ThemePark(make_rides(), 1.5, TRANSITION_MATRIX, rng=replication)
+        park.simulate(max_time=10)
+        reference["n_customers"].append(len(park.customers))
+        reference["n_rides"] += [len(c.path) for c in park.customers]
+        reference["wait_time"] += [sum(c.wait_times) for c in park.customers]
+        reference["ride_time"] += [sum(c.ride_times) for c in park.customers]
+
+    batch = BatchThemePark(make_rides(), 1.5, TRANSITION_MATRIX, n_replications=3000, rng=0).simulate(max_time=10)
+    batch["n_customers"] = np.bincount(batch["replication"], minlength=3000)
+
+    # The means of both engines must agree within 4 standard errors of their difference
+    for metric, values in reference.items():
+        values = np.asarray(values, dtype=float)
+        standard_error = np.sqrt(values.var() / len(values) + batch[metric].var() / len(batch[metric]))
+        assert abs(values.mean() - batch[metric].mean()) < 4 * standard_error, metric
+    # The shapes of the distributions must agree too
+    for quantile in (0.25, 0.5, 0.75):
+        assert abs(np.quantile(reference["ride_time"], quantile) - np.quantile(batch["ride_time"], quantile)) < 0.3
+
+def test_customer_records_share_a_trip_log():
+    trip_log = TripLog()
+    first = Customer(1, 0.0, trip_log)
+    second = Customer(2, 0.5, trip_log)
+    first.record_trip(2, 0.0, 0.25, 1.0)
+    second.record_trip(1, 0.5, 0.5, 0.75)
+    first.record_trip(3, 1.5, 1.0, 2.0)  # Boarded before joining the queue, so no wait
+    second.record_ride(3, 0.3, 0.1)
+
+    assert first.path == [2, 3] and second.path == [1, 3]
+    assert first.ride_times == [0.75, 1.0] and first.wait_times == [0.25, 0.0]
+    assert second.ride_times == [0.25, 0.3] and second.wait_times == [0.0, 0.1]
+    assert list(trip_log.to_numpy()["customer_id"]) == [1, 2, 1, 2]
+    assert not hasattr(first, "__dict__")
+
+    # A customer created on their own gets a private log
+    assert Customer(3, 1.0).path == []
+
+    for arguments in ((-1, 0.0, 0.5, 1.0), (1.0, 0.0, 0.5, 1.0), (2, "0", 0.5, 1.0), (2, 0.0, -0.5, 1.0),
+                      (2, 0.0, 1.0, 0.5)):
+        with pytest.raises(ValueError):
+            first.record_trip(*arguments)
+    assert first.path == [2, 3]
+
+def test_sinks_write_the_same_rows_as_pandas(tmp_path):
+
+    park = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=3)
+    park.simulate(max_time=10)
+    expected = [customer_summary(c) + (2.0, "Sunday", 4) for c in park.customers]
+    pd.DataFrame(expected, columns=RESULT_COLUMNS).to_csv(tmp_path / "expected.csv", index=False)
+
+    streamed = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=3)
+    sinks = [CSVSink(tmp_path / "streamed.csv", chunk_size=7), NpySink(tmp_path / "streamed.npy", chunk_size=7)]
+    callbacks = [sink.callback(arrival_rate=2.0, day="Sunday", week=4) for sink in sinks]
+    streamed.simulate(max_time=10, sink=lambda customer: [callback(customer) for callback in callbacks])
+    for sink in sinks:
+        sink.close()
+
+    assert streamed.customers == []  # The customers went to the sinks instead
+    assert (tmp_path / "streamed.csv").read_bytes() == (tmp_path / "expected.csv").read_bytes()
+    records = np.load(tmp_path / "streamed.npy", mmap_mode="r")
+    assert [tuple(record.tolist()) for record in records] == expected
+
+    pytest.importorskip("pyarrow")
+    with ParquetSink(tmp_path / "streamed.parquet", chunk_size=7) as sink:
+        for row in expected:
+            sink.write_row(row)
+    parquet_rows = pd.read_parquet(tmp_path / "streamed.parquet").itertuples(index=False, name=None)
+    assert [tuple(row) for row in parquet_rows] == expected
+
+def test_sink_runs_drop_the_trips_of_customers_who_left():
+    rows, kept = [], []
+    def sink(customer):
+        rows.append(customer_summary(customer))
+        if customer.customer_id % 100 == 0:
+            kept.append(customer)
+    park = ThemePark(make_rides(), 1.0, TRANSITION_MATRIX, rng=9)
+    park.simulate(max_time=2500, sink=sink)
+    park.simulate(max_time=5000, sink=sink, resume=True)
+    reference = ThemePark(make_rides(), 1.0, TRANSITION_MATRIX, rng=9)
+    reference.simulate(max_time=2500)
+    reference.simulate(max_time=5000, resume=True)
+
+    # The trip log stays small, and the customers the sink kept still have all their rides
+    assert len(park.trip_log) < 10000 < sum(row[1] for row in rows)
+    final_rows = {row[0]: row for row in rows}  # Customers in the park at 2500 reach the sink twice
+    assert list(final_rows.values()) == [customer_summary(c) for c in reference.customers]
+    by_id = {c.customer_id: c for c in reference.customers}
+    assert all((c.path, c.wait_times) == (by_id[c.customer_id].path, by_id[c.customer_id].wait_times) for c in kept)
+
+def test_streaming_summary_matches_pandas():
+    df = pd.read_csv("example_output.csv")
+
+    # Two accumulators fed half of the rows each, as two workers would be, then merged
+    first, second = SummaryAccumulator(), SummaryAccumulator()
+    for index, row in enumerate(df.itertuples(index=False, name=None)):
+        (first if index % 2 else second).write_row(row)
+    first.merge(second)
+
+    for day, n_customers, rides, wait, ride_time in first.summary_rows():
+        day_df = df.loc[df["day"] == day]
+        assert n_customers == day_df.groupby("week")["customer_id"].nunique().sum()
+        assert np.allclose([rides, wait, ride_time], day_df[["n_rides", "wait_time", "ride_time"]].mean())
+
+    for day, metric, mean, std, lower, upper, median, p90 in first.confidence_rows():
+        values = df.loc[df["day"] == day, metric]
+        assert np.isclose(std, values.std())
+        assert lower < mean < upper
+        assert values.min() <= median <= p90 <= values.max()
+
+def test_t_quantile_matches_the_tables():
+    # Two-sided 95%, 90% and 99% critical values of Student's t distribution
+    table = {(0.975, 3): 3.182446, (0.975, 4): 2.776445, (0.975, 5): 2.570582, (0.975, 9): 2.262157,
+             (0.975, 30): 2.042272, (0.975, 120): 1.979930, (0.95, 3): 2.353363, (0.995, 4): 4.604095,
+             (0.975, 1): 12.706205, (0.975, 2): 4.302653}
+    for (probability, df), value in table.items():
+        assert abs(t_quantile(probability, df) - value) < 1e-6
+        assert abs(t_quantile(1 - probability, df) + value) < 1e-6
+
+def test_analyze_matches_a_long_simulation():
+    for arrival_rate in (0.3, 1.0):
+        park = ThemePark(make_rides(), arrival_rate, TRANSITION_MATRIX, rng=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")  # Rides without a capacity limit are never unstable
+            analysis = park.analyze()
+        park.simulate(max_time=20000)
+        trips = park.trip_log.to_numpy()
+        stats = park.ride_stats()
+
+        # Flow conservation: in a long run each ride carries customers at its effective arrival rate
+        throughput = np.array([ride.customers_processed for ride in park.rides]) / 20000
+        assert np.allclose(throughput, analysis["arrival_rate"], rtol=0.05)
+        assert np.isclose(np.mean([len(c.path) for c in park.customers]), analysis["rides_per_guest"], rtol=0.05)
+        # W and Wq from the times of each trip, and L from the time-weighted number riding
+        for ride_id in (1, 2, 3):
+            on_ride = trips["ride_id"] == ride_id
+            delays = trips["start_time"][on_ride] - trips["queue_entry_time"][on_ride]
+            time_in_system = trips["end_time"][on_ride] - trips["queue_entry_time"][on_ride]
+            assert abs(delays.mean() - analysis["mean_wait"][ride_id - 1]) < 1e-9
+            assert np.isclose(time_in_system.mean(), analysis["mean_time_in_system"][ride_id - 1], rtol=0.05)
+        assert np.allclose(stats["mean_busy"], analysis["mean_number_in_system"], rtol=0.1)
+
+def test_runs_are_reproducible_from_one_seed():
+    def trajectory(arrival_rate, seed):
+        park = ThemePark(make_rides(), arrival_rate, TRANSITION_MATRIX, rng=seed)
+        park.simulate(max_time=10)
+        return [(c.arrival_time, c.path, c.wait_times, c.ride_times) for c in park.customers]
+
+    assert trajectory(1.0, 42) == trajectory(1.0, 42)
+    assert trajectory(1.0, 42) != trajectory(1.0, 43)
+
+    # Common random numbers: doubling the arrival rate halves every inter-arrival time
+    slow, fast = trajectory(1.0, 42), trajectory(2.0, 42)
+    assert np.allclose([c[0] for c in fast[:5]], [c[0] / 2 for c in slow[:5]])
+
+def test_profiling_counts_events_without_changing_the_run():
+    plain = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=5)
+    plain.simulate(max_time=10)
+    profiled = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=5)
+    profiled.simulate(max_time=10, profile=True)
+
+    assert plain.stats is None
+    assert [c.path for c in plain.customers] == [c.path for c in profiled.customers]
+    stats = profiled.stats.to_dict()
+    assert stats["event_counts"]["arrival"] == len(profiled.customers)
+    assert stats["event_counts"]["ride"] == sum(ride.customers_processed for ride in profiled.rides)
+    assert stats["routing_draws"] == sum(stats["event_counts"].values())
+    assert stats["calendar_high_water"] >= 1 and stats["events_per_second"] > 0
+
+    # The season and adaptive runners profile their runs too, without changing them
+    scenarios = [(0.5, "Monday", 1), (2.0, "Tuesday", 1)]
+    season_stats = []
+    rows = run_season(RIDE_SPECS, TRANSITION_MATRIX, scenarios, day_length=10, stats=season_stats)
+    assert rows == run_season(RIDE_SPECS, TRANSITION_MATRIX, scenarios, day_length=10)
+    assert len(season_stats) == 1 and season_stats[0]["event_counts"]["arrival"] == len(rows)
+    adaptive_stats = []
+    _, report = run_adaptive(RIDE_SPECS, TRANSITION_MATRIX, scenarios, min_replications=2, max_replications=2,
+                             max_workers=1, stats=adaptive_stats)
+    assert len(adaptive_stats) == sum(entry["n_replications"] for entry in report) == 4
+    assert all(entry["event_counts"]["arrival"] >= 0 for entry in adaptive_stats)
+
+def test_benchmark_regressions_are_flagged():
+    baseline = {"shipped-load1-h10": {"events": 100, "events_per_second": 1000.0}}
+    assert compare_to_baseline({"shipped-load1-h10": {"events": 100, "events_per_second": 900.0}}, baseline) == []
+    assert len(compare_to_baseline({"shipped-load1-h10": {"events": 100, "events_per_second": 700.0}}, baseline)) == 1
+    assert compare_to_baseline({"new-scenario": {"events": 1, "events_per_second": 1.0}}, baseline) == []
+
+def test_snapshot_restores_a_warmed_up_park():
+    park = ThemePark(make_rides(), 1.0, TRANSITION_MATRIX, rng=8)
+    with pytest.raises(ValueError):
+        park.simulate(max_time=20, resume=True)
+    park.simulate(max_time=20)
+    snapshot = park.snapshot()
+    restored = ThemePark.restore(snapshot)
+    assert restored.current_time == park.current_time
+    assert str(restored) == str(park)
+
+    # The restored park continues exactly as the original would
+    park.simulate(max_time=40, resume=True)
+    restored.simulate(max_time=40, resume=True)
+    assert [(c.arrival_time, c.path, c.wait_times) for c in park.customers] == \
+           [(c.arrival_time, c.path, c.wait_times) for c in restored.customers]
+    assert max(c.arrival_time for c in park.customers) > 20
+
+    # Forked clones continue as different replications, and resumed sinks still receive customers in order
+    forks = [ThemePark.restore(snapshot).clone(rng=seed) for seed in (1, 2)]
+    received = [[], []]
+    for fork, customers in zip(forks, received):
+        fork.simulate(max_time=40, sink=lambda c, customers=customers: customers.append(c.customer_id), resume=True)
+    assert received[0] != received[1]
+    assert all(customers == sorted(customers) for customers in received)
+
+    # A rate function can only be saved if it is defined at module level
+    schedule = ArrivalSchedule([0], [2.0], rate_function=wavy_rate)
+    ThemePark(make_rides(), schedule, TRANSITION_MATRIX, rng=8).clone().simulate(max_time=10)
+    park = ThemePark(make_rides(), ArrivalSchedule([0], [2.0], rate_function=lambda t: 1.0), TRANSITION_MATRIX)
+    with pytest.raises(ValueError, match="rate_function"):
+        park.snapshot()
+    with pytest.raises(ValueError, match="rate_function"):
+        park.clone()
+
+def test_arrival_schedule_thinning():
+    # A single segment draws the same arrivals as a constant rate
+    constant = ThemePark(make_rides(), 0.6, TRANSITION_MATRIX, rng=3)
+    constant.simulate(max_time=10)
+    scheduled = ThemePark(make_rides(), ArrivalSchedule([0], [0.6]), TRANSITION_MATRIX, rng=3)
+    scheduled.simulate(max_time=10)
+    assert [(c.arrival_time, c.path) for c in constant.customers] == [(c.arrival_time, c.path) for c in scheduled.customers]
+
+    # Nobody arrives while the rate is 0, and the arrival counts follow the rates
+    def arrivals(schedule, end, seed=0):
+        stream, times, t = VariateStream(seed), [], 0.0
+        while True:
+            t = schedule.next_arrival(t, stream)
+            if t >= end:
+                return np.array(times)
+            times.append(t)
+    times = arrivals(ArrivalSchedule.daily([5.0, 0.0, 20.0], day_length=100), 300)
+    assert not ((times >= 100) & (times < 200)).any()
+    assert np.isclose((times < 100).sum(), 500, rtol=0.15) and np.isclose((times >= 200).sum(), 2000, rtol=0.1)
+    times = arrivals(ArrivalSchedule([0], [2.0], rate_function=lambda t: 1 + np.sin(t)), 2000)
+    assert np.isclose(len(times), 2000, rtol=0.1)
+    with pytest.raises(ValueError):
+        arrivals(ArrivalSchedule([0], [1.0], rate_function=lambda t: 3.0), 10)
+
+    # A continuous season tags each customer with the day they arrived on
+    rows = run_season(RIDE_SPECS, TRANSITION_MATRIX, [(0.5, "Monday", 1), (2.0, "Tuesday", 1)], day_length=50)
+    assert [row[5] for row in rows] == sorted(row[5] for row in rows)
+    assert sum(row[5] == "Tuesday" for row in rows) > 2 * sum(row[5] == "Monday" for row in rows)
+
+def test_adaptive_replications_stop_at_the_target_precision():
+    scenarios = [(0.5, "Tuesday", 1), (2.0, "Sunday", 1)]
+    rows, report = run_adaptive(RIDE_SPECS, TRANSITION_MATRIX, scenarios, relative_precision=0.1,
+                                metrics=("n_customers",), max_workers=1, master_seed=3)
+    for entry in report:
+        assert entry["converged"] and 5 <= entry["n_replications"] < 200
+        assert entry["n_customers_half_width"] <= 0.1 * entry["n_customers_mean"]
+    # The busier day has relatively less variable attendance, so it needs fewer replications
+    assert report[1]["n_replications"] < report[0]["n_replications"]
+
+    # Replications use the same seeds as a fixed-size study
+    fixed = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=5, max_workers=1, master_seed=3)
+    assert sorted(row for row in rows if row[7] < 5) == sorted(fixed)
+
+    _, report = run_adaptive(RIDE_SPECS, TRANSITION_MATRIX, scenarios, relative_precision=0.01, max_workers=1, budget=30)
+    assert sum(entry["n_replications"] for entry in report) == 30 and not any(entry["converged"] for entry in report)
+
+def test_trace_records_every_event(tmp_path):
+    plain = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=4)
+    plain.simulate(max_time=10)
+    traced = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=4)
+    with TraceRecorder(capacity=8, path=str(tmp_path / "trace.npy")) as trace:
+        traced.simulate(max_time=10, trace=trace)
+    records = read_trace(str(tmp_path / "trace.npy"))
+
+    # Tracing does not change the run, and every arrival and ride is recorded
+    assert [c.path for c in plain.customers] == [c.path for c in traced.customers]
+    assert (records["event"] == TRACE_ARRIVAL).sum() == len(traced.customers)
+    rides = records[records["event"] == TRACE_RIDE]
+    assert len(rides) == sum(ride.customers_processed for ride in traced.rides)
+    assert np.allclose(np.sort(rides["wait"]), np.sort([w for c in traced.customers for w in c.wait_times]))
+    lines = list(format_trace(records[:2], {1: "Ride One", 2: "Ride Two", 3: "Ride Three"}))
+    assert lines[0] == f"Customer 1 arrived at time {traced.customers[0].arrival_time}."
+
+    # An in-memory ring keeps the latest records
+    ring = TraceRecorder(capacity=16)
+    ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=4).simulate(max_time=10, trace=ring)
+    assert ring.n_dropped == len(records) - 16
+    assert ring.to_numpy().tolist() == records[-16:].tolist()
+    assert list(ring.to_dataframe()["event"][:1]) in (["arrival"], ["ride"], ["rejected"])
+
+def test_trusted_and_validating_modes_give_the_same_run():
+    runs = []
+    for validate in (True, False):
+        park = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX, rng=21)
+        park.simulate(max_time=10, validate=validate)
+        park.simulate(max_time=15, validate=validate, resume=True)
+        runs.append(([(c.customer_id, c.arrival_time) for c in park.customers],
+                     {name: column.tolist() for name, column in park.trip_log.to_numpy().items()},
+                     park.event_queue.queue))
+    assert runs[0] == runs[1]
+
+    park = ThemePark(make_rides(), 2.0, TRANSITION_MATRIX)
+    for arguments in ({"max_time": -1}, {"max_time": "10"}, {"max_time": 10, "sink": []}, 
+                      {"max_time": 10, "trace": []}):
+        with pytest.raises(ValueError):
+            park.simulate(**arguments)
+
+def test_sparse_transitions_route_like_the_dense_matrix():
+    transition_matrix = np.loadtxt("ride_transitions.csv", delimiter=",", skiprows=1)
+    sparse = SparseTransitions.read_csv("ride_transitions_edges.csv")
+    assert np.array_equal(sparse.to_dense(), transition_matrix)
+    assert np.array_equal(SparseTransitions.from_dense(transition_matrix).to_dense(), transition_matrix)
+
+    dense_park = ThemePark(make_rides(), 0.3, transition_matrix, rng=0)
+    sparse_park = ThemePark(make_rides(), 0.3, sparse, rng=0)
+    for key, value in dense_park.analyze().items():
+        assert np.allclose(sparse_park.analyze()[key], value)
+
+    # Draws only ever follow edges, with the edge probabilities
+    for row in range(4):
+        draws = sparse_park.router.draw_many(np.full(20000, row))
+        assert np.allclose(np.bincount(draws, minlength=5) / 20000, transition_matrix[row], atol=0.015)
+        draws = [sparse_park.route_customer(row) for _ in range(20000)]
+        assert np.allclose(np.bincount(draws, minlength=5) / 20000, transition_matrix[row], atol=0.015)
+
+    # A large park where each ride links to a few others
+    n_rides, rng = 3000, np.random.default_rng(1)
+    adjacency = [[(ride_id, 1 / n_rides) for ride_id in range(1, n_rides + 1)]]
+    for ride_id in range(1, n_rides + 1):
+        adjacency.append([(int(next_id), 0.2) for next_id in rng.integers(1, n_rides + 1, 4)] + [(n_rides + 1, 0.2)])
+    adjacency.append([(n_rides + 1, 1.0)])
+    park = ThemePark([Ride(i, f"Ride {i}", 2.0) for i in range(1, n_rides + 1)], 5.0,
+                     SparseTransitions.from_adjacency(adjacency), rng=2)
+    park.simulate(max_time=20)
+    assert np.isclose(park.analyze()["rides_per_guest"], 5.0)
+    assert all(ride_id <= n_rides for c in park.customers for ride_id in c.path)
+
+def test_park_model_loader_and_cache(tmp_path):
+    model = parse_park_model()
+    ride_info, ride_transitions, arrival_rates = model.to_dataframes()
+    pd.testing.assert_frame_equal(ride_info, pd.read_csv("ride_info.csv"))
+    assert np.array_equal(ride_transitions.to_numpy(), pd.read_csv("ride_transitions.csv").to_numpy())
+    pd.testing.assert_frame_equal(arrival_rates, pd.read_csv("arrival_rates.csv"))
+    assert model.scenarios[0] == (0.6, "Monday", 1)
+
+    # The cache is reused while the files are unchanged, and rebuilt when one changes
+    for name in ("ride_info.csv", "ride_transitions_edges.csv", "arrival_rates.csv"):
+        shutil.copy(name, tmp_path / name)
+    paths = [str(tmp_path / name) for name in ("ride_info.csv", "ride_transitions_edges.csv", "arrival_rates.csv")]
+    cache_path = str(tmp_path / "model.npz")
+    first = load_park_model(*paths, cache_path=cache_path)
+    cached = load_park_model(*paths, cache_path=cache_path)
+    assert np.array_equal(cached.transition_matrix.to_dense(), first.transition_matrix.to_dense())
+    assert cached.ride_specs == first.ride_specs and cached.scenarios == first.scenarios
+    with open(paths[2], "a") as file:
+        file.write("5,Monday,0.9\n")
+    assert load_park_model(*paths, cache_path=cache_path).scenarios[-1] == (0.9, "Monday", 5)
+    with open(paths[2], "a") as file:
+        file.write("5,Tuesday,-1\n")
+    with pytest.raises(ValueError):
+        load_park_model(*paths, cache_path=cache_path)
+
+def test_ride_stats_are_time_weighted():
+    park = ThemePark(make_rides(), 0.2, TRANSITION_MATRIX, rng=6)
+    park.simulate(max_time=200)
+    park.simulate(max_time=3000, resume=True)
+    stats = park.ride_stats()
+    end_time = park.current_time
+
+    # A customer is in a ride's queue from when they are routed to it (their arrival, or the start of 
+    # their previous ride) until they board
+    queue_area = np.zeros(4)
+    for c in park.customers:
+        routed_at = c.arrival_time
+        for i in park.trip_log.history(c._last_trip):
+            queue_area[park.trip_log.ride_ids[i]] += park.trip_log.start_times[i] - routed_at
+            routed_at = park.trip_log.start_times[i]
+    for ride in park.rides:
+        for c, _ in ride:
+            trips = park.trip_log.history(c._last_trip)
+            queue_area[ride.ride_id] += end_time - (park.trip_log.start_times[trips[-1]] if trips else c.arrival_time)
+    assert np.allclose(stats["mean_queue_length"], queue_area[1:] / end_time)
+    assert np.array_equal(stats["n_served"], [ride.customers_processed for ride in park.rides])
+    assert np.all(stats["max_queue_length"] >= stats["mean_queue_length"])
+    # The number riding, integrated from the trips and counting the rides still going on up to end_time
+    trips = park.trip_log.to_numpy()
+    busy_area = np.bincount(trips["ride_id"], np.minimum(trips["end_time"], end_time) - trips["start_time"], 4)
+    assert np.allclose(stats["mean_busy"], busy_area[1:] / end_time)
+
+    # Rides have no capacity limit, so the mean number riding is the offered load of the Jackson network
+    analysis = park.analyze()
+    assert np.allclose(stats["mean_busy"], analysis["utilization"], rtol=0.15)
+    assert np.allclose(stats["utilization"], analysis["utilization"], rtol=0.15)
+    assert np.allclose(stats["utilization"], stats["throughput"] / [ride.ride_rate for ride in park.rides])
+    # Queue entry times are dropped as customers board
+    assert all(len(ride.queue_entry_times) == len(ride) for ride in park.rides)
+
+def test_result_cache_replays_replications(tmp_path):
+    scenarios = [(0.5, "Monday", 1), (1.5, "Sunday", 1)]
+    directory = str(tmp_path / "cache")
+    expected = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=7, max_workers=1)
+    # Every module of the simulator is part of the version, so that editing any of them discards older results
+    hashed = {module.__name__ for module in themepark_cache._SIMULATOR_MODULES}
+    simulator, pending = set(), ["themepark_runner"]
+    while pending:
+        name = pending.pop()
+        if name not in simulator and name.lower().startswith("themepark_"):
+            simulator.add(name)
+            pending.extend(getattr(value, "__module__", getattr(value, "__name__", ""))
+                           for value in vars(sys.modules[name]).values())
+    assert simulator == hashed
+
+    with ResultCache(directory) as cache:
+        first = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=7,
+                              max_workers=1, cache=cache)
+        assert (cache.hits, cache.misses, len(cache)) == (0, 6, 6)
+    with ResultCache(directory) as cache:
+        replayed = run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios, n_replications=3, master_seed=7,
+                                 max_workers=1, cache=cache)
+        assert (cache.hits, cache.misses) == (6, 0)
+        # A different seed or transition matrix is a different replication
+        run_scenarios(RIDE_SPECS, TRANSITION_MATRIX, scenarios[:1], master_seed=8, max_workers=1, cache=cache)
+        changed = TRANSITION_MATRIX.copy()
+        changed[0] = [0, 0.4, 0.3, 0.3, 0.0]
+        run_scenarios(RIDE_SPECS, changed, scenarios[:1], master_seed=7, max_workers=1, cache=cache)
+        assert (cache.hits, cache.misses, len(cache)) == (6, 2, 8)
+    assert first == replayed == expected
+
+    # The least recently used replications are evicted beyond max_bytes
+    with ResultCache(directory) as cache:
+        n_bytes = cache.n_bytes
+        oldest = cache.key((RIDE_SPECS, 0.5, TRANSITION_MATRIX, 10, np.random.SeedSequence(7, spawn_key=(0, 0)), False))
+    with ResultCache(directory, max_bytes=n_bytes - 1) as cache:
+        assert len(cache) == 7 and oldest not in cache and cache.n_bytes < n_bytes
+    # Results of another simulator version are discarded, but no other file is touched
+    (tmp_path / "cache" / "my_results.npz").write_bytes(b"not a replication")
+    with ResultCache(directory, version="another version") as cache:
+        assert len(cache) == 0
+    assert (tmp_path / "cache" / "my_results.npz").exists()
+    # A directory of other files is not taken for a store
+    (tmp_path / "project").mkdir()
+    (tmp_path / "project" / ".park_model.npz").write_bytes(b"")
+    with pytest.raises(ValueError):
+        ResultCache(str(tmp_path / "project"))
+
+    # Two processes sharing a store: the last index written still lists what the other one stored
+    first_store, second_store = ResultCache(directory), ResultCache(directory)
+    for key in range(4):
+        (first_store if key % 2 else second_store).put(f"{key:064x}", [(1, 2, 0.5, 1.0)])
+    second_store.flush()
+    first_store.flush()
+    with ResultCache(directory) as cache:
+        assert len(cache) == 4
+        n_bytes = cache.n_bytes
+    with ResultCache(directory, max_bytes=n_bytes // 2) as cache:
+        assert cache.n_bytes <= n_bytes // 2 and len(os.listdir(directory)) == len(cache) + 2  # index and my_results
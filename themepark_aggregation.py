@@ -0,0 +1,424 @@
+import csv
+import math
+from statistics import NormalDist
+
+# The per-customer metrics summarised for each day
+METRICS = ["n_rides", "wait_time", "ride_time"]
+
+DAYS_IN_ORDER = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def t_quantile(probability, df):
+    """
+    Returns the quantile of Student's t distribution, exactly for 1 and 2 degrees of freedom and otherwise
+    by Newton's method on the distribution function, started from a Cornish-Fisher expansion around the 
+    normal quantile. The result is accurate to about 1e-12, as the expansion alone is not for small df 
+    (e.g. 3.1786 instead of 3.1824 for the 97.5% quantile with 3 degrees of freedom).
+
+    Parameters:
+    - probability (float): The cumulative probability, strictly between 0 and 1.
+    - df (int or float): The degrees of freedom. Must be positive.
+
+    Returns:
+    float: the quantile.
+    """
+    if df == 1:
+        return math.tan(math.pi * (probability - 0.5))
+    if df == 2:
+        return (2 * probability - 1) / math.sqrt(2 * probability * (1 - probability))
+    z = NormalDist().inv_cdf(probability)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    t = z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+    log_density_constant = math.lgamma((df + 1) / 2) - math.lgamma(df / 2) - 0.5 * math.log(df * math.pi)
+    for _ in range(50):
+        density = math.exp(log_density_constant - (df + 1) / 2 * math.log1p(t * t / df))
+        step = (_t_cdf(t, df) - probability) / density
+        t -= step
+        if abs(step) <= 1e-13 * max(1.0, abs(t)):
+            break
+    return t
+
+
+def _t_cdf(t, df):
+    """Returns the distribution function of Student's t distribution with df degrees of freedom at t."""
+    tail = 0.5 * _incomplete_beta(df / 2, 0.5, df / (df + t * t))
+    return 1 - tail if t > 0 else tail
+
+
+def _incomplete_beta(a, b, x):
+    """Returns the regularised incomplete beta function I_x(a, b), from its continued fraction (Lentz's method)."""
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):  # The continued fraction converges quickly on the other side only
+        return 1 - _incomplete_beta(b, a, 1 - x)
+    tiny = 1e-300
+    front = math.exp(math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) + a * math.log(x) + b * math.log1p(-x)) / a
+    c, d = 1.0, 0.0
+    fraction = 1.0
+    for m in range(200):
+        # The coefficients 1, d1, d2, ... of the fraction 1 / (1 + d1 / (1 + d2 / ...)), two at a time
+        even = m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m)) if m else 1.0
+        odd = -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))
+        for numerator in (even, odd):
+            d = 1 + numerator * d
+            d = 1 / (d if abs(d) > tiny else tiny)
+            c = 1 + numerator / c
+            c = c if abs(c) > tiny else tiny
+            fraction *= c * d
+        if abs(c * d - 1) < 1e-15:
+            break
+    return front * (fraction - 1)
+
+
+class RunningStats:
+    """
+    Count, mean and variance of a stream of numbers, updated one value at a time with Welford's method.
+    Two RunningStats can be merged, e.g. those of parallel workers, with the same result as a single stream.
+
+    Attributes:
+    - count (int): The number of values.
+    - mean (float): Their mean, nan if there are none.
+    - variance (float): Their sample variance, nan if there are fewer than two.
+    - minimum, maximum (float): The smallest and largest values.
+    """
+    def __init__(self):
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0  # Sum of squared deviations from the mean
+        self._minimum = math.inf
+        self._maximum = -math.inf
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean if self._count else math.nan
+
+    @property
+    def variance(self):
+        return self._m2 / (self._count - 1) if self._count > 1 else math.nan
+
+    @property
+    def minimum(self):
+        return self._minimum
+
+    @property
+    def maximum(self):
+        return self._maximum
+
+    def update(self, value):
+        """Adds one value."""
+        self._count += 1
+        delta = value - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (value - self._mean)
+        if value < self._minimum:
+            self._minimum = value
+        if value > self._maximum:
+            self._maximum = value
+
+    def merge(self, other):
+        """Adds all the values summarised by another RunningStats (Chan et al.'s parallel formula)."""
+        if not other._count:
+            return
+        count = self._count + other._count
+        delta = other._mean - self._mean
+        self._mean += delta * other._count / count
+        self._m2 += other._m2 + delta * delta * self._count * other._count / count
+        self._count = count
+        self._minimum = min(self._minimum, other._minimum)
+        self._maximum = max(self._maximum, other._maximum)
+
+    def confidence_interval(self, confidence=0.95):
+        """
+        Returns the Student t confidence interval of the mean.
+
+        Parameter:
+        confidence (float): The confidence level, strictly between 0 and 1.
+
+        Returns:
+        tuple (lower, upper): nan bounds if there are fewer than two values.
+        """
+        if self._count < 2:
+            return (math.nan, math.nan)
+        half_width = t_quantile(0.5 + confidence / 2, self._count - 1) * math.sqrt(self.variance / self._count)
+        return (self._mean - half_width, self._mean + half_width)
+
+
+class TDigest:
+    """
+    Quantile sketch of a stream of numbers (Dunning's merging t-digest).
+    Values are summarised by at most about `compression` weighted centroids, which are small near the
+    extremes so that tail quantiles stay accurate. Two digests can be merged.
+
+    Attributes:
+    - compression (int): Controls the number of centroids, and so the size and accuracy of the sketch.
+    - count (int): The number of values.
+    """
+    def __init__(self, compression=100):
+        self._compression = compression
+        self._means = []
+        self._weights = []
+        self._buffer = []  # (value, weight) pairs not yet merged into the centroids
+        self._count = 0
+        self._minimum = math.inf
+        self._maximum = -math.inf
+
+    @property
+    def compression(self):
+        return self._compression
+
+    @property
+    def count(self):
+        return self._count
+
+    def update(self, value, weight=1.0):
+        """Adds one value."""
+        self._buffer.append((value, weight))
+        self._count += weight
+        if value < self._minimum:
+            self._minimum = value
+        if value > self._maximum:
+            self._maximum = value
+        if len(self._buffer) >= 5 * self._compression:
+            self._compress()
+
+    def merge(self, other):
+        """Adds all the values summarised by another TDigest."""
+        self._buffer.extend(zip(other._means, other._weights))
+        self._buffer.extend(other._buffer)
+        self._count += other._count
+        self._minimum = min(self._minimum, other._minimum)
+        self._maximum = max(self._maximum, other._maximum)
+        self._compress()
+
+    def _q_limit(self, q):
+        """Returns the largest quantile a centroid starting at quantile q may reach under the arcsine scale function."""
+        k = self._compression / (2 * math.pi) * math.asin(2 * q - 1) + 1
+        if k >= self._compression / 4:
+            return 1.0
+        return (math.sin(2 * math.pi * k / self._compression) + 1) / 2
+
+    def _compress(self):
+        """Merges the buffered values into the centroids."""
+        if not self._buffer:
+            return
+        items = sorted(list(zip(self._means, self._weights)) + self._buffer)
+        total = sum(weight for _, weight in items)
+        means, weights = [], []
+        cumulative = 0.0
+        q_limit = self._q_limit(0.0)
+        mean, weight = items[0]
+        for next_mean, next_weight in items[1:]:
+            if (cumulative + weight + next_weight) / total <= q_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                cumulative += weight
+                q_limit = self._q_limit(cumulative / total)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self._means, self._weights, self._buffer = means, weights, []
+
+    def quantile(self, q):
+        """
+        Estimates a quantile, interpolating linearly between the centroids.
+
+        Parameter:
+        q (float): The cumulative probability, between 0 and 1.
+
+        Returns:
+        float: the estimate, nan if no value was added.
+        """
+        self._compress()
+        if not self._means:
+            return math.nan
+        if len(self._means) == 1:
+            return self._means[0]
+        target = q * self._count
+        # Interpolate between the minimum, the centres of the centroids and the maximum
+        left_position, left_value = 0.0, self._minimum
+        cumulative = 0.0
+        for mean, weight in zip(self._means, self._weights):
+            centre = cumulative + weight / 2
+            if target <= centre:
+                return _interpolate(target, left_position, left_value, centre, mean)
+            left_position, left_value = centre, mean
+            cumulative += weight
+        return _interpolate(target, left_position, left_value, self._count, self._maximum)
+
+
+def _interpolate(x, x0, y0, x1, y1):
+    """Returns the value at x of the line through (x0, y0) and (x1, y1)."""
+    if x1 <= x0:
+        return y1
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+
+
+class GroupSummary:
+    """
+    Streaming summary of the customers of one group (e.g. one day of one week): a RunningStats
+    and a TDigest for each metric in METRICS.
+
+    Attributes:
+    - stats (dict): RunningStats of each metric.
+    - digests (dict): TDigest of each metric.
+    - n_customers (int): The number of customers.
+    """
+    def __init__(self, compression=100):
+        self._stats = {metric: RunningStats() for metric in METRICS}
+        self._digests = {metric: TDigest(compression) for metric in METRICS}
+
+    @property
+    def stats(self):
+        return self._stats
+
+    @property
+    def digests(self):
+        return self._digests
+
+    @property
+    def n_customers(self):
+        return self._stats[METRICS[0]].count
+
+    def update(self, values):
+        """Adds one customer, given as a sequence of the values of METRICS."""
+        for metric, value in zip(METRICS, values):
+            self._stats[metric].update(value)
+            self._digests[metric].update(value)
+
+    def merge(self, other):
+        """Adds the customers summarised by another GroupSummary."""
+        for metric in METRICS:
+            self._stats[metric].merge(other._stats[metric])
+            self._digests[metric].merge(other._digests[metric])
+
+
+class SummaryAccumulator:
+    """
+    Aggregates customer rows of simulations_output.csv by (day, week) without keeping the rows.
+    It can be fed while the simulation runs, as the sink of themepark_runner.run_scenarios or through
+    callback() as the sink of ThemePark.simulate, or from a CSV file with update_from_csv.
+    Accumulators of parallel workers can be combined with merge.
+
+    Attributes:
+    - groups (dict): GroupSummary of each (day, week).
+    """
+    def __init__(self, compression=100):
+        self._compression = compression
+        self._groups = {}
+
+    @property
+    def groups(self):
+        return self._groups
+
+    def _group(self, day, week):
+        group = self._groups.get((day, week))
+        if group is None:
+            group = self._groups[(day, week)] = GroupSummary(self._compression)
+        return group
+
+    def update(self, day, week, n_rides, wait_time, ride_time):
+        """Adds one customer of the given day and week."""
+        self._group(day, week).update((n_rides, wait_time, ride_time))
+
+    def write_row(self, row):
+        """Adds one row with the columns of themepark_sinks.RESULT_COLUMNS, so the accumulator can be used as a sink."""
+        customer_id, n_rides, wait_time, ride_time, arrival_rate, day, week = row[:7]
+        self._group(day, week).update((n_rides, wait_time, ride_time))
+
+    def callback(self, day, week):
+        """Returns a function to pass as the sink of ThemePark.simulate, adding each customer to (day, week)."""
+        group = self._group(day, week)
+        return lambda c: group.update((len(c.path), sum(c.wait_times), sum(c.ride_times)))
+
+    def close(self):
+        """Does nothing: an accumulator holds no file."""
+
+    def update_from_csv(self, path):
+        """
+        Adds every row of a CSV file with the columns of simulations_output.csv, reading it one row at a time.
+
+        Parameter:
+        path (str): The CSV file.
+        """
+        with open(path, newline="") as file:
+            for row in csv.DictReader(file):
+                self._group(row["day"], int(row["week"])).update(
+                    (int(row["n_rides"]), float(row["wait_time"]), float(row["ride_time"])))
+
+    def merge(self, other):
+        """Adds the groups of another SummaryAccumulator."""
+        for (day, week), group in other._groups.items():
+            self._group(day, week).merge(group)
+
+    def by_day(self, days=DAYS_IN_ORDER):
+        """
+        Merges the groups of every week for each day.
+
+        Parameter:
+        days (list of str): The days to include, in order.
+
+        Returns:
+        dict: GroupSummary of each day that has customers, in the order of days.
+        """
+        summaries = {}
+        for day in days:
+            summary = GroupSummary(self._compression)
+            for (group_day, week), group in self._groups.items():
+                if group_day == day:
+                    summary.merge(group)
+            if summary.n_customers:
+                summaries[day] = summary
+        return summaries
+
+    def summary_rows(self, days=DAYS_IN_ORDER):
+        """
+        Returns the rows of summary_output.csv: for each day, the total number of customers over all weeks
+        and the mean rides, wait time and ride time per customer.
+        """
+        return [(day, summary.n_customers, summary.stats["n_rides"].mean, summary.stats["wait_time"].mean,
+                 summary.stats["ride_time"].mean)
+                for day, summary in self.by_day(days).items()]
+
+    def confidence_rows(self, days=DAYS_IN_ORDER, confidence=0.95):
+        """
+        Returns, for each day and metric, the mean with its confidence interval, the standard deviation
+        and the median and 90th percentile estimated by the t-digest.
+        """
+        rows = []
+        for day, summary in self.by_day(days).items():
+            for metric in METRICS:
+                stats = summary.stats[metric]
+                lower, upper = stats.confidence_interval(confidence)
+                digest = summary.digests[metric]
+                rows.append((day, metric, stats.mean, math.sqrt(stats.variance), lower, upper,
+                             digest.quantile(0.5), digest.quantile(0.9)))
+        return rows
+
+    def write_summary(self, path, days=DAYS_IN_ORDER):
+        """Writes summary_rows to a CSV file with the header of summary_output.csv."""
+        _write_csv(path, ["Day", "Total Customers", "Rides Per Customer", "Mean Wait Time", "Mean Ride Time"],
+                   self.summary_rows(days))
+
+    def write_confidence_intervals(self, path, days=DAYS_IN_ORDER, confidence=0.95):
+        """Writes confidence_rows to a CSV file."""
+        _write_csv(path, ["Day", "Metric", "Mean", "Std", "CI Lower", "CI Upper", "Median", "P90"],
+                   self.confidence_rows(days, confidence))
+
+
+def _write_csv(path, header, rows):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
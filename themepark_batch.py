@@ -0,0 +1,238 @@
+import numpy as np
+from Themepark_classes import SparseTransitions, ThemePark
+
+
+class BatchThemePark:
+    """
+    Simulates many independent days of the theme park at once.
+    Follows the same model as ThemePark.simulate, but the n_replications days advance in lockstep:
+    each step processes the next event of every unfinished replication with NumPy array operations,
+    and all state (event calendars, ride queues, customer records) lives in preallocated arrays
+    that double in size when full.
+
+    Attributes:
+    - rides (list): an ordered collection of Ride instances in increasing order of ride_id.
+    - arrival_rate (float): The rate at which customers arrive at the park.
+    - transition_matrix (numpy.ndarray or SparseTransitions): Square matrix representing ride transition probabilities.
+    - n_replications (int): The number of independent days simulated together.
+    """
+
+    def __init__(self, rides, arrival_rate, transition_matrix, n_replications, rng=None):
+        """
+        Initialises the batch simulation with the same inputs as ThemePark and a number of replications.
+
+        Parameters:
+        - rides (list of Ride): the rides of the park, with ride_ids from 1 to len(rides). Only their ride_rate is used.
+        - arrival_rate (int or float): The rate at which customers arrive at the park. Must be positive.
+        - transition_matrix (numpy.ndarray or SparseTransitions): Square matrix representing ride transition 
+            probabilities. A SparseTransitions is expanded to a dense matrix.
+        - n_replications (int): The number of independent days to simulate. Must be positive.
+        - rng (numpy.random.Generator, int or None): The generator, or a seed for one, used for all draws.
+
+        Raises ValueError if the inputs would be rejected by ThemePark, arrival_rate is an ArrivalSchedule or 
+        n_replications is not a positive integer.
+        """
+        # Let ThemePark validate the rides, arrival rate and transition matrix
+        park = ThemePark(rides, arrival_rate, transition_matrix)
+        if park.arrival_schedule is not None:
+            raise ValueError("BatchThemePark needs a constant arrival rate, not an ArrivalSchedule.")
+        if not isinstance(n_replications, int) or n_replications <= 0:
+            raise ValueError("n_replications must be a positive integer.")
+        self._rides = rides
+        self._arrival_rate = park.arrival_rate
+        self._transition_matrix = transition_matrix
+        self._n_replications = n_replications
+        self._rng = np.random.default_rng(rng)
+
+        # Mean ride time indexed by ride_id (index 0, the arrival, is unused)
+        rides_by_id = sorted(rides, key=lambda ride: ride.ride_id)
+        self._mean_ride_times = np.array([np.inf] + [1.0 / ride.ride_rate for ride in rides_by_id])
+        if isinstance(transition_matrix, SparseTransitions):
+            transition_matrix = transition_matrix.to_dense()
+        self._cumulative = np.cumsum(np.asarray(transition_matrix, dtype=float), axis=1)
+        self._cumulative[:, -1] = 1.0  # Guard against rounding errors in the row sums
+
+    @property
+    def rides(self):
+        return self._rides
+
+    @property
+    def arrival_rate(self):
+        return self._arrival_rate
+
+    @property
+    def transition_matrix(self):
+        return self._transition_matrix
+
+    @property
+    def n_replications(self):
+        return self._n_replications
+
+    def _route(self, ride_ids):
+        """Draws the next ride (or exit) for each current ride_id in the array ride_ids."""
+        uniforms = self._rng.random(len(ride_ids))
+        next_ride_ids = (self._cumulative[ride_ids] <= uniforms[:, None]).sum(axis=1)
+        return np.minimum(next_ride_ids, self._cumulative.shape[1] - 1)
+
+    def simulate(self, max_time):
+        """
+        Simulates n_replications independent days of length max_time.
+
+        Parameter:
+        max_time (float): The maximum simulation time of each day, as in ThemePark.simulate.
+
+        Returns:
+        dict of numpy.ndarray: one element per customer of every replication, ordered by replication
+        then customer_id, with the keys 'replication', 'customer_id', 'arrival_time', 'n_rides',
+        'wait_time' and 'ride_time'.
+        """
+        n_rides = len(self._rides)
+        n_reps = self._n_replications
+        state = _BatchState(n_reps, n_rides)
+        all_reps = np.arange(n_reps)
+        first_arrivals = self._rng.exponential(1.0 / self._arrival_rate, n_reps)
+        state.push(all_reps, first_arrivals, np.zeros(n_reps, dtype=np.int64))
+        now = np.zeros(n_reps)
+
+        while True:
+            # Pop the earliest event of every replication that is still running
+            slots = state.event_times.argmin(axis=1)
+            times = state.event_times[all_reps, slots]
+            running = (now < max_time) & np.isfinite(times)
+            if not running.any():
+                break
+            reps = np.flatnonzero(running)
+            slots = slots[reps]
+            times = times[reps]
+            ride_ids = state.event_rides[reps, slots]
+            state.event_times[reps, slots] = np.inf
+            now[reps] = times
+
+            # New customer arrivals
+            arriving = ride_ids == 0
+            a_reps = reps[arriving]
+            a_times = times[arriving]
+            if len(a_reps):
+                customer_ids = state.new_customers(a_reps, a_times)
+                next_ride_ids = self._route(np.zeros(len(a_reps), dtype=np.int64))
+                go = (next_ride_ids >= 1) & (next_ride_ids <= n_rides)
+                state.enqueue(a_reps[go], next_ride_ids[go], customer_ids[go], a_times[go])
+                state.push(a_reps[go], a_times[go], next_ride_ids[go])
+                next_arrivals = a_times + self._rng.exponential(1.0 / self._arrival_rate, len(a_reps))
+                state.push(a_reps, next_arrivals, np.zeros(len(a_reps), dtype=np.int64))
+
+            # Customers starting a ride
+            r_reps = reps[~arriving]
+            if len(r_reps):
+                r_times = times[~arriving]
+                r_ride_ids = ride_ids[~arriving]
+                customer_ids, entry_times = state.dequeue(r_reps, r_ride_ids)
+                completion_times = r_times + self._rng.exponential(self._mean_ride_times[r_ride_ids])
+                wait_times = np.where(r_times < entry_times, 0.0, r_times - entry_times)
+                state.n_rides[r_reps, customer_ids] += 1
+                state.wait_times[r_reps, customer_ids] += wait_times
+                state.ride_times[r_reps, customer_ids] += completion_times - r_times
+
+                # Route to the next ride if it can be completed within the remaining time
+                next_ride_ids = self._route(r_ride_ids)
+                go = np.flatnonzero((next_ride_ids >= 1) & (next_ride_ids <= n_rides))
+                expected_ride_times = self._rng.exponential(self._mean_ride_times[next_ride_ids[go]])
+                go = go[completion_times[go] + expected_ride_times <= max_time]
+                state.enqueue(r_reps[go], next_ride_ids[go], customer_ids[go], completion_times[go])
+                state.push(r_reps[go], completion_times[go], next_ride_ids[go])
+
+        return state.results()
+
+
+class _BatchState:
+    """
+    Array storage of BatchThemePark.simulate. Row r of every array belongs to replication r;
+    a step handles at most one event per replication, so rows are never repeated in one update.
+    """
+
+    def __init__(self, n_reps, n_rides, capacity=8):
+        self.event_times = np.full((n_reps, capacity), np.inf)
+        self.event_rides = np.zeros((n_reps, capacity), dtype=np.int64)
+
+        # Circular FIFO queue of (customer index, queue entry time) per replication and ride_id
+        self.queue_customers = np.zeros((n_reps, n_rides + 1, capacity), dtype=np.int64)
+        self.queue_entry_times = np.zeros((n_reps, n_rides + 1, capacity))
+        self.queue_heads = np.zeros((n_reps, n_rides + 1), dtype=np.int64)
+        self.queue_lengths = np.zeros((n_reps, n_rides + 1), dtype=np.int64)
+
+        self.n_customers = np.zeros(n_reps, dtype=np.int64)
+        self.arrival_times = np.zeros((n_reps, capacity))
+        self.n_rides = np.zeros((n_reps, capacity), dtype=np.int64)
+        self.wait_times = np.zeros((n_reps, capacity))
+        self.ride_times = np.zeros((n_reps, capacity))
+
+    def push(self, reps, times, ride_ids):
+        """Schedules one event in each replication of reps, in the first free slot of its calendar."""
+        if not len(reps):
+            return
+        slots = np.isinf(self.event_times[reps]).argmax(axis=1)
+        if not np.isinf(self.event_times[reps, slots]).all():
+            self.event_times = _grow(self.event_times, np.inf)
+            self.event_rides = _grow(self.event_rides, 0)
+            slots = np.isinf(self.event_times[reps]).argmax(axis=1)
+        self.event_times[reps, slots] = times
+        self.event_rides[reps, slots] = ride_ids
+
+    def new_customers(self, reps, times):
+        """Records a new customer arriving at each time in each replication of reps and returns their indices."""
+        customer_ids = self.n_customers[reps]
+        if customer_ids.max() >= self.arrival_times.shape[1]:
+            self.arrival_times = _grow(self.arrival_times, 0.0)
+            self.n_rides = _grow(self.n_rides, 0)
+            self.wait_times = _grow(self.wait_times, 0.0)
+            self.ride_times = _grow(self.ride_times, 0.0)
+        self.arrival_times[reps, customer_ids] = times
+        self.n_customers[reps] += 1
+        return customer_ids
+
+    def enqueue(self, reps, ride_ids, customer_ids, entry_times):
+        """Appends each customer to the back of the queue of the ride ride_ids[i] in replication reps[i]."""
+        if not len(reps):
+            return
+        capacity = self.queue_customers.shape[2]
+        if self.queue_lengths[reps, ride_ids].max() == capacity:
+            self._grow_queues()
+            capacity = self.queue_customers.shape[2]
+        positions = (self.queue_heads[reps, ride_ids] + self.queue_lengths[reps, ride_ids]) % capacity
+        self.queue_customers[reps, ride_ids, positions] = customer_ids
+        self.queue_entry_times[reps, ride_ids, positions] = entry_times
+        self.queue_lengths[reps, ride_ids] += 1
+
+    def dequeue(self, reps, ride_ids):
+        """Removes the customer at the front of each queue and returns their indices and queue entry times."""
+        heads = self.queue_heads[reps, ride_ids]
+        customer_ids = self.queue_customers[reps, ride_ids, heads]
+        entry_times = self.queue_entry_times[reps, ride_ids, heads]
+        self.queue_heads[reps, ride_ids] = (heads + 1) % self.queue_customers.shape[2]
+        self.queue_lengths[reps, ride_ids] -= 1
+        return customer_ids, entry_times
+
+    def _grow_queues(self):
+        """Doubles the capacity of every ride queue, moving each queue's front to position 0."""
+        capacity = self.queue_customers.shape[2]
+        order = (self.queue_heads[:, :, None] + np.arange(capacity)) % capacity
+        self.queue_customers = _grow(np.take_along_axis(self.queue_customers, order, axis=2), 0)
+        self.queue_entry_times = _grow(np.take_along_axis(self.queue_entry_times, order, axis=2), 0.0)
+        self.queue_heads[:] = 0
+
+    def results(self):
+        """Returns the per-customer records of every replication, flattened in order of replication then customer."""
+        recorded = np.arange(self.arrival_times.shape[1]) < self.n_customers[:, None]
+        replications, customer_indices = np.nonzero(recorded)
+        return {"replication": replications,
+                "customer_id": customer_indices + 1,
+                "arrival_time": self.arrival_times[recorded],
+                "n_rides": self.n_rides[recorded],
+                "wait_time": self.wait_times[recorded],
+                "ride_time": self.ride_times[recorded]}
+
+
+def _grow(array, fill_value):
+    """Returns a copy of array with its last axis doubled in length, padded with fill_value."""
+    padding = np.full(array.shape[:-1] + (array.shape[-1],), fill_value, dtype=array.dtype)
+    return np.concatenate([array, padding], axis=-1)
@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import re
+import time
+import numpy as np
+import Themepark_classes
+import themepark_aggregation
+import themepark_runner
+import themepark_sinks
+import themepark_trace
+from Themepark_classes import SparseTransitions
+
+# Bump when a change to the simulation alters its output for a given seed, so that older results are discarded.
+# Edits to the simulator's source files also invalidate the cache, through simulator_version()
+SIMULATOR_VERSION = 1
+
+# Default directory of the result cache
+RESULT_CACHE_PATH = ".themepark_cache"
+
+# The names of the files of a store: the replications, named by their key, the index, and their temporary copies
+_KEY_FILE = re.compile(r"[0-9a-f]{64}\.npz")
+_STORE_FILE = re.compile(r"([0-9a-f]{64}\.npz|index\.json)(\.[0-9]+\.tmp)?")
+
+# The modules whose code determines the rows of a replication: the runner and every module it imports
+_SIMULATOR_MODULES = (Themepark_classes, themepark_aggregation, themepark_runner, themepark_sinks, themepark_trace)
+
+
+def simulator_version():
+    """Returns SIMULATOR_VERSION followed by a hash of the source files of the simulator."""
+    digest = hashlib.sha256()
+    for module in _SIMULATOR_MODULES:
+        with open(module.__file__, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return f"{SIMULATOR_VERSION}-{digest.hexdigest()[:16]}"
+
+
+def replication_key(task, version=None):
+    """
+    Returns the content address of a replication: a SHA-256 hex digest of everything its rows depend on,
+    i.e. the simulator version, the rides, the arrival rate, the transition probabilities, the horizon and the seed.
+
+    Parameters:
+    - task (tuple): (ride_specs, arrival_rate, transition_matrix, max_time, seed, profile) as taken by
+        themepark_runner.run_replication. profile is ignored, as it does not change the rows.
+    - version (str or None): The simulator version. None uses simulator_version().
+
+    Returns:
+    str: the key.
+    """
+    ride_specs, arrival_rate, transition_matrix, max_time, seed, _ = task
+    digest = hashlib.sha256(f"themepark {version or simulator_version()}".encode())
+    rides = [(int(ride_id), str(ride_name), float(ride_rate)) for ride_id, ride_name, ride_rate in ride_specs]
+    digest.update(repr((rides, float(arrival_rate), float(max_time))).encode())
+    if isinstance(transition_matrix, SparseTransitions):
+        digest.update(b"sparse")
+        arrays = (transition_matrix.indptr, transition_matrix.indices, transition_matrix.probabilities)
+    else:
+        digest.update(b"dense")
+        arrays = (np.asarray(transition_matrix.shape), np.asarray(transition_matrix, dtype=float))
+    for values in arrays:
+        digest.update(np.ascontiguousarray(values, dtype=values.dtype.newbyteorder("<")).tobytes())
+    if isinstance(seed, np.random.SeedSequence):
+        seed = ("SeedSequence", seed.entropy, tuple(seed.spawn_key), seed.pool_size)
+    digest.update(repr(seed).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    A content-addressed store of the customer rows of replications on disk, so that a sweep only simulates
+    the replications whose inputs or seed changed since an earlier run. Each replication is stored in its own
+    .npz file named by its replication_key, and an index.json records the size and last use of each file.
+    When the files exceed max_bytes, the least recently used are deleted. The stored replications are deleted
+    when the simulator version differs from the one that wrote the index. Only files named as the store names
+    them are ever deleted, and several processes may share a store: the index is merged with the files on disk
+    and with the index of the other processes whenever it is written, and max_bytes is enforced then.
+
+    Attributes:
+    - directory (str): The directory of the store.
+    - max_bytes (int): The largest total size of the stored files.
+    - version (str): The simulator version of the stored results.
+    - n_bytes (int): The total size of the stored files known to this object.
+    - hits (int): The number of replications loaded from the store by this object.
+    - misses (int): The number of replications simulated and stored by this object.
+    """
+    def __init__(self, directory=RESULT_CACHE_PATH, max_bytes=1 << 30, version=None):
+        """
+        Parameters:
+        - directory (str): The directory of the store, created if needed.
+        - max_bytes (int): The largest total size of the stored files. Must be positive.
+        - version (str or None): The simulator version. None uses simulator_version().
+
+        Raises ValueError if
+        - max_bytes is not a positive integer or
+        - the directory holds files other than those of a store and has no index, e.g. a project directory.
+        """
+        if not isinstance(max_bytes, int) or max_bytes <= 0:
+            raise ValueError("max_bytes must be a positive integer.")
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._version = version or simulator_version()
+        self._hits = 0
+        self._misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._entries = {}  # key -> [n_bytes, time of last use], in order of last use
+        index = self._read_index()
+        if index is None and any(not _STORE_FILE.fullmatch(name) for name in os.listdir(directory)):
+            raise ValueError(f"{directory} holds other files and is not a result cache: give a new or empty directory.")
+        if index is not None and index["version"] != self._version:
+            self._remove_files()  # The results of another simulator version can never be looked up again
+        self._dirty = True
+        self.flush()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def n_bytes(self):
+        return sum(n_bytes for n_bytes, _ in self._entries.values())
+
+    @property
+    def hits(self):
+        return self._hits
+
+    @property
+    def misses(self):
+        return self._misses
+
+    def __len__(self):
+        """Returns the number of stored replications."""
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def key(self, task):
+        """Returns the replication_key of a task for the version of this store."""
+        return replication_key(task, self._version)
+
+    def _path(self, key):
+        return os.path.join(self._directory, f"{key}.npz")
+
+    def _index_path(self):
+        return os.path.join(self._directory, "index.json")
+
+    def _read_index(self):
+        """Returns the index on disk as a dictionary with 'version' and 'entries', or None if it is missing or invalid."""
+        try:
+            with open(self._index_path(), encoding="utf-8") as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(index, dict) or not isinstance(index.get("entries"), dict) or "version" not in index:
+            return None
+        return index
+
+    def _touch(self, key, n_bytes):
+        """Marks a stored replication as the most recently used."""
+        self._entries.pop(key, None)
+        self._entries[key] = [n_bytes, time.time()]
+        self._dirty = True
+
+    def get(self, key):
+        """
+        Loads the rows of a replication.
+
+        Parameter:
+        key (str): The replication_key of the replication.
+
+        Returns:
+        list of tuples or None: (customer_id, n_rides, wait_time, ride_time) for each customer, as returned by
+        themepark_runner.run_replication, or None if the replication is not stored.
+        """
+        if key not in self._entries:
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle=False) as arrays:
+                columns = [arrays[column].tolist() for column in ("customer_id", "n_rides", "wait_time", "ride_time")]
+        except (OSError, ValueError, KeyError):
+            del self._entries[key]  # A file evicted by another process, or damaged, is simulated again
+            self._dirty = True
+            return None
+        self._touch(key, self._entries[key][0])
+        self._hits += 1
+        return list(zip(*columns))
+
+    def put(self, key, rows):
+        """
+        Stores the rows of a replication, then evicts the least recently used replications if the store is too big.
+
+        Parameters:
+        - key (str): The replication_key of the replication.
+        - rows (list of tuples): (customer_id, n_rides, wait_time, ride_time) for each customer.
+        """
+        customer_ids, n_rides, wait_times, ride_times = zip(*rows) if rows else ((), (), (), ())
+        path = self._path(key)
+        # Write to a temporary file first, so that a concurrent job never reads a partial file
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as file:
+            np.savez(file, customer_id=np.array(customer_ids, dtype=np.int64),
+                     n_rides=np.array(n_rides, dtype=np.int64), wait_time=np.array(wait_times, dtype=float),
+                     ride_time=np.array(ride_times, dtype=float))
+        os.replace(temporary_path, path)
+        self._touch(key, os.path.getsize(path))
+        self._misses += 1
+        self._evict()
+
+    def _evict(self):
+        """Deletes the least recently used replications until the store fits in max_bytes."""
+        n_bytes = self.n_bytes
+        while n_bytes > self._max_bytes and self._entries:
+            key = next(iter(self._entries))
+            n_bytes -= self._entries.pop(key)[0]
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass  # Already evicted by another process
+            self._dirty = True
+
+    def _stored_keys(self):
+        """Returns the keys of the replication files in the directory."""
+        return [name[:-len(".npz")] for name in os.listdir(self._directory) if _KEY_FILE.fullmatch(name)]
+
+    def _remove_files(self):
+        """Deletes every stored replication file and the index, leaving any other file alone."""
+        for key in self._stored_keys():
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+        try:
+            os.remove(self._index_path())
+        except FileNotFoundError:
+            pass
+        self._entries.clear()
+        self._dirty = True
+
+    def clear(self):
+        """Deletes every stored replication."""
+        self._remove_files()
+        self.flush()
+
+    def flush(self):
+        """
+        Merges the replications known to this object with the files in the directory and the index on disk,
+        which other processes may have written meanwhile, evicts the least recently used replications beyond
+        max_bytes, then writes the index.
+        """
+        if not self._dirty:
+            return
+        index = self._read_index()
+        on_disk = index["entries"] if index is not None and index["version"] == self._version else {}
+        entries = []
+        for key in self._stored_keys():
+            try:
+                n_bytes = os.path.getsize(self._path(key))
+            except FileNotFoundError:
+                continue  # Evicted by another process meanwhile
+            known = [entry[1] for entry in (self._entries.get(key), on_disk.get(key)) if entry is not None]
+            # A file in neither index, e.g. stored by a process that has not written its index yet, counts as just used
+            last_use = max(known) if known else time.time()
+            entries.append((last_use, key, n_bytes))
+        self._entries = {key: [n_bytes, last_use] for last_use, key, n_bytes in sorted(entries)}
+        self._evict()
+        temporary_path = f"{self._index_path()}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump({"version": self._version, "entries": self._entries}, file)
+        os.replace(temporary_path, self._index_path())
+        self._dirty = False
+
+    def close(self):
+        """Writes the index."""
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
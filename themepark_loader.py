@@ -0,0 +1,241 @@
+import csv
+import hashlib
+import os
+import numpy as np
+from Themepark_classes import Ride, SparseTransitions
+
+# Bump when the parsing or the layout of the cache changes, so that older caches are rebuilt
+LOADER_VERSION = 1
+
+# Default cache of the compiled park model
+MODEL_CACHE_PATH = ".park_model.npz"
+
+
+class ParkModel:
+    """
+    The validated inputs of a simulation study: the rides, the transition probabilities and the daily arrival rates,
+    stored as NumPy arrays so that they can be cached in an .npz file.
+
+    Attributes:
+    - ride_ids (numpy.ndarray): The ride_id of each ride, from 1 in increasing order.
+    - ride_names (numpy.ndarray): The name of each ride.
+    - ride_rates (numpy.ndarray): The service rate of each ride.
+    - transition_matrix (numpy.ndarray or SparseTransitions): The transition probabilities between the entrance,
+        the rides and the exit.
+    - arrival_rates (numpy.ndarray): The arrival rate of each simulated day.
+    - days (numpy.ndarray): The name of each simulated day.
+    - weeks (numpy.ndarray): The week of each simulated day.
+    - ride_specs (list of tuples): (ride_id, ride_name, ride_rate) for each ride, as taken by themepark_runner.
+    - scenarios (list of tuples): (arrival_rate, day, week) for each simulated day, as taken by themepark_runner.
+    """
+    def __init__(self, ride_ids, ride_names, ride_rates, transition_matrix, arrival_rates, days, weeks):
+        """
+        Parameters: the attributes of the model.
+
+        Raises ValueError if
+        - the ride_ids are not 1 to the number of rides in order, or a ride rate is not positive, or
+        - the transitions do not have one state per ride plus the entrance and the exit, or a row is not a
+          probability distribution, or
+        - an arrival rate is not positive, or the days do not have one name, week and arrival rate each.
+        """
+        self._ride_ids = np.asarray(ride_ids, dtype=np.int64)
+        self._ride_names = np.asarray(ride_names, dtype=str)
+        self._ride_rates = np.asarray(ride_rates, dtype=float)
+        n_rides = len(self._ride_ids)
+        if not np.array_equal(self._ride_ids, np.arange(1, n_rides + 1)) or len(self._ride_names) != n_rides:
+            raise ValueError("The ride_ids must run from 1 to the number of rides, in order, each with a name.")
+        if len(self._ride_rates) != n_rides or not np.all(self._ride_rates > 0):
+            raise ValueError("Every ride must have a positive service rate.")
+
+        if transition_matrix.shape != (n_rides + 2, n_rides + 2):
+            raise ValueError(f"The transitions must have {n_rides + 2} states: the entrance, the rides and the exit.")
+        if isinstance(transition_matrix, np.ndarray):
+            transition_matrix = np.asarray(transition_matrix, dtype=float)
+            if np.any(transition_matrix < 0) or not np.allclose(transition_matrix.sum(axis=1), 1.0):
+                raise ValueError("Every row of the transition matrix must be non-negative and sum to 1.")
+        self._transition_matrix = transition_matrix  # SparseTransitions validate themselves
+
+        self._arrival_rates = np.asarray(arrival_rates, dtype=float)
+        self._days = np.asarray(days, dtype=str)
+        self._weeks = np.asarray(weeks, dtype=np.int64)
+        if not len(self._arrival_rates) == len(self._days) == len(self._weeks):
+            raise ValueError("Every day must have an arrival rate, a name and a week.")
+        if not np.all(self._arrival_rates > 0):
+            raise ValueError("Every arrival rate must be positive.")
+
+    @property
+    def ride_ids(self):
+        return self._ride_ids
+
+    @property
+    def ride_names(self):
+        return self._ride_names
+
+    @property
+    def ride_rates(self):
+        return self._ride_rates
+
+    @property
+    def transition_matrix(self):
+        return self._transition_matrix
+
+    @property
+    def arrival_rates(self):
+        return self._arrival_rates
+
+    @property
+    def days(self):
+        return self._days
+
+    @property
+    def weeks(self):
+        return self._weeks
+
+    @property
+    def ride_specs(self):
+        return list(zip(self._ride_ids.tolist(), self._ride_names.tolist(), self._ride_rates.tolist()))
+
+    @property
+    def scenarios(self):
+        return list(zip(self._arrival_rates.tolist(), self._days.tolist(), self._weeks.tolist()))
+
+    def build_rides(self):
+        """Returns a fresh list of the Ride objects of the model."""
+        return [Ride(ride_id, ride_name, ride_rate) for ride_id, ride_name, ride_rate in self.ride_specs]
+
+    def to_arrays(self):
+        """Returns the model as a dictionary of arrays, the contents of its .npz cache."""
+        arrays = {"ride_ids": self._ride_ids, "ride_names": self._ride_names, "ride_rates": self._ride_rates,
+                  "arrival_rates": self._arrival_rates, "days": self._days, "weeks": self._weeks}
+        if isinstance(self._transition_matrix, SparseTransitions):
+            arrays.update(transition_indptr=self._transition_matrix.indptr,
+                          transition_indices=self._transition_matrix.indices,
+                          transition_probabilities=self._transition_matrix.probabilities)
+        else:
+            arrays["transition_matrix"] = self._transition_matrix
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuilds a model from the output of to_arrays, e.g. a loaded .npz file."""
+        if "transition_matrix" in arrays:
+            transition_matrix = arrays["transition_matrix"]
+        else:
+            transition_matrix = SparseTransitions(arrays["transition_indptr"], arrays["transition_indices"],
+                                                  arrays["transition_probabilities"])
+        return cls(arrays["ride_ids"], arrays["ride_names"], arrays["ride_rates"], transition_matrix,
+                   arrays["arrival_rates"], arrays["days"], arrays["weeks"])
+
+    def to_dataframes(self):
+        """
+        Returns the model as the DataFrames pandas.read_csv gives for the input files. Requires pandas,
+        which is only imported here.
+
+        Returns:
+        tuple (ride_info, ride_transitions, arrival_rates) of pandas.DataFrame. A sparse ride_transitions
+        is expanded to a dense matrix.
+        """
+        import pandas as pd
+        ride_info = pd.DataFrame({"ride_id": self._ride_ids, "ride_name": self._ride_names,
+                                  "service_rate": self._ride_rates})
+        matrix = self._transition_matrix
+        if isinstance(matrix, SparseTransitions):
+            matrix = matrix.to_dense()
+        ride_transitions = pd.DataFrame(matrix, columns=[str(state) for state in range(matrix.shape[1])])
+        arrival_rates = pd.DataFrame({"week": self._weeks, "day": self._days, "arrival_rate": self._arrival_rates})
+        return ride_info, ride_transitions, arrival_rates
+
+
+def parse_park_model(ride_info_path="ride_info.csv", transitions_path="ride_transitions.csv",
+                     arrival_rates_path="arrival_rates.csv"):
+    """
+    Reads and validates the input files with the csv module.
+
+    Parameters:
+    - ride_info_path (str): CSV file with the columns ride_id, ride_name and service_rate.
+    - transitions_path (str): CSV file of the transition matrix with a header row, as ride_transitions.csv,
+        or a sparse edge list with the columns from_id, to_id and probability, as ride_transitions_edges.csv.
+    - arrival_rates_path (str): CSV file with the columns week, day and arrival_rate.
+
+    Returns:
+    ParkModel: the model.
+
+    Raises ValueError if a file lacks a column or the values are invalid, as for ParkModel.
+    """
+    ride_info = _read_columns(ride_info_path, ["ride_id", "ride_name", "service_rate"])
+    arrival_rates = _read_columns(arrival_rates_path, ["week", "day", "arrival_rate"])
+    n_states = len(ride_info["ride_id"]) + 2
+    with open(transitions_path, newline="") as file:
+        header = [column.strip() for column in next(csv.reader(file), [])]
+    if header == ["from_id", "to_id", "probability"]:
+        transition_matrix = SparseTransitions.read_csv(transitions_path, n_states=n_states)
+    else:
+        with open(transitions_path, newline="") as file:
+            rows = [row for row in csv.reader(file) if row][1:]  # Skip the header
+        transition_matrix = np.array(rows, dtype=float).reshape(len(rows), -1)
+    return ParkModel(np.array(ride_info["ride_id"], dtype=np.int64), ride_info["ride_name"],
+                     np.array(ride_info["service_rate"], dtype=float), transition_matrix,
+                     np.array(arrival_rates["arrival_rate"], dtype=float), arrival_rates["day"],
+                     np.array(arrival_rates["week"], dtype=np.int64))
+
+
+def load_park_model(ride_info_path="ride_info.csv", transitions_path="ride_transitions.csv",
+                    arrival_rates_path="arrival_rates.csv", cache_path=MODEL_CACHE_PATH):
+    """
+    Returns the park model of the input files, from the compiled .npz cache if the files have not changed
+    since it was written. Otherwise the files are parsed and validated and the cache is rewritten.
+
+    Parameters:
+    - ride_info_path, transitions_path, arrival_rates_path (str): The input files, as for parse_park_model.
+    - cache_path (str or None): The cache file. None neither reads nor writes a cache.
+
+    Returns:
+    ParkModel: the model.
+    """
+    if cache_path is None:
+        return parse_park_model(ride_info_path, transitions_path, arrival_rates_path)
+    key = model_key(ride_info_path, transitions_path, arrival_rates_path)
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as arrays:
+                if str(arrays["key"]) == key:
+                    return ParkModel.from_arrays(arrays)
+        except (OSError, ValueError, KeyError):
+            pass  # An unreadable or outdated cache is rebuilt
+    model = parse_park_model(ride_info_path, transitions_path, arrival_rates_path)
+    # Write to a temporary file first, so that a concurrent job never reads a partial cache
+    temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        np.savez(file, key=np.array(key), **model.to_arrays())
+    os.replace(temporary_path, cache_path)
+    return model
+
+
+def model_key(*paths):
+    """Returns a SHA-256 hex digest of the loader version and the contents of the files."""
+    digest = hashlib.sha256(f"themepark_loader {LOADER_VERSION}".encode())
+    for path in paths:
+        with open(path, "rb") as file:
+            digest.update(hashlib.sha256(file.read()).digest())
+    return digest.hexdigest()
+
+
+def _read_columns(path, columns):
+    """
+    Reads the given columns of a CSV file with a header row.
+
+    Returns:
+    dict of lists of str: the values of each column, in the order of the rows.
+
+    Raises ValueError if a column is missing.
+    """
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        missing = [column for column in columns if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"{path} has no column {missing}.")
+        values = {column: [] for column in columns}
+        for row in reader:
+            for column in columns:
+                values[column].append(row[column])
+    return values
@@ -0,0 +1,319 @@
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from Themepark_classes import ArrivalSchedule, Ride, ThemePark
+from themepark_aggregation import RunningStats, t_quantile
+from themepark_sinks import customer_summary
+
+# The per-replication metrics that run_adaptive can target
+ADAPTIVE_METRICS = ("mean_wait", "rides_per_guest", "n_customers")
+
+
+def build_rides(ride_specs):
+    """
+    Builds a fresh list of Ride objects, so that no queue or counter is shared between parks.
+
+    Parameter:
+    ride_specs (list of tuples): (ride_id, ride_name, ride_rate) for each ride.
+
+    Returns:
+    list of Ride: the rides in the order given.
+    """
+    return [Ride(int(ride_id), str(ride_name), float(ride_rate)) for ride_id, ride_name, ride_rate in ride_specs]
+
+
+def replication_seed(master_seed, scenario_index, replication):
+    """
+    Returns the seed of one replication of one scenario. The seed only depends on its position
+    in the study, not on how many replications or workers there are.
+
+    Parameters:
+    - master_seed (int): The seed of the whole study.
+    - scenario_index (int): The position of the scenario in the study.
+    - replication (int): The number of the replication within the scenario, starting at 0.
+
+    Returns:
+    numpy.random.SeedSequence: an independent seed stream for the replication.
+    """
+    return np.random.SeedSequence(master_seed, spawn_key=(scenario_index, replication))
+
+
+def run_replication(task):
+    """
+    Simulates one day of the park with freshly built rides. Runs in a worker process.
+
+    Parameter:
+    task (tuple): (ride_specs, arrival_rate, transition_matrix, max_time, seed, profile) where seed is a
+        numpy.random.SeedSequence and profile is passed on to ThemePark.simulate.
+
+    Returns:
+    tuple (rows, stats):
+    - rows (list of tuples): (customer_id, n_rides, wait_time, ride_time) for each customer, in order of arrival.
+    - stats (dict or None): SimulationStats.to_dict() of the run if profile is True, else None.
+    """
+    ride_specs, arrival_rate, transition_matrix, max_time, seed, profile = task
+    park = ThemePark(build_rides(ride_specs), float(arrival_rate), transition_matrix, rng=seed)
+    rows = []
+    # Summarise customers as they leave rather than keeping them all in the park
+    park.simulate(max_time, sink=lambda customer: rows.append(customer_summary(customer)), profile=profile)
+    return rows, (park.stats.to_dict() if profile else None)
+
+
+def run_scenarios(ride_specs, transition_matrix, scenarios, n_replications=1, max_time=10,
+                  master_seed=0, max_workers=None, sink=None, stats=None, cache=None):
+    """
+    Runs every scenario n_replications times, spreading the replications over a pool of processes.
+    The output for a given master_seed is the same whatever the number of workers.
+
+    Parameters:
+    - ride_specs (list of tuples): (ride_id, ride_name, ride_rate) for each ride.
+    - transition_matrix (numpy.ndarray): Square matrix representing ride transition probabilities.
+    - scenarios (list of tuples): (arrival_rate, day, week) for each simulated day, e.g. the rows of arrival_rates.csv.
+    - n_replications (int): Number of independent replications of each scenario. Must be positive.
+    - max_time (float): The length of each simulated day.
+    - master_seed (int): The seed from which the seed of every replication is derived.
+    - max_workers (int or None): Number of worker processes. None uses all cores, 1 runs in this process.
+    - sink (CustomerSink or None): If given, the rows are written to it as each replication finishes
+        instead of being returned, so memory use does not grow with the length of the study.
+    - stats (list or None): If given, every replication is profiled and a dictionary with its scenario
+        (arrival_rate, day, week), replication number and SimulationStats.to_dict() is appended to it.
+    - cache (themepark_cache.ResultCache or None): If given, replications already in the cache are loaded 
+        instead of simulated, and the others are added to it. Profiled replications are always simulated.
+
+    Returns:
+    list of tuples, or None if sink is given: one row per customer with the columns of 
+    themepark_sinks.RESULT_COLUMNS, followed by the replication number when n_replications is more than 1. 
+    Rows are ordered by scenario, then replication, then customer_id.
+
+    Raises ValueError if n_replications is not a positive integer.
+    """
+    if not isinstance(n_replications, int) or n_replications <= 0:
+        raise ValueError("n_replications must be a positive integer.")
+
+    keys = [(scenario, replication) for scenario in range(len(scenarios)) for replication in range(n_replications)]
+    tasks = [(ride_specs, scenarios[scenario][0], transition_matrix, max_time,
+              replication_seed(master_seed, scenario, replication), stats is not None)
+             for scenario, replication in keys]
+
+    results = []
+    write_row = sink.write_row if sink is not None else results.append
+    if max_workers == 1:
+        _merge_outputs(keys, _run_tasks(tasks, None, max_workers, cache), scenarios, n_replications, write_row, stats)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            outputs = _run_tasks(tasks, executor, max_workers, cache)
+            _merge_outputs(keys, outputs, scenarios, n_replications, write_row, stats)
+    return results if sink is None else None
+
+
+def _run_tasks(tasks, executor, max_workers, cache=None):
+    """
+    Yields the output of run_replication for each task, in the order of the tasks, running them in this
+    process if executor is None. With a cache, the replications it holds are loaded instead of simulated, 
+    except when profiled, and the others are stored in it as they finish.
+    """
+    keys = [cache.key(task) for task in tasks] if cache is not None else [None] * len(tasks)
+    cached = [key is not None and not task[5] and key in cache for task, key in zip(tasks, keys)]
+    missing = [task for task, hit in zip(tasks, cached) if not hit]
+    if executor is None:
+        outputs = map(run_replication, missing)
+    else:
+        # map() returns the outputs in the order of the tasks, whichever worker finishes first
+        chunksize = max(1, len(missing) // (4 * (max_workers or os.cpu_count() or 1)))
+        outputs = executor.map(run_replication, missing, chunksize=chunksize)
+    try:
+        for task, key, hit in zip(tasks, keys, cached):
+            rows = cache.get(key) if hit else None
+            if rows is not None:
+                yield rows, None
+                continue
+            if hit:  # Evicted since it was found, to make room for the replications stored meanwhile
+                output = run_replication(task)
+            else:
+                output = next(outputs)
+            if cache is not None:
+                cache.put(key, output[0])
+            yield output
+    finally:
+        if cache is not None:
+            cache.flush()
+
+
+def _merge_outputs(keys, outputs, scenarios, n_replications, write_row, stats):
+    """Adds the scenario columns (and the replication number if there are several) to each customer row."""
+    for (scenario, replication), (customers, run_stats) in zip(keys, outputs):
+        arrival_rate, day, week = scenarios[scenario]
+        if stats is not None:
+            stats.append({"arrival_rate": float(arrival_rate), "day": day, "week": int(week),
+                          "replication": replication, **run_stats})
+        extra = (float(arrival_rate), day, int(week)) + ((replication,) if n_replications > 1 else ())
+        for customer_row in customers:
+            write_row(customer_row + extra)
+
+
+def run_season(ride_specs, transition_matrix, scenarios, day_length=10, master_seed=0, sink=None, stats=None):
+    """
+    Simulates every scenario as consecutive days of one continuous run, with the arrival rate 
+    changing at each day boundary, instead of one cold-started park per day. Customers and queues
+    carry over from one day to the next, and each customer is tagged with the day they arrived on.
+
+    Parameters:
+    - ride_specs (list of tuples): (ride_id, ride_name, ride_rate) for each ride.
+    - transition_matrix (numpy.ndarray): Square matrix representing ride transition probabilities.
+    - scenarios (list of tuples): (arrival_rate, day, week) for each day, in the order they are simulated.
+    - day_length (float): The length of each day.
+    - master_seed (int): The seed of the run.
+    - sink (CustomerSink or None): If given, the rows are written to it instead of being returned.
+    - stats (list or None): If given, the run is profiled and a dictionary with the number of days ('n_days'),
+        day_length and SimulationStats.to_dict() is appended to it.
+
+    Returns:
+    list of tuples, or None if sink is given: one row per customer with the columns of
+    themepark_sinks.RESULT_COLUMNS, ordered by customer_id.
+    """
+    labels = [{"arrival_rate": float(arrival_rate), "day": day, "week": int(week)}
+              for arrival_rate, day, week in scenarios]
+    schedule = ArrivalSchedule.daily([label["arrival_rate"] for label in labels], day_length, labels)
+    park = ThemePark(build_rides(ride_specs), schedule, transition_matrix, rng=master_seed)
+    rows = []
+    if sink is not None:
+        callback = sink.schedule_callback(schedule)
+    else:
+        extras = [(label["arrival_rate"], label["day"], label["week"]) for label in labels]
+        callback = lambda customer: rows.append(customer_summary(customer) + 
+                                                extras[schedule.segment(customer.arrival_time)])
+    park.simulate(day_length * len(scenarios), sink=callback, profile=stats is not None)
+    if stats is not None:
+        stats.append({"n_days": len(scenarios), "day_length": float(day_length), **park.stats.to_dict()})
+    return rows if sink is None else None
+
+
+def replication_metrics(rows):
+    """
+    Summarises one replication by the metrics of ADAPTIVE_METRICS.
+
+    Parameter:
+    rows (list of tuples): (customer_id, n_rides, wait_time, ride_time) for each customer, as from run_replication.
+
+    Returns:
+    dict: 'mean_wait' and 'rides_per_guest' (0.0 if there are no customers) and 'n_customers'.
+    """
+    n_customers = len(rows)
+    if not n_customers:
+        return {"mean_wait": 0.0, "rides_per_guest": 0.0, "n_customers": 0}
+    return {"mean_wait": sum(row[2] for row in rows) / n_customers,
+            "rides_per_guest": sum(row[1] for row in rows) / n_customers,
+            "n_customers": n_customers}
+
+
+def run_adaptive(ride_specs, transition_matrix, scenarios, relative_precision=0.05, confidence=0.95,
+                 metrics=ADAPTIVE_METRICS, min_replications=5, batch_size=5, max_replications=200, budget=None,
+                 max_time=10, master_seed=0, max_workers=None, sink=None, stats=None, cache=None):
+    """
+    Runs each scenario in batches of replications until the confidence interval of the mean of every target 
+    metric is narrow enough, so that noisy scenarios get more replications than quiet ones.
+    After min_replications, each batch is sized from the current variance to reach the precision, 
+    with at least batch_size replications. Replication r of scenario s uses the same seed as in run_scenarios, 
+    so its output does not depend on when it was run.
+
+    Parameters:
+    - ride_specs, transition_matrix, scenarios, max_time, master_seed, max_workers, stats, cache: as in run_scenarios.
+    - relative_precision (float): The target half-width of each confidence interval, relative to its mean. Must be positive.
+    - confidence (float): The confidence level of the intervals, strictly between 0 and 1.
+    - metrics (tuple of str): The target metrics, among ADAPTIVE_METRICS.
+    - min_replications (int): The number of replications before the precision is first checked. At least 2.
+    - batch_size (int): The smallest number of replications added to an unfinished scenario at a time. Must be positive.
+    - max_replications (int): The largest number of replications of one scenario.
+    - budget (int or None): The largest total number of replications of the study. None for no limit.
+    - sink (CustomerSink or None): If given, the rows are written to it instead of being returned.
+
+    Returns:
+    tuple (rows, report):
+    - rows (list of tuples, or None if sink is given): one row per customer with the columns of
+        themepark_sinks.RESULT_COLUMNS followed by the replication number, ordered by batch, then scenario,
+        then replication.
+    - report (list of dict): for each scenario, its arrival_rate, day and week, the number of replications it 
+        needed ('n_replications'), whether every metric reached the precision ('converged'), and the mean and 
+        confidence interval half-width of each metric ('<metric>_mean' and '<metric>_half_width').
+
+    Raises ValueError if a metric is unknown or the precision, confidence or replication counts are invalid.
+    """
+    if any(metric not in ADAPTIVE_METRICS for metric in metrics):
+        raise ValueError(f"metrics must be among {ADAPTIVE_METRICS}.")
+    if relative_precision <= 0 or not 0 < confidence < 1:
+        raise ValueError("relative_precision must be positive and confidence strictly between 0 and 1.")
+    if not isinstance(min_replications, int) or min_replications < 2 or max_replications < min_replications:
+        raise ValueError("min_replications must be an integer of at least 2 and at most max_replications.")
+    if not isinstance(batch_size, int) or batch_size <= 0:
+        raise ValueError("batch_size must be a positive integer.")
+
+    summaries = [{metric: RunningStats() for metric in metrics} for _ in scenarios]
+    converged = [False] * len(scenarios)
+    remaining_budget = math.inf if budget is None else budget
+    results = []
+    write_row = sink.write_row if sink is not None else results.append
+
+    def next_batch(scenario):
+        """Returns the number of replications to add to a scenario, 0 if it is finished."""
+        n_done = summaries[scenario][metrics[0]].count
+        if n_done < min_replications:
+            wanted = min_replications - n_done
+        else:
+            t = t_quantile(0.5 + confidence / 2, n_done - 1)
+            needed = n_done
+            for running in summaries[scenario].values():
+                target = relative_precision * abs(running.mean)
+                if running.variance == 0:
+                    continue
+                if target == 0:  # A noisy metric with a zero mean never reaches a relative precision
+                    needed = math.inf
+                    break
+                # Replications needed for t * sqrt(variance / n) <= target with the current estimates
+                needed = max(needed, math.ceil(running.variance * (t / target) ** 2))
+            if needed <= n_done:
+                converged[scenario] = True
+                return 0
+            wanted = max(batch_size, needed - n_done)
+        return min(wanted, max_replications - n_done)
+
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+    try:
+        while remaining_budget > 0:
+            keys = []
+            for scenario in range(len(scenarios)):
+                n_new = min(next_batch(scenario), remaining_budget - len(keys))
+                n_done = summaries[scenario][metrics[0]].count
+                keys += [(scenario, replication) for replication in range(n_done, n_done + n_new)]
+            if not keys:
+                break
+            remaining_budget -= len(keys)
+            tasks = [(ride_specs, scenarios[scenario][0], transition_matrix, max_time,
+                      replication_seed(master_seed, scenario, replication), stats is not None)
+                     for scenario, replication in keys]
+            outputs = _run_tasks(tasks, executor, max_workers, cache)
+            for (scenario, replication), (customers, run_stats) in zip(keys, outputs):
+                for metric, value in replication_metrics(customers).items():
+                    if metric in summaries[scenario]:
+                        summaries[scenario][metric].update(value)
+                arrival_rate, day, week = scenarios[scenario]
+                if stats is not None:
+                    stats.append({"arrival_rate": float(arrival_rate), "day": day, "week": int(week),
+                                  "replication": replication, **run_stats})
+                extra = (float(arrival_rate), day, int(week), replication)
+                for customer_row in customers:
+                    write_row(customer_row + extra)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    report = []
+    for (arrival_rate, day, week), summary, done in zip(scenarios, summaries, converged):
+        entry = {"arrival_rate": float(arrival_rate), "day": day, "week": int(week),
+                 "n_replications": summary[metrics[0]].count, "converged": done}
+        for metric, running in summary.items():
+            lower, upper = running.confidence_interval(confidence)
+            entry[f"{metric}_mean"] = running.mean
+            entry[f"{metric}_half_width"] = (upper - lower) / 2
+        report.append(entry)
+    return (results if sink is None else None), report
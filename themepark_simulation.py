@@ -1,42 +1,58 @@
-import pandas as pd
-from Themepark_classes import Ride, ThemePark
+import json
+from themepark_cache import ResultCache
+from themepark_loader import load_park_model
+from themepark_runner import run_adaptive, run_scenarios, run_season
+from themepark_sinks import RESULT_COLUMNS, CSVSink
 
-ride_info = pd.read_csv("ride_info.csv")
-arrival_rates = pd.read_csv("arrival_rates.csv")
-ride_transitions = pd.read_csv("ride_transitions.csv", header=0)  
-transition_matrix = ride_transitions.to_numpy()  # Convert DataFrame to numpy array
+MASTER_SEED = 2024  # Seed of the whole study: the same seed gives the same output whatever the number of workers
+N_REPLICATIONS = 1  # Replications of each day; more than 1 adds a 'replication' column to the output
+MAX_WORKERS = None  # Number of worker processes, None uses every core
+MAX_TIME = 10  # Length of each simulated day
+PROFILE = False  # If True, dumps the event counts and timers of every replication (or of the season) to
+                 # simulation_stats.json
+RELATIVE_PRECISION = None  # If set, e.g. 0.05, replicates each day until the 95% confidence intervals of the mean 
+                           # wait, rides per guest and number of customers are within this fraction of their means
+CONTINUOUS_SEASON = False  # If True, runs all the days back to back in one park instead of one fresh park per day
+TRANSITION_EDGES = None  # If set, e.g. "ride_transitions_edges.csv", reads the transitions from this sparse edge list
+                         # (columns from_id, to_id, probability) instead of the matrix in ride_transitions.csv
+RESULT_CACHE = None  # If set, e.g. ".themepark_cache", reloads the replications already run with the same inputs
+                     # and seed from this directory instead of simulating them again
+RESULT_CACHE_BYTES = 1 << 30  # Size of the result cache beyond which the least recently used results are deleted
 
-# Prepare a list of rides based on ride_info.csv
-rides = []
-for _, row in ride_info.iterrows(): 
-    ride_id = row['ride_id']
-    ride_name = row['ride_name']
-    ride_rate = row['service_rate']
-    rides.append(Ride(ride_id, ride_name, ride_rate))
+if __name__ == "__main__":
+    # Parse and validate the input files, or reload them from the compiled cache if they have not changed
+    model = load_park_model(transitions_path=TRANSITION_EDGES or "ride_transitions.csv")
+    transition_matrix = model.transition_matrix
 
-results = []  # List to store simulation results
+    # Each replication builds its own rides from these specs, so no state leaks between days
+    ride_specs = model.ride_specs
+    scenarios = model.scenarios
+    # The runners write the index of the cache once they have run every replication
+    cache = ResultCache(RESULT_CACHE, RESULT_CACHE_BYTES) if RESULT_CACHE is not None else None
+    stats = [] if PROFILE else None
 
-# Run simulations for each row in arrival_rates
-for index, row in arrival_rates.iterrows():
-    arrival_rate = row['arrival_rate']
-    day = row['day']
-    week = row['week']
-    themepark = ThemePark(rides, arrival_rate, transition_matrix)
-    themepark.simulate(max_time=10)
+    if CONTINUOUS_SEASON:
+        # One run through the whole season, each customer tagged with the day they arrived on
+        with CSVSink("simulations_output.csv") as sink:
+            run_season(ride_specs, transition_matrix, scenarios, day_length=MAX_TIME, master_seed=MASTER_SEED,
+                       sink=sink, stats=stats)
+    elif RELATIVE_PRECISION is not None:
+        with CSVSink("simulations_output.csv", RESULT_COLUMNS + ["replication"]) as sink:
+            _, report = run_adaptive(ride_specs, transition_matrix, scenarios, relative_precision=RELATIVE_PRECISION,
+                                     max_time=MAX_TIME, master_seed=MASTER_SEED, max_workers=MAX_WORKERS, sink=sink,
+                                     stats=stats, cache=cache)
+        for entry in report:
+            status = "" if entry["converged"] else " (replication limit reached)"
+            print(f"{entry['day']} week {entry['week']}: {entry['n_replications']} replications{status}")
+    else:
+        # Run every day of arrival_rates.csv N_REPLICATIONS times in parallel, 
+        # writing the customers to the CSV file in chunks as each day finishes
+        columns = RESULT_COLUMNS + (["replication"] if N_REPLICATIONS > 1 else [])
+        with CSVSink("simulations_output.csv", columns) as sink:
+            run_scenarios(ride_specs, transition_matrix, scenarios, n_replications=N_REPLICATIONS,
+                          max_time=MAX_TIME, master_seed=MASTER_SEED, max_workers=MAX_WORKERS, sink=sink, stats=stats,
+                          cache=cache)
 
-    for customer in themepark.customers:
-        # Create a dictionary, keys are column names, values are the corresponding data for each customer
-        result_row = {
-            'customer_id': customer.customer_id,
-            'n_rides': len(customer.path),
-            'wait_time': sum(customer.wait_times),
-            'ride_time': sum(customer.ride_times),
-            'arrival_rate': arrival_rate,
-            'day': day,
-            'week': week
-        }
-        results.append(result_row)  # results is now a list of dictionaries
-
-# Convert the list results into a pandas dataframe and save it to a CSV file
-results_df = pd.DataFrame(results)
-results_df.to_csv("simulations_output.csv", index=False)
+    if PROFILE:
+        with open("simulation_stats.json", "w") as file:
+            json.dump(stats, file, indent=2)
@@ -0,0 +1,252 @@
+import csv
+import struct
+import numpy as np
+
+# Columns of simulations_output.csv
+RESULT_COLUMNS = ["customer_id", "n_rides", "wait_time", "ride_time", "arrival_rate", "day", "week"]
+
+# Record layout of simulations_output.csv in a .npy file
+RESULT_DTYPE = np.dtype([("customer_id", "<i8"), ("n_rides", "<i8"), ("wait_time", "<f8"), ("ride_time", "<f8"),
+                         ("arrival_rate", "<f8"), ("day", "<U16"), ("week", "<i8")])
+
+
+def customer_summary(customer):
+    """
+    Summarises the visit of a customer as in simulations_output.csv.
+
+    Parameter:
+    customer (Customer): the customer.
+
+    Returns:
+    tuple (customer_id, n_rides, wait_time, ride_time): the totals over the customer's rides.
+    """
+    return (customer.customer_id, len(customer.path), float(sum(customer.wait_times)), float(sum(customer.ride_times)))
+
+
+class CustomerSink:
+    """
+    Base class of the sinks that write customer summaries to a file in chunks while the simulation runs.
+    Rows are buffered and written chunk_size at a time, so memory use does not grow with the number of customers.
+    Subclasses implement _write_chunk and _close_file.
+
+    Attributes:
+    - path (str): The file written to.
+    - columns (list of str): The column names. The first four are those of customer_summary.
+    - chunk_size (int): The number of rows buffered before they are written.
+    - n_rows (int): The number of rows received so far.
+    """
+    def __init__(self, path, columns=RESULT_COLUMNS, chunk_size=10000):
+        """
+        Parameters:
+        - path (str): The file to write to. It is overwritten.
+        - columns (list of str): The column names, starting with customer_id, n_rides, wait_time and ride_time.
+        - chunk_size (int): The number of rows to buffer before writing. Must be positive.
+
+        Raises ValueError if chunk_size is not a positive integer.
+        """
+        if not isinstance(chunk_size, int) or chunk_size <= 0:
+            raise ValueError("chunk_size must be a positive integer.")
+        self._path = path
+        self._columns = list(columns)
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._n_rows = 0
+        self._closed = False
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
+
+    @property
+    def n_rows(self):
+        return self._n_rows
+
+    def write_row(self, row):
+        """
+        Adds one row to the output.
+
+        Parameter:
+        row (tuple): The values of the row, in the order of columns.
+        """
+        self._buffer.append(row)
+        self._n_rows += 1
+        if len(self._buffer) >= self._chunk_size:
+            self.flush()
+
+    def callback(self, **context):
+        """
+        Returns a function to pass as the sink of ThemePark.simulate.
+        It writes the summary of each customer followed by the values of the other columns, taken from context.
+
+        Parameter:
+        context: The value of each column after the first four, e.g. arrival_rate=0.6, day="Monday", week=1.
+
+        Returns:
+        callable: a function taking a Customer.
+
+        Raises ValueError if a column is missing from context.
+        """
+        missing = [column for column in self._columns[4:] if column not in context]
+        if missing:
+            raise ValueError(f"No value given for the columns {missing}.")
+        extra = tuple(context[column] for column in self._columns[4:])
+        return lambda customer: self.write_row(customer_summary(customer) + extra)
+
+    def schedule_callback(self, schedule):
+        """
+        Returns a function to pass as the sink of ThemePark.simulate when the park runs an ArrivalSchedule.
+        It writes the summary of each customer followed by the values of the other columns, taken from the 
+        label of the segment of the schedule in which the customer arrived.
+
+        Parameter:
+        schedule (ArrivalSchedule): The schedule of the park, labelled with a dictionary of the values 
+            of the columns after the first four for each segment, e.g. {"arrival_rate": 0.6, "day": "Monday", "week": 1}.
+
+        Returns:
+        callable: a function taking a Customer.
+
+        Raises ValueError if the schedule has no labels or a column is missing from a label.
+        """
+        if schedule.labels is None:
+            raise ValueError("The schedule has no labels.")
+        extras = []
+        for label in schedule.labels:
+            missing = [column for column in self._columns[4:] if column not in label]
+            if missing:
+                raise ValueError(f"No value given for the columns {missing}.")
+            extras.append(tuple(label[column] for column in self._columns[4:]))
+        return lambda customer: self.write_row(customer_summary(customer) + extras[schedule.segment(customer.arrival_time)])
+
+    def flush(self):
+        """Writes the buffered rows to the file."""
+        if self._buffer:
+            self._write_chunk(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        """Writes the remaining rows and closes the file."""
+        if not self._closed:
+            self.flush()
+            self._close_file()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_chunk(self, rows):
+        raise NotImplementedError
+
+    def _close_file(self):
+        raise NotImplementedError
+
+
+class CSVSink(CustomerSink):
+    """
+    Writes customer summaries to a CSV file with a header row, in the same format as
+    pandas.DataFrame.to_csv(index=False).
+    """
+    def __init__(self, path, columns=RESULT_COLUMNS, chunk_size=10000):
+        super().__init__(path, columns, chunk_size)
+        self._file = open(path, "w", newline="")
+        self._writer = csv.writer(self._file, lineterminator="\n")
+        self._writer.writerow(self._columns)
+
+    def _write_chunk(self, rows):
+        self._writer.writerows(rows)
+
+    def _close_file(self):
+        self._file.close()
+
+
+class ParquetSink(CustomerSink):
+    """
+    Writes customer summaries to a Parquet file, one row group per chunk. Requires pyarrow.
+    """
+    def __init__(self, path, columns=RESULT_COLUMNS, chunk_size=100000):
+        super().__init__(path, columns, chunk_size)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as error:
+            raise ImportError("ParquetSink requires pyarrow, which is not installed.") from error
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self._writer = None  # Created with the schema of the first chunk
+
+    def _write_chunk(self, rows):
+        table = self._pyarrow.Table.from_arrays([self._pyarrow.array(values) for values in zip(*rows)],
+                                                names=self._columns)
+        if self._writer is None:
+            self._writer = self._parquet.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def _close_file(self):
+        if self._writer is None:  # No rows: still write an empty file with the column names
+            table = self._pyarrow.table({column: [] for column in self._columns})
+            self._parquet.write_table(table, self._path)
+        else:
+            self._writer.close()
+
+
+class NpySink(CustomerSink):
+    """
+    Writes customer summaries to a .npy file of structured records, which can be opened
+    without loading it with numpy.load(path, mmap_mode="r").
+    The header is rewritten with the final number of rows when the sink is closed.
+    """
+    def __init__(self, path, columns=RESULT_COLUMNS, chunk_size=10000, dtype=RESULT_DTYPE):
+        """
+        Parameters:
+        - path, columns, chunk_size: as in CustomerSink.
+        - dtype (numpy.dtype): The structured record type, with one field per column.
+
+        Raises ValueError if the field names of dtype are not the columns.
+        """
+        super().__init__(path, columns, chunk_size)
+        if list(dtype.names) != self._columns:
+            raise ValueError("The fields of dtype must be the columns.")
+        self._dtype = dtype
+        # Reserve a header long enough for any number of rows
+        self._header_length = len(npy_header(dtype, 10 ** 19))
+        self._file = open(path, "wb")
+        self._file.write(npy_header(dtype, 0, self._header_length))
+
+    def _write_chunk(self, rows):
+        self._file.write(np.array(rows, dtype=self._dtype).tobytes())
+
+    def _close_file(self):
+        self._file.seek(0)
+        self._file.write(npy_header(self._dtype, self._n_rows, self._header_length))
+        self._file.close()
+
+
+def npy_header(dtype, n_rows, length=None):
+    """
+    Builds a version 1.0 .npy header for a 1-d array of n_rows records. Used by NpySink and by
+    themepark_trace.TraceRecorder to write .npy files a chunk at a time.
+
+    Parameters:
+    - dtype (numpy.dtype): The record type.
+    - n_rows (int): The number of records.
+    - length (int or None): The total header length in bytes, padding with spaces. None uses the shortest
+        length that is a multiple of 64, as numpy does.
+
+    Returns:
+    bytes: the magic string, header length and header.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), n_rows)
+    if length is None:
+        length = -(-(10 + len(header) + 1) // 64) * 64
+    header = header.ljust(length - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
@@ -0,0 +1,211 @@
+import mmap
+import os
+import struct
+import numpy as np
+from themepark_sinks import npy_header
+
+# Event types of the trace records
+TRACE_ARRIVAL = 0  # A customer arrived and joined the queue of ride_id (0 if they left at once)
+TRACE_RIDE = 1  # A customer finished ride_id at time, after waiting wait
+TRACE_REJECTED = 2  # A customer could not start ride_id, as it would end after max_time
+EVENT_NAMES = ("arrival", "ride", "rejected")
+
+# One fixed-width record per event: time, event type, customer_id, ride_id, queue length and wait
+TRACE_RECORD = struct.Struct("<dBqiid")
+TRACE_DTYPE = np.dtype([("time", "<f8"), ("event", "u1"), ("customer_id", "<i8"), ("ride_id", "<i4"),
+                        ("queue_length", "<i4"), ("wait", "<f8")])
+
+
+class TraceRecorder:
+    """
+    Records the events of ThemePark.simulate(trace=...) as fixed-width binary records of TRACE_DTYPE,
+    which costs one struct.pack_into per event instead of formatting and printing a line.
+    In memory, the records are kept in a preallocated buffer, by default a ring holding the latest capacity events.
+    With a path, they are written to a memory-mapped .npy file that grows as needed and keeps every event;
+    once closed, it can be opened with read_trace without loading it.
+
+    Attributes:
+    - capacity (int): The number of records the buffer holds before it wraps around or doubles in size.
+    - path (str or None): The file written to, or None in memory.
+    - ring (bool): Whether the oldest records are overwritten when the buffer is full.
+    - n_recorded (int): The number of events recorded so far.
+    - n_dropped (int): The number of oldest events overwritten by the ring buffer.
+    """
+    def __init__(self, capacity=1 << 16, path=None, ring=True):
+        """
+        Parameters:
+        - capacity (int): The number of records to preallocate. Must be positive.
+        - path (str or None): The .npy file to write to, overwritten. None keeps the records in memory.
+        - ring (bool): If True, a full buffer in memory wraps around to overwrite the oldest records;
+            if False, it doubles in size. A file always grows.
+
+        Raises ValueError if capacity is not a positive integer.
+        """
+        if not isinstance(capacity, int) or capacity <= 0:
+            raise ValueError("capacity must be a positive integer.")
+        self._capacity = capacity
+        self._path = path
+        self._ring = ring and path is None
+        self._n_recorded = 0
+        self._offset = 0  # Byte offset of the next record in the buffer
+        if path is None:
+            self._header_length = 0
+            self._file = None
+            self._buffer = bytearray(capacity * TRACE_RECORD.size)
+        else:
+            # Reserve a header long enough for any number of records, as NpySink does
+            self._header_length = len(npy_header(TRACE_DTYPE, 10 ** 19))
+            self._file = open(path, "w+b")
+            self._file.write(npy_header(TRACE_DTYPE, 0, self._header_length))
+            self._map()
+            self._offset = self._header_length
+        self._end = len(self._buffer)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def ring(self):
+        return self._ring
+
+    @property
+    def n_recorded(self):
+        return self._n_recorded
+
+    @property
+    def n_dropped(self):
+        return max(0, self._n_recorded - self._capacity) if self._ring else 0
+
+    def __len__(self):
+        """Returns the number of records held."""
+        return self._n_recorded - self.n_dropped
+
+    def _map(self):
+        """Sizes the file for capacity records and maps it into memory."""
+        self._file.truncate(self._header_length + self._capacity * TRACE_RECORD.size)
+        self._buffer = mmap.mmap(self._file.fileno(), 0)
+
+    def _grow(self):
+        """Doubles the capacity of the buffer."""
+        if self._path is None:
+            self._buffer.extend(bytes(len(self._buffer)))
+        else:
+            self._buffer.close()
+            self._capacity *= 2
+            self._map()
+        self._capacity = (len(self._buffer) - self._header_length) // TRACE_RECORD.size
+        self._end = len(self._buffer)
+
+    def record(self, time, event, customer_id, ride_id, queue_length, wait):
+        """
+        Records one event.
+
+        Parameters:
+        - time (float): The time of the event.
+        - event (int): TRACE_ARRIVAL, TRACE_RIDE or TRACE_REJECTED.
+        - customer_id (int): The customer concerned.
+        - ride_id (int): The ride concerned, 0 if none.
+        - queue_length (int): The length of the ride's queue after the event.
+        - wait (float): The time the customer waited for the ride, 0.0 if not a ride.
+        """
+        if self._offset == self._end:
+            if self._ring:
+                self._offset = 0  # Overwrite the oldest records
+            else:
+                self._grow()
+        TRACE_RECORD.pack_into(self._buffer, self._offset, time, event, customer_id, ride_id, queue_length, wait)
+        self._offset += TRACE_RECORD.size
+        self._n_recorded += 1
+
+    def to_numpy(self):
+        """
+        Returns the records held, oldest first, as a copy.
+
+        Returns:
+        numpy.ndarray: a structured array of TRACE_DTYPE.
+        """
+        records = np.frombuffer(self._buffer, dtype=TRACE_DTYPE, count=len(self), offset=self._header_length)
+        if self.n_dropped:  # The ring has wrapped around: the oldest record is the next to be overwritten
+            split = self._offset // TRACE_RECORD.size
+            return np.concatenate([records[split:], records[:split]])
+        return records.copy()
+
+    def to_dataframe(self):
+        """Returns the records held as a pandas DataFrame with an 'event' column of event names. Requires pandas."""
+        return trace_dataframe(self.to_numpy())
+
+    def close(self):
+        """Writes the final header and shrinks the file to the records written. Does nothing in memory."""
+        if self._file is not None:
+            self._buffer.close()
+            self._file.truncate(self._header_length + self._n_recorded * TRACE_RECORD.size)
+            self._file.seek(0)
+            self._file.write(npy_header(TRACE_DTYPE, self._n_recorded, self._header_length))
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_trace(path):
+    """
+    Opens a trace written by a closed TraceRecorder without loading it into memory.
+
+    Parameter:
+    path (str): The .npy file of the trace.
+
+    Returns:
+    numpy.ndarray: a read-only memory-mapped structured array of TRACE_DTYPE.
+    """
+    if os.path.getsize(path) == len(npy_header(TRACE_DTYPE, 10 ** 19)):  # numpy cannot map an empty array
+        return np.load(path)
+    return np.load(path, mmap_mode="r")
+
+
+def trace_dataframe(records):
+    """
+    Converts trace records to a pandas DataFrame, with the event types replaced by their names. Requires pandas.
+
+    Parameter:
+    records (numpy.ndarray): A structured array of TRACE_DTYPE.
+
+    Returns:
+    pandas.DataFrame: one row per record.
+    """
+    import pandas as pd  # Only needed here, so that tracing does not import pandas
+    frame = pd.DataFrame(np.asarray(records))
+    frame["event"] = pd.Categorical.from_codes(frame["event"], EVENT_NAMES)
+    return frame
+
+
+def format_trace(records, ride_names=None):
+    """
+    Yields a human-readable line for each trace record, one at a time, so that only the lines
+    actually read are formatted.
+
+    Parameters:
+    - records (numpy.ndarray): A structured array of TRACE_DTYPE.
+    - ride_names (dict or None): The name of each ride_id. The ride_id is used if None.
+
+    Yields:
+    str: the description of the event.
+    """
+    ride_names = ride_names or {}
+    for start in range(0, len(records), 4096):  # Convert to Python values a block at a time
+        for time, event, customer_id, ride_id, queue_length, wait in records[start:start + 4096].tolist():
+            ride_name = ride_names.get(ride_id, f"ride {ride_id}")
+            if event == TRACE_ARRIVAL:
+                yield f"Customer {customer_id} arrived at time {time}."
+            elif event == TRACE_RIDE:
+                yield f"Customer {customer_id} completed {ride_name} at time {time}."
+            else:
+                yield f"Customer {customer_id} cannot start {ride_name} due to insufficient remaining time."